@@ -0,0 +1,533 @@
+r"""Benchmarks for the speed and accuracy of the correspondence pipeline
+
+    python3 -m eval.benchmark precision --device cpu --precision bf16 --num_pairs 4
+    python3 -m eval.benchmark quantize --device cpu --num_pairs 4
+    python3 -m eval.benchmark compile --device cpu --compile trace
+    python3 -m eval.benchmark compile --device cpu --compile trace --check_quantized --model_type tiny-random
+    python3 -m eval.benchmark encoders --device cpu --encoders vae tiny cached
+    python3 -m eval.benchmark startup --device cpu
+    python3 -m eval.benchmark memory --device cpu --workers 4
+    python3 -m eval.benchmark schedule --benchmark spair --workers 4 8 16
+    python3 -m eval.benchmark ordering --benchmark spair --cache_size 64
+    python3 -m eval.benchmark knn --device cpu --points 1024 4096 --chunk_size 1024
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+import utils.optimize as optimize
+from utils.evaluation import Evaluator
+from utils.optimize_token import load_ldm, quantize_unet, optimize_prompt, run_image_with_tokens_cropped, find_max_pixel_value, init_random_noise, run_unet, crop_image
+from utils.compiled_unet import compile_unet
+from utils import encoders
+from utils.workers import ModelPool, memory_usage
+from utils.cache import LRUCache
+from eval import download
+from eval import schedule
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+
+
+def load_model(args, **kwargs):
+    r"""Loads the model and fills in the default layers of its backend"""
+    ldm = load_ldm(args.device, args.model_type, **kwargs)
+    if args.layers is None:
+        args.layers = ldm.backend.default_layers
+    ldm.backend.check_layers(args.layers)
+    return ldm
+
+
+def load_subset(args):
+    r"""Loads the first num_pairs pairs of the benchmark"""
+    download.download_dataset(args.datapath, args.benchmark)
+    dataset = download.load_dataset(args.benchmark, args.datapath, args.thres, args.device,
+                                    args.split, False, 16, sub_class=args.sub_class)
+    return Subset(dataset, range(min(args.num_pairs, len(dataset))))
+
+
+def run_subset(ldm, dataset, args):
+    r"""Runs the full optimize and evaluate loop over the dataset, returns its StreamingPCK and the seconds taken"""
+    seed_everything(args.seed)
+    loader = DataLoader(dataset, batch_size=1, num_workers=0, shuffle=False)
+
+    with tempfile.TemporaryDirectory() as save_folder:
+        start = time.time()
+        pck = optimize.validate_epoch(ldm,
+                                      loader,
+                                      num_steps=args.num_steps,
+                                      noise_level=args.noise_level,
+                                      upsample_res=args.upsample_res,
+                                      layers=args.layers,
+                                      device=args.device,
+                                      lr=args.learning_rate,
+                                      sigma=args.sigma,
+                                      flip_prob=args.flip_prob,
+                                      num_opt_iterations=args.num_opt_iterations,
+                                      num_iterations=args.num_iterations,
+                                      crop_percent=args.crop_percent,
+                                      save_folder=save_folder)
+        seconds = time.time() - start
+
+    return pck, seconds
+
+
+def mean_pck(pck_array):
+    r"""Mean PCK@0.1 of a pck array with alternating 0.05 and 0.1 entries"""
+    return sum(pck_array[1::2]) / len(pck_array[1::2])
+
+
+def benchmark_precision(args):
+    r"""Compares the PCK and run time of a reduced precision against fp32"""
+    dataset = load_subset(args)
+
+    results = {}
+    for precision in ['fp32', args.precision]:
+        ldm = load_model(args, precision=precision)
+        pck, seconds = run_subset(ldm, dataset, args)
+        results[precision] = (pck.mean(alpha=0.1), seconds)
+        print(f"{precision}: pck {results[precision][0]:.2f} in {seconds:.1f} seconds")
+        del ldm
+
+    pck_ref, seconds_ref = results['fp32']
+    pck, seconds = results[args.precision]
+    print(f"{args.precision} vs fp32 on {args.device}: pck delta {pck - pck_ref:+.2f}, speedup {seconds_ref / seconds:.2f}x")
+
+
+def attention_argmaxes(ldm, image, context, args, image_mask=None):
+    r"""Runs inference for a context and returns the argmax of every layer and of their mean"""
+    attn_maps, _ = run_image_with_tokens_cropped(ldm, image, context, index=0, upsample_res=args.upsample_res, noise_level=args.noise_level,
+                                                 layers=args.layers, device=args.device, crop_percent=args.crop_percent,
+                                                 num_iterations=args.num_iterations, image_mask=image_mask)
+    maps = torch.mean(attn_maps, dim=1)
+    layer_argmaxes = torch.stack([find_max_pixel_value(maps[k], img_size=512) + 0.5 for k in range(maps.shape[0])])
+    maps = torch.nn.Softmax(dim=-1)(maps.reshape(maps.shape[0], -1)).reshape(maps.shape)
+    argmax = find_max_pixel_value(torch.mean(maps, dim=0), img_size=512) + 0.5
+    return layer_argmaxes, argmax
+
+
+def benchmark_quantize(args):
+    r"""Validates the int8 unet against fp32 on the attention map argmaxes and the PCK
+
+    Contexts are optimized once with the fp32 unet and inference is run with both unets from the same seed
+    """
+    dataset = load_subset(args)
+    loader = DataLoader(dataset, batch_size=1, num_workers=0, shuffle=False)
+
+    ldm = load_model(args)
+    quantize_unet(ldm)
+    quantized = ldm.quantized_unet
+    backends = {'fp32': None, 'int8': quantized}
+
+    seed_everything(args.seed)
+    pck = {backend: [] for backend in backends}
+    seconds = {backend: 0.0 for backend in backends}
+    layer_distances = []
+    distances = []
+    for mini_batch in loader:
+        est_keypoints = {backend: -1 * torch.ones_like(mini_batch['src_kps']) for backend in backends}
+        image_mask = None if 'bool_img_trg' not in mini_batch else mini_batch['bool_img_trg'][0]
+        for j in range(mini_batch['src_kps'].shape[2]):
+            if mini_batch['src_kps'][0, 0, j] == -1:
+                break
+            context = optimize_prompt(ldm, mini_batch['src_img'][0], mini_batch['src_kps'][0, :, j]/512, num_steps=args.num_steps,
+                                      device=args.device, layers=args.layers, lr=args.learning_rate, upsample_res=args.upsample_res,
+                                      noise_level=args.noise_level, sigma=args.sigma, flip_prob=args.flip_prob, crop_percent=args.crop_percent)
+            argmaxes = {}
+            for backend, unet in backends.items():
+                ldm.quantized_unet = unet
+                seed_everything(args.seed + j)
+                start = time.time()
+                argmaxes[backend] = attention_argmaxes(ldm, mini_batch['trg_img'][0], context, args, image_mask=image_mask)
+                seconds[backend] += time.time() - start
+                est_keypoints[backend][0, :, j] = argmaxes[backend][1]
+            layer_distances.append((argmaxes['fp32'][0] - argmaxes['int8'][0]).norm(dim=-1))
+            distances.append((argmaxes['fp32'][1] - argmaxes['int8'][1]).norm())
+
+        for backend in backends:
+            pck[backend] += Evaluator.eval_kps_transfer(est_keypoints[backend].cpu(), mini_batch)['pck']
+    ldm.quantized_unet = quantized
+
+    layer_distances = torch.stack(layer_distances).cpu()
+    distances = torch.stack(distances).cpu()
+    for k, layer in enumerate(args.layers):
+        print(f"layer {layer}: argmax agreement {(layer_distances[:, k] < 1).float().mean() * 100:.1f}%, mean distance {layer_distances[:, k].mean():.2f} px")
+    print(f"combined: argmax agreement {(distances < 1).float().mean() * 100:.1f}%, mean distance {distances.mean():.2f} px")
+    for backend in backends:
+        print(f"{backend}: pck {mean_pck(pck[backend]):.2f}, inference took {seconds[backend]:.1f} seconds")
+    print(f"int8 vs fp32: pck delta {mean_pck(pck['int8']) - mean_pck(pck['fp32']):+.2f}, speedup {seconds['fp32'] / seconds['int8']:.2f}x")
+
+
+def time_unet_calls(ldm, args):
+    r"""Times the first call and the steady state of the attention capturing unet, forward and backward as in optimize_prompt"""
+    size = ldm.backend.latent_size
+    latents = torch.randn(1, 4, size, size).to(args.device)
+    context = init_random_noise(args.device, dim=ldm.backend.context_dim)
+    context.requires_grad = True
+    t = ldm.scheduler.timesteps[args.noise_level]
+
+    def call():
+        controller = run_unet(ldm, latents, context, t)
+        sum(attn.sum() for attn in controller.attention_store["up_cross"]).backward()
+
+    start = time.time()
+    call()
+    startup = time.time() - start
+
+    start = time.time()
+    for _ in range(args.num_calls):
+        call()
+    steady = (time.time() - start) / args.num_calls
+
+    return startup, steady
+
+
+def benchmark_compile(args):
+    r"""Startup and steady state throughput of the compiled unet against eager"""
+    ldm = load_model(args)
+
+    results = {}
+    for mode in ['none', args.compile]:
+        compile_unet(ldm, mode, args.compile_cache)
+        startup, steady = time_unet_calls(ldm, args)
+        results[mode] = steady
+        cached = mode != 'none' and ldm.unet_compiler.loaded_from_cache
+        print(f"{mode}: startup {startup:.2f} seconds{' (loaded from cache)' if cached else ''}, steady state {steady * 1000:.1f} ms per step, {1 / steady:.2f} steps per second")
+
+    print(f"{args.compile} vs eager: steady state speedup {results['none'] / results[args.compile]:.2f}x")
+
+    if args.check_quantized:
+        check_quantized_cache(ldm, args)
+
+
+def check_quantized_cache(ldm, args):
+    r"""Compiles the fp32 and the int8 unet into the same cache and checks they are kept apart
+
+    Both unets have the same config and parameter dtype, a shared cache entry would silently run one in place of the other
+    """
+    quantize_unet(ldm)
+    compile_unet(ldm, args.compile, args.compile_cache)
+    compiler = ldm.unet_compiler
+    unets = {'fp32': ldm.unet, 'int8': ldm.quantized_unet}
+
+    size = ldm.backend.latent_size
+    latents = torch.randn(1, 4, size, size).to(args.device)
+    context = init_random_noise(args.device, dim=ldm.backend.context_dim)
+    t = ldm.scheduler.timesteps[args.noise_level]
+
+    paths = {backend: compiler.cache_path(unet, latents, context) for backend, unet in unets.items()}
+    with torch.no_grad():
+        maps = {backend: compiler(unet, latents, t, context)[1] for backend, unet in unets.items()}
+    difference = max((fp32 - int8).abs().max().item() for fp32, int8 in zip(maps['fp32'], maps['int8']))
+
+    print(f"cache entries: fp32 {paths['fp32']}, int8 {paths['int8']}, largest attention map difference {difference:.2e}")
+    if paths['fp32'] == paths['int8'] or difference == 0:
+        raise RuntimeError("the fp32 and int8 unets share a compile cache entry")
+
+
+def benchmark_encoders(args):
+    r"""Fidelity against the vae latents and per-step latency of every encoder backend
+
+    Every crop is encoded args.repeats times, as happens for uncropped or seeded images, so the cached backend can hit
+    """
+    dataset = load_subset(args)
+    ldm = load_model(args)
+
+    seed_everything(args.seed)
+    crops = []
+    for item in dataset:
+        for key in ['src_img', 'trg_img']:
+            pixel = torch.rand(2) * 512
+            cropped_image, _, _, _, _, _ = crop_image(item[key].to(args.device), pixel, crop_percent=args.crop_percent)
+            crops.append(cropped_image[None] * 2 - 1)
+
+    with torch.no_grad():
+        reference = [encoders.VAEEncoder(ldm).encode(crop) for crop in crops]
+
+        for name in args.encoders:
+            encoder = encoders.get_encoder(name, ldm)
+            errors = []
+            cosines = []
+            start = time.time()
+            for _ in range(args.repeats):
+                for n, (crop, ref) in enumerate(zip(crops, reference)):
+                    # keyed by the crop, as the inference crops are by their image and box
+                    latents = encoder.encode(crop, keys=[n])
+                    errors.append(((latents - ref).norm() / ref.norm()).item())
+                    cosines.append(torch.nn.functional.cosine_similarity(latents.flatten(), ref.flatten(), dim=0).item())
+            seconds = (time.time() - start) / (len(crops) * args.repeats)
+
+            hits = f", cache hit rate {encoder.hits / (encoder.hits + encoder.misses) * 100:.1f}%" if name == 'cached' else ''
+            print(f"{name}: {seconds * 1000:.1f} ms per step, relative error {np.mean(errors):.4f}, cosine similarity {np.mean(cosines):.4f}{hits}")
+
+
+def run_measured(code):
+    r"""Runs python code in a fresh interpreter, returns the json it prints last with its peak resident memory added"""
+    wrapped = code + "\nimport resource\nresult['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024\nprint(json.dumps(result))"
+    process = subprocess.run([sys.executable, '-c', wrapped], capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"benchmark subprocess failed:\n{process.stderr}")
+    return json.loads(process.stdout.strip().split('\n')[-1])
+
+
+def benchmark_startup(args):
+    r"""Cold start seconds and resident memory of loading the whole pipeline against lean loading"""
+    for lean in [False, True]:
+        result = run_measured(
+            "import json, time\n"
+            "start = time.time()\n"
+            "from utils.optimize_token import load_ldm\n"
+            "imported = time.time()\n"
+            f"ldm = load_ldm({args.device!r}, {args.model_type!r}, lean={lean})\n"
+            "result = {'import_seconds': imported - start, 'seconds': time.time() - start}"
+        )
+        print(f"{'lean' if lean else 'pipeline'}: cold start {result['seconds']:.2f} seconds "
+              f"({result['import_seconds']:.2f} importing), peak resident memory {result['max_rss_mb']:.0f} MB")
+
+
+def unet_step(ldm, seed):
+    r"""Optimizes a context for one step on random latents, the work a pool worker does per step of optimize_prompt"""
+    generator = torch.Generator().manual_seed(seed)
+    size = ldm.backend.latent_size
+    latents = torch.randn(1, 4, size, size, generator=generator).to(ldm.device)
+    context = torch.randn(1, 77, ldm.backend.context_dim, generator=generator).to(ldm.device)
+    context.requires_grad = True
+    controller = run_unet(ldm, latents, context, ldm.scheduler.timesteps[-8])
+    sum(attn.sum() for attn in controller.attention_store["up_cross"]).backward()
+    return seed
+
+
+def benchmark_memory(args):
+    r"""Memory of workers sharing the parent's weights against every worker loading its own copy"""
+    ldm = load_model(args, lean=args.lean_loading)
+
+    start = time.time()
+    with ModelPool(ldm, args.workers) as pool:
+        for _ in pool.imap(unet_step, range(args.workers * args.steps_per_worker)):
+            pass
+        seconds = time.time() - start
+        parent = memory_usage()
+        pool.report()
+
+    # the rss counts the shared weights in full, which is what every worker would hold if it loaded its own copy
+    shared = parent['pss'] + sum(stats['memory']['pss'] for stats in pool.stats.values())
+    separate = sum(stats['memory']['rss'] for stats in pool.stats.values())
+    print(f"{args.workers} workers: {args.workers * args.steps_per_worker / seconds:.2f} steps per second, "
+          f"{shared:.0f} MB in total against {separate:.0f} MB with a separate process per worker")
+
+
+def benchmark_schedule(args):
+    r"""Estimated makespan of naive index sharding against longest processing time first scheduling of the whole split"""
+    download.download_dataset(args.datapath, args.benchmark)
+    dataset = download.load_dataset(args.benchmark, args.datapath, args.thres, args.device,
+                                    args.split, False, 16, sub_class=args.sub_class)
+
+    cost_model = schedule.CostModel(args.num_steps, args.num_opt_iterations, args.num_iterations)
+    if args.seconds_per_keypoint is not None:
+        # e.g. the fit printed at the end of an eval.eval run
+        cost_model.seconds_per_unit = args.seconds_per_keypoint / cost_model.units_per_keypoint
+        cost_model.overhead = args.overhead
+    costs = schedule.pair_costs(dataset, cost_model)
+    print(f"{len(dataset)} pairs, {cost_model}, {costs.sum() / 3600:.1f} hours in total")
+
+    for workers in args.workers:
+        bound = max(costs.sum() / workers, costs.max())
+        makespans = {
+            'index shards': schedule.bins_makespan(costs, schedule.index_bins(len(costs), workers)),
+            'queue in index order': schedule.queue_makespan(costs, range(len(costs)), workers),
+            'lpt shards': schedule.bins_makespan(costs, schedule.lpt_bins(costs, workers)),
+            'queue in lpt order': schedule.queue_makespan(costs, schedule.lpt_order(costs), workers),
+        }
+        print(f"{workers} workers, lower bound {bound / 3600:.2f} hours: " +
+              ", ".join(f"{name} {makespan / 3600:.2f} hours ({makespan / bound:.3f}x)" for name, makespan in makespans.items()))
+
+
+def order_hit_rates(dataset, order, cache_size):
+    r"""Hit rates of an image cache and of a cache keyed on the source image (contexts, source latents) over an order of pairs"""
+    images = LRUCache(cache_size)
+    sources = LRUCache(cache_size)
+    for idx in order:
+        _, src, trg = dataset.pair_key(idx)
+        images.get_or_compute(src, lambda: True)
+        images.get_or_compute(trg, lambda: True)
+        sources.get_or_compute(src, lambda: True)
+    return images.hit_rate, sources.hit_rate
+
+
+def benchmark_ordering(args):
+    r"""Cache hit rates under every --order of eval.eval, simulated from the pair annotations without running the model"""
+    download.download_dataset(args.datapath, args.benchmark)
+    dataset = download.load_dataset(args.benchmark, args.datapath, args.thres, args.device,
+                                    args.split, False, 16, sub_class=args.sub_class)
+    cost_model = schedule.CostModel(args.num_steps, args.num_opt_iterations, args.num_iterations)
+
+    for name in ['shuffle', 'index', 'locality', 'cost']:
+        order = schedule.pair_order(dataset, name, cost_model)
+        if order is None:
+            order = np.random.RandomState(args.seed).permutation(len(dataset))
+        image_rate, source_rate = order_hit_rates(dataset, order, args.cache_size)
+        print(f"{name}: image cache hit rate {image_rate * 100:.1f}%, source image hit rate {source_rate * 100:.1f}%")
+
+
+def find_knn_repeated(db_vectors, qr_vectors):
+    r"""find_knn as it was before chunking, both point sets are repeated into [db, queries, dim] tensors"""
+    db = db_vectors.unsqueeze(1).repeat(1, qr_vectors.size(0), 1)
+    qr = qr_vectors.unsqueeze(0).repeat(db_vectors.size(0), 1, 1)
+    dist = (db - qr).pow(2).sum(2).pow(0.5).t()
+    _, nearest_idx = dist.min(dim=1)
+
+    return nearest_idx
+
+
+def benchmark_knn(args):
+    r"""Peak memory and seconds of the chunked find_knn against repeating both point sets, on dense point sets"""
+    from eval.dataset import find_knn
+
+    if args.half and torch.device(args.device).type != 'cuda':
+        raise ValueError(f"--half computes the distances in fp16, which is only supported on cuda devices, not {args.device}")
+
+    for points in args.points:
+        generator = torch.Generator().manual_seed(args.seed)
+        db, qr = torch.rand(2, points, args.dim, generator=generator).to(args.device)
+        # the chunked search finds the same neighbours up to ties and rounding of the distances
+        nearest = find_knn(db, qr, chunk_size=args.chunk_size, half=args.half)
+        exact = torch.cdist(qr, db, compute_mode='donot_use_mm_for_euclid_dist').min(dim=1)[0]
+        error = ((qr - db[nearest]).norm(dim=1) - exact).abs().max().item()
+
+        for name, call in [('repeated', 'find_knn_repeated(db, qr)'),
+                           ('chunked', f'find_knn(db, qr, chunk_size={args.chunk_size}, half={args.half})')]:
+            # every run is a fresh process so the peak resident memory is its own, cuda reports its allocator peak
+            result = run_measured(
+                "import json, time, torch\n"
+                "from eval.benchmark import find_knn_repeated\n"
+                "from eval.dataset import find_knn\n"
+                "from utils.workers import memory_usage\n"
+                f"generator = torch.Generator().manual_seed({args.seed})\n"
+                f"db, qr = torch.rand(2, {points}, {args.dim}, generator=generator).to({args.device!r})\n"
+                "cuda = db.is_cuda\n"
+                "if cuda:\n"
+                "    torch.cuda.reset_peak_memory_stats()\n"
+                "baseline = torch.cuda.memory_allocated() / 2**20 if cuda else memory_usage()['rss']\n"
+                "start = time.time()\n"
+                f"nearest = {call}\n"
+                "if cuda:\n"
+                "    torch.cuda.synchronize()\n"
+                "result = {'seconds': time.time() - start, 'baseline': baseline, 'cuda_peak': torch.cuda.max_memory_allocated() / 2**20 if cuda else None}"
+            )
+            peak = result['cuda_peak'] if result['cuda_peak'] is not None else result['max_rss_mb']
+            print(f"{points} points, {name}: {result['seconds']:.3f} seconds, peak memory {peak - result['baseline']:.0f} MB above the inputs")
+        print(f"{points} points: chunked neighbours are within {error:.2e} of the exact nearest distance")
+
+
+def add_common_args(parser):
+    # Dataset
+    parser.add_argument('--datapath', type=str, default='../Datasets_CATs')
+    parser.add_argument('--benchmark', type=str,
+                        choices=['spair', 'pfwillow', 'cubs', 'custom'], default='custom')
+    parser.add_argument('--thres', type=str, default='auto',
+                        choices=['auto', 'img', 'bbox'])
+    parser.add_argument('--sub_class', type=str, default='all')
+    parser.add_argument('--split', type=str, default='test',
+                        choices=['test', 'trn', 'val'])
+    parser.add_argument('--num_pairs', type=int, default=4,
+                        help='number of pairs to benchmark on')
+
+    # Hyperparameters, defaults match eval.eval
+    parser.add_argument('--num_steps', type=int, default=129)
+    parser.add_argument('--noise_level', type=int, default=-8)
+    parser.add_argument('--flip_prob', type=float, default=0.0)
+    parser.add_argument('--sigma', type=float, default=27.97853316316864)
+    parser.add_argument('--layers', type=int, nargs='+', default=None)
+    parser.add_argument('--learning_rate', type=float, default=0.0023755632081200314)
+    parser.add_argument('--crop_percent', type=float, default=93.16549294381423)
+    parser.add_argument('--num_opt_iterations', type=int, default=5)
+    parser.add_argument('--num_iterations', type=int, default=20)
+    parser.add_argument('--upsample_res', type=int, default=512)
+
+    # Run details
+    parser.add_argument('--model_type', type=str, default='CompVis/stable-diffusion-v1-4')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark Script')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    precision_parser = subparsers.add_parser('precision', help='PCK delta and speedup of reduced precision against fp32')
+    add_common_args(precision_parser)
+    precision_parser.add_argument('--precision', type=str, default='bf16', choices=['bf16', 'fp16'])
+    precision_parser.set_defaults(func=benchmark_precision)
+
+    quantize_parser = subparsers.add_parser('quantize', help='attention argmax agreement, PCK and speedup of the int8 unet against fp32')
+    add_common_args(quantize_parser)
+    quantize_parser.set_defaults(func=benchmark_quantize)
+
+    compile_parser = subparsers.add_parser('compile', help='startup and steady state throughput of the compiled unet against eager')
+    add_common_args(compile_parser)
+    compile_parser.add_argument('--compile', type=str, default='trace', choices=['trace', 'inductor'])
+    compile_parser.add_argument('--compile_cache', type=str, default='.cache/unet')
+    compile_parser.add_argument('--num_calls', type=int, default=10,
+                                help='number of steady state unet calls to time')
+    compile_parser.add_argument('--check_quantized', action='store_true',
+                                help='also compile the int8 unet into the same cache and check it gets its own entry')
+    compile_parser.set_defaults(func=benchmark_compile)
+
+    encoders_parser = subparsers.add_parser('encoders', help='fidelity and per-step latency of the image2latent backends')
+    add_common_args(encoders_parser)
+    encoders_parser.add_argument('--encoders', type=str, nargs='+', default=['vae', 'tiny', 'cached'],
+                                 choices=list(encoders.ENCODERS))
+    encoders_parser.add_argument('--repeats', type=int, default=2,
+                                 help='number of times every crop is encoded')
+    encoders_parser.set_defaults(func=benchmark_encoders)
+
+    startup_parser = subparsers.add_parser('startup', help='cold start time and resident memory of pipeline against lean loading')
+    add_common_args(startup_parser)
+    startup_parser.set_defaults(func=benchmark_startup)
+
+    memory_parser = subparsers.add_parser('memory', help='per worker memory of a pool sharing one copy of the weights')
+    add_common_args(memory_parser)
+    memory_parser.add_argument('--workers', type=int, default=4)
+    memory_parser.add_argument('--steps_per_worker', type=int, default=2)
+    memory_parser.add_argument('--lean_loading', action='store_true')
+    memory_parser.set_defaults(func=benchmark_memory)
+
+    schedule_parser = subparsers.add_parser('schedule', help='estimated makespan of index sharding against cost ordered scheduling')
+    add_common_args(schedule_parser)
+    schedule_parser.add_argument('--workers', type=int, nargs='+', default=[4, 8, 16])
+    schedule_parser.add_argument('--seconds_per_keypoint', type=float, default=None,
+                                 help='measured cost of a keypoint, the prior of the cost model by default')
+    schedule_parser.add_argument('--overhead', type=float, default=2.0,
+                                 help='measured seconds per pair, used with --seconds_per_keypoint')
+    schedule_parser.set_defaults(func=benchmark_schedule)
+
+    ordering_parser = subparsers.add_parser('ordering', help='cache hit rates under every pair ordering')
+    add_common_args(ordering_parser)
+    ordering_parser.add_argument('--cache_size', type=int, default=64,
+                                 help='number of images or sources the simulated caches keep')
+    ordering_parser.set_defaults(func=benchmark_ordering)
+
+    knn_parser = subparsers.add_parser('knn', help='peak memory of the chunked nearest neighbour search against the repeated one')
+    add_common_args(knn_parser)
+    knn_parser.add_argument('--points', type=int, nargs='+', default=[1024, 4096],
+                            help='number of database and query points')
+    knn_parser.add_argument('--dim', type=int, default=2)
+    knn_parser.add_argument('--chunk_size', type=int, default=1024)
+    knn_parser.add_argument('--half', action='store_true', help='compute the chunked distances in fp16, cuda devices only')
+    knn_parser.set_defaults(func=benchmark_knn)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,86 +1,99 @@
 import os
-import cv2
 import math
 import torch
-import itertools
 import numpy as np
 from PIL import Image, ImageOps
 from torch.utils.data import Dataset, DataLoader
 
+from utils.cache import LRUCache
+
 
 class CUBDataset(Dataset):
+    NUM_PARTS = 15
+
     def __init__(self, datapath="/scratch/iamerich/Datasets_CATs", split="test", num_classes=3, item_index=-1, *args, **kwargs):
         self.datapath = f"{datapath}/CUB_200_2011"
         self.train = split!="test"
         self.num_classes = num_classes
 
-        # Load image list
+        # Load image list, image ids run from 1 to the number of images and row = id - 1 in every array below
         with open(os.path.join(self.datapath, "images.txt"), "r") as f:
-            self.images = [line.strip().split() for line in f.readlines()]
-
-        # Load train/test split
-        with open(os.path.join(self.datapath, "train_test_split.txt"), "r") as f:
-            self.train_test_split = [line.strip().split() for line in f.readlines()]
-
-        # Load part locations
-        with open(os.path.join(self.datapath, "parts/part_locs.txt"), "r") as f:
-            self.part_locs = {}
-            for line in f.readlines():
-                img_id, part_id, x, y, visible = line.strip().split()
-                if img_id not in self.part_locs:
-                    self.part_locs[img_id] = []
-                self.part_locs[img_id].append((int(part_id), float(x), float(y), int(visible)))
-
-        # Load image class labels
-        with open(os.path.join(self.datapath, "image_class_labels.txt"), "r") as f:
-            self.image_class_labels = {line.split()[0]: int(line.split()[1]) for line in f.readlines()}
-
-        # Filter images based on train/test split and class labels
-        self.filtered_images = []
-        for img_id, img_name in self.images:
-            is_training_image = int(self.train_test_split[int(img_id) - 1][1])
-            class_id = self.image_class_labels[img_id]
-            if ((self.train and is_training_image) or (not self.train and not is_training_image)) and (class_id <= self.num_classes):
-                self.filtered_images.append((img_id, img_name))
-        
-        # Generate all pairs for each class
-        pairs = []
-        for class_id in range(1, self.num_classes + 1):
-            class_images = [img for img in self.filtered_images if self.image_class_labels[img[0]] == class_id]
-            class_pairs = list(itertools.combinations(class_images, 2))
-            pairs.extend(class_pairs)
+            self.image_names = [line.strip().split()[1] for line in f.readlines()]
+        num_images = len(self.image_names)
+
+        # Load train/test split and image class labels
+        is_training_image = np.loadtxt(os.path.join(self.datapath, "train_test_split.txt"), dtype=np.int64)[:, 1].astype(bool)
+        self.labels = np.loadtxt(os.path.join(self.datapath, "image_class_labels.txt"), dtype=np.int64)[:, 1]
+
+        # Load part locations into [images, parts, (part_id, x, y, visible)]
+        part_locs = np.loadtxt(os.path.join(self.datapath, "parts/part_locs.txt"), dtype=np.float32).reshape(-1, 5)
+        self.parts = np.zeros((num_images, self.NUM_PARTS, 4), dtype=np.float32)
+        self.parts[part_locs[:, 0].astype(np.int64) - 1, part_locs[:, 1].astype(np.int64) - 1] = part_locs[:, 1:]
 
-        # Use only the specified pair index if provided
-        if item_index != -1:
-            if 0 <= item_index < len(pairs):
-                self.pairs = [pairs[item_index]]
-            else:
-                raise IndexError("The specified pair index is out of range.")
-        else:
-            self.pairs = pairs
-            
         # Load bounding box data
-        with open(os.path.join(self.datapath, "bounding_boxes.txt"), "r") as f:
-            self.bounding_boxes = {line.split()[0]: list(map(float, line.strip().split()[1:])) for line in f.readlines()}
+        self.bounding_boxes = np.loadtxt(os.path.join(self.datapath, "bounding_boxes.txt"), dtype=np.float64)[:, 1:]
+
+        # Filter images based on train/test split and class labels, grouped by class in image order
+        selected = np.flatnonzero((is_training_image == self.train) & (self.labels <= self.num_classes))
+        self.class_images = selected[np.argsort(self.labels[selected], kind="stable")]
+        images_per_class = np.bincount(self.labels[selected], minlength=self.num_classes + 1)[1:self.num_classes + 1]
+
+        # All pairs of images of a class, in the order of itertools.combinations, are indexed arithmetically:
+        # the pairs of class c start at pair_offsets[c - 1] and its images at image_offsets[c - 1]
+        self.image_offsets = np.concatenate([[0], np.cumsum(images_per_class)])
+        self.pair_offsets = np.concatenate([[0], np.cumsum(images_per_class * (images_per_class - 1) // 2)])
+
+        # Use only the specified pair index if provided
+        self.item_index = item_index
+        if item_index != -1 and not 0 <= item_index < self.pair_offsets[-1]:
+            raise IndexError("The specified pair index is out of range.")
+
+        self.image_cache = LRUCache(maxsize=64)
+        # resized images read from a memory mapped eval.image_cache.ImageCache instead, if one is set
+        self.preprocessed = None
                 
     def __len__(self):
-        return len(self.pairs)
+        return 1 if self.item_index != -1 else int(self.pair_offsets[-1])
+
+    def pair(self, idx):
+        """rows of the two images of a pair, the idx-th of itertools.combinations over the images of each class"""
+        if self.item_index != -1:
+            idx = self.item_index
+        if not 0 <= idx < self.pair_offsets[-1]:
+            raise IndexError(idx)
+
+        c = int(np.searchsorted(self.pair_offsets, idx, side="right")) - 1
+        k = idx - int(self.pair_offsets[c])
+        n = int(self.image_offsets[c + 1] - self.image_offsets[c])
+
+        # the pairs (i, j > i) of the first image i number n - 1, n - 2, ..., so pair k has the largest i with
+        # i * n - i * (i + 1) / 2 <= k, corrected for the rounding of the square root
+        i = int((2 * n - 1 - math.sqrt((2 * n - 1) ** 2 - 8 * k)) // 2)
+        while i > 0 and i * n - i * (i + 1) // 2 > k:
+            i -= 1
+        while (i + 1) * n - (i + 1) * (i + 2) // 2 <= k:
+            i += 1
+        j = k - (i * n - i * (i + 1) // 2) + i + 1
+
+        first = int(self.image_offsets[c])
+        return int(self.class_images[first + i]), int(self.class_images[first + j])
 
     def __getitem__(self, idx):
-        (img1_id, img1_name), (img2_id, img2_name) = self.pairs[idx]
+        row1, row2 = self.pair(idx)
+        img1_name, img2_name = self.image_names[row1], self.image_names[row2]
 
         # Load images
-        img1, scale_factor_1, pad_left_1, pad_top_1, bool_img_src = self.load_image(img1_name)
-        img2, scale_factor_2, pad_left_2, pad_top_2, bool_img_trg = self.load_image(img2_name)
+        img1, scale_factor_1, pad_left_1, pad_top_1, bool_img_src = self.image_cache.get_or_compute(img1_name, lambda: self.load_image(img1_name))
+        img2, scale_factor_2, pad_left_2, pad_top_2, bool_img_trg = self.image_cache.get_or_compute(img2_name, lambda: self.load_image(img2_name))
 
         # Load keypoints and visibility
-        keypoints1 = torch.tensor(self.part_locs[img1_id], dtype=torch.float)
+        keypoints1 = torch.from_numpy(self.parts[row1].copy())
         keypoints1[:, 1] *= scale_factor_1[0]
         keypoints1[:, 2] *= scale_factor_1[1]
         keypoints1[:, 1] += pad_left_1
         keypoints1[:, 2] += pad_top_1
         visibility1 = keypoints1[:, -1].bool()
-        keypoints2 = torch.tensor(self.part_locs[img2_id], dtype=torch.float)
+        keypoints2 = torch.from_numpy(self.parts[row2].copy())
         keypoints2[:, 1] *= scale_factor_2[0]
         keypoints2[:, 2] *= scale_factor_2[1]
         keypoints2[:, 1] += pad_left_2
@@ -100,25 +113,39 @@ class CUBDataset(Dataset):
         reordered_keypoints2[:num_overlapping] = keypoints2[overlapping, 1:3]
         
         # Load bounding box for the image
-        bbox = self.bounding_boxes[img2_id]
+        bbox = self.bounding_boxes[row2].tolist()
 
         # Compute PCK threshold for the image
         pck_threshold = self.compute_pck_threshold_per_image(bbox, scale_factor_2[0])
 
         return {'pckthres': pck_threshold, 'src_img': img1/255.0, 'trg_img': img2/255.0, 'src_kps': reordered_keypoints1.permute(1, 0), 'trg_kps': reordered_keypoints2.permute(1, 0), 'n_pts': torch.tensor([num_overlapping]), 'bbox': bbox, 'idx': torch.tensor([idx]), 'bool_img_src':bool_img_src, 'bool_img_trg':bool_img_trg, 'resized': pad_left_1 > 10 or pad_top_1  > 10 or pad_left_2  > 10 or pad_top_2  > 10}
     
-    def load_image(self, img_name):
+    def num_keypoints(self, idx):
+        row1, row2 = self.pair(idx)
+        # the parts visible in both images, as counted in __getitem__
+        return int(np.sum((self.parts[row1, :, 3] > 0) & (self.parts[row2, :, 3] > 0)))
+
+    def pair_key(self, idx):
+        row1, row2 = self.pair(idx)
+        return int(self.labels[row1]), self.image_names[row1], self.image_names[row2]
+
+    def image_keys(self):
+        return sorted(self.image_names[row] for row in self.class_images)
+
+    def read_image(self, img_name):
         img_path = os.path.join(self.datapath, "images", img_name)
         image = Image.open(img_path).convert('RGB')
 
-        width, height = image.size
-        max_dim = max(width, height)
-        scale_factor = 512 / max_dim
-        
         # upscale to 512x512
-        image = image.resize((512, 512), Image.BILINEAR)
-        image = np.array(image)
-        image = torch.from_numpy(image).permute(2, 0, 1).float()
+        return np.array(image.resize((512, 512), Image.BILINEAR)), image.size
+
+    def load_image(self, img_name):
+        if self.preprocessed is not None and img_name in self.preprocessed:
+            image, (width, height) = self.preprocessed[img_name]
+        else:
+            image, (width, height) = self.read_image(img_name)
+            image = torch.from_numpy(image)
+        image = image.permute(2, 0, 1).float()
         
         pad_left = 0
         pad_right = 0
@@ -1,5 +1,4 @@
 import os
-import cv2
 import math
 import torch
 import itertools
@@ -13,7 +12,9 @@ class CustomDataset(Dataset):
     This class is used to create a custom dataset for training and testing the model.
     """
     def __init__(self, *args, **kwargs):
-        pass
+        # resized images read from a memory mapped eval.image_cache.ImageCache instead, if one is set
+        self.preprocessed = None
+
     def __len__(self):
         return 1
 
@@ -30,16 +31,30 @@ class CustomDataset(Dataset):
 
         return {'pckthres': torch.tensor([512.0]), 'src_img': source_img, 'trg_img': target_img, 'src_kps': src_kps, 'trg_kps': trg_kps, 'n_pts': n_points, 'idx': torch.tensor([0])}
 
-    def load_image(self, img_name):
+    def num_keypoints(self, idx):
+        return 1
+
+    def pair_key(self, idx):
+        return "custom", "example_images/source_cat.png", "example_images/target_cat.jpeg"
+
+    def image_keys(self):
+        return ["example_images/source_cat.png", "example_images/target_cat.jpeg"]
+
+    def read_image(self, img_name):
         image = Image.open(img_name).convert('RGB')
 
-        image = image.resize((512, 512), Image.BILINEAR)
-    
-        image = np.array(image)
+        return np.array(image.resize((512, 512), Image.BILINEAR)), image.size
+
+    def load_image(self, img_name):
+        if self.preprocessed is not None and img_name in self.preprocessed:
+            image, _ = self.preprocessed[img_name]
+        else:
+            image, _ = self.read_image(img_name)
+            image = torch.from_numpy(image)
     
-        image = np.transpose(image, (2, 0, 1))
+        image = image.permute(2, 0, 1)
         
-        image = torch.tensor(image)/255.0
+        image = image/255.0
 
         return image
 
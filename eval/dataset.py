@@ -9,9 +9,9 @@ from PIL import Image
 import numpy as np
 import torch
 
+from utils.cache import LRUCache
+
 # from .keypoint_to_flow import KeypointToFlow
-import albumentations as A
-# from albumentations.pytorch.transforms import ToTensorV2
 
 
 def resize(img, kps, size=(512, 512)):
@@ -141,6 +141,11 @@ class CorrespondenceDataset(Dataset):
         self.src_kps = []
         self.trg_kps = []
 
+        # Decoded images, pairs sharing images hit when they are run one after another
+        self.image_cache = LRUCache(maxsize=64)
+        # Resized images read from a memory mapped eval.image_cache.ImageCache instead, if one is set
+        self.preprocessed = None
+
         # self.kps_to_flow = KeypointToFlow(receptive_field_size=35, jsz=512//feature_size, feat_size=feature_size, img_size=self.imside)
 
     def __len__(self):
@@ -159,20 +164,14 @@ class CorrespondenceDataset(Dataset):
         batch['category_id'] = self.cls_ids[idx]
         batch['category'] = self.cls[batch['category_id']]
         
-        # Image as numpy (original width, original height)
-        src_pil = self.get_image(self.src_imnames, idx)
-        trg_pil = self.get_image(self.trg_imnames, idx)
-
-        batch['src_imsize'] = src_pil.size
-        batch['trg_imsize'] = trg_pil.size
-            
-        batch['src_img'] = self.transform(src_pil)
-        batch['trg_img'] = self.transform(trg_pil)
+        # Image as tensor and (original width, original height)
+        batch['src_img'], batch['src_imsize'] = self.load_image(self.src_imnames, idx)
+        batch['trg_img'], batch['trg_imsize'] = self.load_image(self.trg_imnames, idx)
         
 
         # Key-points (re-scaled)
-        batch['src_kps'], num_pts = self.get_points(self.src_kps, idx, src_pil.size)
-        batch['trg_kps'], _ = self.get_points(self.trg_kps, idx, trg_pil.size)
+        batch['src_kps'], num_pts = self.get_points(self.src_kps, idx, batch['src_imsize'])
+        batch['trg_kps'], _ = self.get_points(self.trg_kps, idx, batch['trg_imsize'])
         batch['n_pts'] = torch.tensor(num_pts)
 
         # The number of pairs in training split
@@ -180,11 +179,41 @@ class CorrespondenceDataset(Dataset):
 
         return batch
 
+    def num_keypoints(self, idx):
+        r"""Returns the number of key-points of a pair without loading its images"""
+        return self.src_kps[idx].size(1)
+
+    def pair_key(self, idx):
+        r"""Returns (category, source image, target image) of a pair"""
+        return self.cls[self.cls_ids[idx]], self.src_imnames[idx], self.trg_imnames[idx]
+
+    def image_key(self, imnames, idx):
+        r"""Returns the path of an image relative to img_path, its key in a preprocessed image cache"""
+        return imnames[idx]
+
+    def image_keys(self):
+        r"""Returns the keys of all images referenced by the pairs"""
+        return sorted({self.image_key(imnames, idx) for imnames in (self.src_imnames, self.trg_imnames) for idx in range(len(self))})
+
     def get_image(self, imnames, idx):
         r"""Reads PIL image from path"""
-        path = os.path.join(self.img_path, imnames[idx])
+        path = os.path.join(self.img_path, self.image_key(imnames, idx))
         return Image.open(path).convert('RGB')
 
+    def read_image(self, key):
+        r"""Returns an image resized to imside as a uint8 array and its original (width, height), as preprocessed"""
+        pil = Image.open(os.path.join(self.img_path, key)).convert('RGB')
+        return np.array(pil.resize((self.imside, self.imside), Image.BILINEAR)), pil.size
+
+    def load_image(self, imnames, idx):
+        r"""Returns an image tensor resized to imside and its original (width, height)"""
+        key = self.image_key(imnames, idx)
+        if self.preprocessed is not None and key in self.preprocessed:
+            image, imsize = self.preprocessed[key]
+            return image.permute(2, 0, 1).float() / 255, imsize
+        pil = self.image_cache.get_or_compute(key, lambda: self.get_image(imnames, idx))
+        return self.transform(pil), pil.size
+
     def get_pckthres(self, batch, imsize):
         r"""Computes PCK threshold"""
         if self.thres == 'bbox':
@@ -214,11 +243,31 @@ class CorrespondenceDataset(Dataset):
         return kps, n_pts
 
 
-def find_knn(db_vectors, qr_vectors):
-    r"""Finds K-nearest neighbors (Euclidean distance)"""
-    db = db_vectors.unsqueeze(1).repeat(1, qr_vectors.size(0), 1)
-    qr = qr_vectors.unsqueeze(0).repeat(db_vectors.size(0), 1, 1)
-    dist = (db - qr).pow(2).sum(2).pow(0.5).t()
-    _, nearest_idx = dist.min(dim=1)
+def find_knn(db_vectors, qr_vectors, k=1, chunk_size=1024, half=False):
+    r"""Finds K-nearest neighbors (Euclidean distance)
+
+    Distances are computed between chunks of chunk_size queries and chunk_size database vectors at a time and
+    only the k nearest so far are kept, so memory is O(chunk_size^2 + queries * k) instead of the
+    O(db * queries * dim) of repeating both sets against each other. With half the distances are computed
+    in fp16, which needs cuda tensors. Returns the [queries] indices of the nearest database vectors, [queries, k] with k > 1
+    """
+    if half and (db_vectors.device.type != 'cuda' or qr_vectors.device.type != 'cuda'):
+        # cdist and topk have no fp16 cpu kernels in the pinned torch
+        raise ValueError("half=True needs cuda tensors, fp16 distances are not supported on the cpu")
+    dtype = torch.float16 if half else torch.float32
+    nearest_idx = []
+    for q in range(0, qr_vectors.size(0), chunk_size):
+        qr = qr_vectors[q:q + chunk_size].to(dtype)
+        best_dist = qr.new_empty(qr.size(0), 0)
+        best_idx = torch.empty(qr.size(0), 0, dtype=torch.long, device=qr.device)
+        for d in range(0, db_vectors.size(0), chunk_size):
+            db = db_vectors[d:d + chunk_size].to(dtype)
+            # exact differences, the matmul expansion of cdist can pick another neighbour of near ties
+            dist = torch.cat([best_dist, torch.cdist(qr, db, compute_mode='donot_use_mm_for_euclid_dist')], dim=1)
+            idx = torch.cat([best_idx, torch.arange(d, d + db.size(0), device=qr.device).expand(qr.size(0), -1)], dim=1)
+            best_dist, best = dist.topk(min(k, dist.size(1)), dim=1, largest=False, sorted=True)
+            best_idx = idx.gather(1, best)
+        nearest_idx.append(best_idx)
+    nearest_idx = torch.cat(nearest_idx)
 
-    return nearest_idx
+    return nearest_idx[:, 0] if k == 1 else nearest_idx
@@ -1,37 +1,33 @@
 r"""Functions to download semantic correspondence datasets"""
+import importlib
 import tarfile
 import os
 
-import requests
-
-# from . import pfpascal
-from . import pfwillow
-# from . import caltech
-from . import spair
-from . import cub2011
-from . import custom_image
-
 
 def load_dataset(benchmark, datapath, thres, device, split='test', augmentation=False, feature_size=16, sub_class = "all", item_index=-1):
     r"""Instantiates desired correspondence dataset"""
+    # (module, class), modules are only imported when used
     correspondence_benchmark = {
-        # 'pfpascal': pfpascal.PFPascalDataset,
-        'pfwillow': pfwillow.PFWillowDataset,
-        # 'caltech': caltech.CaltechDataset,
-        'spair': spair.SPairDataset,
-        'cubs': cub2011.CUBDataset,
-        'custom': custom_image.CustomDataset,
+        # 'pfpascal': ('pfpascal', 'PFPascalDataset'),
+        'pfwillow': ('pfwillow', 'PFWillowDataset'),
+        # 'caltech': ('caltech', 'CaltechDataset'),
+        'spair': ('spair', 'SPairDataset'),
+        'cubs': ('cub2011', 'CUBDataset'),
+        'custom': ('custom_image', 'CustomDataset'),
     }
 
-    dataset = correspondence_benchmark.get(benchmark)
-    if dataset is None:
+    if benchmark not in correspondence_benchmark:
         raise Exception('Invalid benchmark dataset %s.' % benchmark)
+    module, name = correspondence_benchmark[benchmark]
+    dataset = getattr(importlib.import_module('eval.' + module), name)
 
     return dataset(benchmark=benchmark, datapath=datapath, thres=thres, device=device, split=split, augmentation=augmentation, feature_size=feature_size, sub_class=sub_class, item_index=item_index)
 
 
 def download_from_google(token_id, filename):
     r"""Downloads desired filename from Google drive"""
+    import requests
+
     print('Downloading %s ...' % os.path.basename(filename))
 
     url = 'https://docs.google.com/uc?export=download'
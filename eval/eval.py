@@ -10,16 +10,20 @@ import time
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
 
 import utils.optimize as optimize
 from utils.evaluation import Evaluator
 from eval import download
 
 
-from utils.optimize_token import load_ldm
-
-import wandb
+from utils.optimize_token import load_ldm, quantize_unet
+from utils.compiled_unet import compile_unet
+from utils.prefetch import enable_prefetch
+from eval.lease import LeaseQueue
+from utils.results_store import ResultsStore
+from eval.image_cache import ImageCache
+from eval.schedule import CostModel, pair_order
+from utils.cache import LRUCache
 
 
 if __name__ == "__main__":
@@ -38,7 +42,11 @@ if __name__ == "__main__":
                         choices=['test', 'trn', 'val'])
     parser.add_argument('--item_index', type=int, default=-1)
     parser.add_argument('--batch-size', type=int, default=1,
-                        help='training batch size')
+                        help='number of pairs whose unet calls are batched together')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='DataLoader processes loading the next pairs while the current one runs')
+    parser.add_argument('--image_cache', type=str, default=None,
+                        help='directory of images preprocessed with python -m eval.image_cache, read instead of decoding the images')
 
     # Hyperparameters
     parser.add_argument('--num_steps', type=int, default=129)
@@ -48,7 +56,8 @@ if __name__ == "__main__":
                         help='probability of flipping the image during optimization')
     parser.add_argument('--sigma', type=float, default=27.97853316316864,
                         help='sigma for the gaussian kernel')
-    parser.add_argument('--layers', type=int, nargs='+', default=[5, 6, 7, 8])
+    parser.add_argument('--layers', type=int, nargs='+', default=None,
+                        help='cross attention layers to use, defaults to those of the model backend ([5, 6, 7, 8] for stable diffusion 1.x)')
     parser.add_argument('--learning_rate', type=float,
                         default=0.0023755632081200314, help='learning rate for the optimizer')
     parser.add_argument('--crop_percent', type=float, default=93.16549294381423,
@@ -60,9 +69,25 @@ if __name__ == "__main__":
 
     # Network details
     parser.add_argument('--model_type', type=str,
-                        default='CompVis/stable-diffusion-v1-4', help='ldm model type')
+                        default='CompVis/stable-diffusion-v1-4', help='ldm model type, a backend in utils.backends (e.g. sd-v1-4, bk-sdm-small, tiny-random) or diffusers weights')
+    parser.add_argument('--lean_loading', action='store_true',
+                        help='only load the unet and vae encoder from memory mapped safetensors instead of the whole pipeline')
     parser.add_argument('--upsample_res', type=int, default=512,
                         help='Resolution to upsample the attention maps to')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='precision to run the model in, fp16 is only supported on cuda')
+    parser.add_argument('--encoder', type=str, default='vae', choices=['vae', 'tiny', 'cached'],
+                        help='backend image2latent encodes the crops with')
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'int8'],
+                        help='dynamically quantize the unet used for inference, cpu only')
+    parser.add_argument('--compile', type=str, default='none', choices=['none', 'trace', 'inductor'],
+                        help='run the attention capturing unet as a torch.jit.trace or torch.compile graph')
+    parser.add_argument('--compile_cache', type=str, default='.cache/unet',
+                        help='where compiled unets are cached across runs')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of crops prepared ahead in a background thread while the unet runs, use with --seed for the same results as without')
+    parser.add_argument('--vae_device', type=str, default=None,
+                        help='device to move the vae to, crops are then also encoded ahead when prefetching')
 
     # Run details
     parser.add_argument('--wandb_log', action='store_true',
@@ -86,6 +111,20 @@ if __name__ == "__main__":
                         help='Pseudo-RNG seed')
     parser.add_argument('--ablate', action='store_true',
                         help='evaluate over a smaller number of points')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes sharing the model that pairs are distributed over')
+    parser.add_argument('--order', type=str, default='shuffle', choices=['shuffle', 'index', 'locality', 'cost'],
+                        help='order pairs are run in, locality groups pairs sharing images so caches stay hot, cost runs the pairs with the most keypoints first so no worker is left with a long pair at the end')
+    parser.add_argument('--context_cache', type=int, default=0,
+                        help='number of (source image, keypoint) contexts kept to reuse for later pairs with the same source keypoint, single worker only')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip pairs with saved results and checkpoint every keypoint so an interrupted pair continues where it stopped')
+    parser.add_argument('--lease_dir', type=str, default=None,
+                        help='shared directory nodes claim pairs through, runs every pair not done or claimed by another node')
+    parser.add_argument('--lease_ttl', type=float, default=600,
+                        help='seconds after which the lease of a node that stopped heartbeating is reclaimed')
+    parser.add_argument('--results_store', type=str, default=None,
+                        help='directory of a results store appended to instead of a correspondence_data file per pair, retest reads it and appends to <save_loc>/results_store')
     
     
 
@@ -101,6 +140,8 @@ if __name__ == "__main__":
 
     if args.wandb_log:
         # initialize wandb
+        import wandb
+
         wandb.init(project="estimated_correspondences",
                    name=f"{args.wandb_name}")
         wandb.config.update(args)
@@ -117,14 +158,27 @@ if __name__ == "__main__":
     else:
         test_dataset = download.load_dataset(args.benchmark, args.datapath, args.thres, device,
                                             args.split, False, 16, sub_class=args.sub_class, item_index=-1)
-    test_dataloader = DataLoader(test_dataset,
-                                 batch_size=args.batch_size,
-                                 num_workers=0,
-                                 shuffle=True)
+    if args.image_cache is not None:
+        test_dataset.preprocessed = ImageCache(args.image_cache)
+    cost_model = CostModel(args.num_steps, args.num_opt_iterations, args.num_iterations)
+    order = pair_order(test_dataset, args.order, cost_model)
+    test_dataloader = optimize.data_loader(test_dataset,
+                                           args.num_workers,
+                                           args.device,
+                                           batch_size=args.batch_size,
+                                           shuffle=order is None,
+                                           sampler=order)
     
-    ldm = load_ldm(args.device, args.model_type)
-    
-    from diffusers.models import unet_2d_condition
+    ldm = load_ldm(args.device, args.model_type, precision=args.precision, encoder=args.encoder, lean=args.lean_loading)
+    if args.quantize == 'int8':
+        # retesting never backpropagates so the fp32 unet does not need to be kept
+        quantize_unet(ldm, keep_fp32=args.mode == "optimize")
+    compile_unet(ldm, args.compile, args.compile_cache)
+    if args.prefetch > 0 or args.vae_device is not None:
+        enable_prefetch(ldm, args.prefetch, args.vae_device)
+    if args.layers is None:
+        args.layers = ldm.backend.default_layers
+    ldm.backend.check_layers(args.layers)
 
     # if args.save_loc doesnt exist, create it
     if not os.path.exists(args.save_loc):
@@ -132,48 +186,72 @@ if __name__ == "__main__":
         
     train_started = time.time()
 
+    results_store = None if args.results_store is None else ResultsStore(args.results_store)
+
     if args.mode == "optimize":
         print("validating")
-        pck_array = optimize.validate_epoch(ldm,
-                                            test_dataloader,
-                                            num_steps=args.num_steps,
-                                            noise_level=args.noise_level,
-                                            upsample_res=args.upsample_res,
-                                            layers=args.layers,
-                                            device=args.device,
-                                            visualize=args.visualize,
-                                            epoch=args.epoch,
-                                            lr=args.learning_rate,
-                                            wandb_log=args.wandb_log,
-                                            sigma=args.sigma,
-                                            flip_prob=args.flip_prob,
-                                            num_opt_iterations=args.num_opt_iterations,
-                                            num_iterations=args.num_iterations,
-                                            crop_percent=args.crop_percent,
-                                            save_folder = args.save_loc,
-                                            item_index = args.item_index,)
+        context_cache = LRUCache(args.context_cache) if args.context_cache > 0 else None
+        pck = optimize.validate_epoch(ldm,
+                                      test_dataloader,
+                                      num_steps=args.num_steps,
+                                      noise_level=args.noise_level,
+                                      upsample_res=args.upsample_res,
+                                      layers=args.layers,
+                                      device=args.device,
+                                      visualize=args.visualize,
+                                      epoch=args.epoch,
+                                      lr=args.learning_rate,
+                                      wandb_log=args.wandb_log,
+                                      sigma=args.sigma,
+                                      flip_prob=args.flip_prob,
+                                      num_opt_iterations=args.num_opt_iterations,
+                                      num_iterations=args.num_iterations,
+                                      crop_percent=args.crop_percent,
+                                      save_folder = args.save_loc,
+                                      item_index = args.item_index,
+                                      workers = args.workers,
+                                      lease_queue = None if args.lease_dir is None else LeaseQueue(args.lease_dir, args.save_loc, args.lease_ttl, store=results_store),
+                                      order = order,
+                                      cost_model = cost_model,
+                                      context_cache = context_cache,
+                                      resume = args.resume,
+                                      seed = None if args.seed == -1 else args.seed,
+                                      results_store = results_store,)
         if args.item_index != -1:
             # save the pck array to a text file
             np.savetxt(
-                f"{args.save_loc}/pck_array_{args.item_index:06d}.txt", pck_array)
+                f"{args.save_loc}/pck_array_{args.item_index:06d}.txt", pck.mean())
 
         print('Test took:', time.time()-train_started, 'seconds')
+        print(f"pck: {pck}")
+        if hasattr(test_dataset, 'image_cache'):
+            print(f"image cache: {test_dataset.image_cache}")
+        if hasattr(ldm.encoder, 'cache'):
+            print(f"latent cache: {ldm.encoder.cache}")
+        if context_cache is not None:
+            print(f"context cache: {context_cache}")
+        if hasattr(ldm, 'prefetch_stats'):
+            print(f"prefetch: {ldm.prefetch_stats}")
     elif args.mode == "retest":
         print("retesting")
-        pck_array = optimize.retest(ldm,
-                                    test_dataset,
-                                    noise_level=args.noise_level,
-                                    upsample_res=args.upsample_res,
-                                    layers=args.layers,
-                                    device=args.device,
-                                    visualize=args.visualize,
-                                    epoch=args.epoch,
-                                    wandb_log=args.wandb_log,
-                                    crop_percent=args.crop_percent,
-                                    item_index=args.item_index,
-                                    save_folder = args.save_loc,
-                                    results_loc = args.results_loc,
-                                    num_iterations = args.num_iterations,
-                                    ablate_results = args.ablate_results,)
+        pck = optimize.retest(ldm,
+                              test_dataset,
+                              noise_level=args.noise_level,
+                              upsample_res=args.upsample_res,
+                              layers=args.layers,
+                              device=args.device,
+                              visualize=args.visualize,
+                              epoch=args.epoch,
+                              wandb_log=args.wandb_log,
+                              crop_percent=args.crop_percent,
+                              item_index=args.item_index,
+                              save_folder = args.save_loc,
+                              results_loc = args.results_loc,
+                              num_iterations = args.num_iterations,
+                              ablate_results = args.ablate_results,
+                              seed = None if args.seed == -1 else args.seed,
+                              num_workers = args.num_workers,
+                              results_store = results_store,
+                              save_store = None if results_store is None else ResultsStore(os.path.join(args.save_loc, "results_store")),)
     else:
         raise ValueError("mode must be one of train, evaluate, or optimize")
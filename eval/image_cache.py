@@ -0,0 +1,93 @@
+r"""Preprocessed images of a dataset in one memory mapped array
+
+Decoding a JPEG and resizing it to 512x512 takes longer than reading the resized image, and every run (and
+retest) decodes the same images again. The preprocess command writes every image referenced by the pairs of a
+dataset once, as a [images, 512, 512, 3] uint8 array (images.npy) with an index of the row and original size of
+every image (index.json). Datasets given an ImageCache read zero-copy slices of the mapped array instead.
+
+    python -m eval.image_cache --benchmark spair --split test --out .cache/images/spair_test
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+class ImageCache:
+    r"""Maps image keys of a dataset to (512x512x3 uint8 tensor, original (width, height))"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        self._images = None
+
+    @property
+    def images(self):
+        # mapped on first use, so that every DataLoader worker maps the file itself. Copy on write mode gives
+        # writable (zero-copy) arrays torch.from_numpy accepts, nothing is ever written back
+        if self._images is None:
+            self._images = np.load(os.path.join(self.path, "images.npy"), mmap_mode="c")
+        return self._images
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        row, width, height = self.index[key]
+        return torch.from_numpy(self.images[row]), (width, height)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __repr__(self):
+        return f"ImageCache({self.path}, {len(self)} images)"
+
+
+def preprocess(dataset, path, size=512):
+    r"""Writes every image referenced by the pairs of dataset to path, see dataset.image_keys and dataset.read_image"""
+    keys = dataset.image_keys()
+    os.makedirs(path, exist_ok=True)
+
+    # the index is written last, so an interrupted run never leaves a cache that can be opened
+    images_path = os.path.join(path, "images.npy")
+    images = np.lib.format.open_memmap(images_path + ".tmp", mode="w+", dtype=np.uint8, shape=(len(keys), size, size, 3))
+    index = {}
+    for row, key in enumerate(tqdm(keys)):
+        image, (width, height) = dataset.read_image(key)
+        images[row] = image
+        index[key] = [row, width, height]
+    images.flush()
+    del images
+    os.replace(images_path + ".tmp", images_path)
+
+    with open(os.path.join(path, "index.json.tmp"), "w") as f:
+        json.dump(index, f)
+    os.replace(os.path.join(path, "index.json.tmp"), os.path.join(path, "index.json"))
+
+    return ImageCache(path)
+
+
+if __name__ == "__main__":
+    from eval import download
+
+    parser = argparse.ArgumentParser(description='Writes the images of a dataset to a memory mapped image cache for --image_cache')
+    parser.add_argument('--datapath', type=str, default='../Datasets_CATs')
+    parser.add_argument('--benchmark', type=str, choices=['spair', 'pfwillow', 'cubs', 'custom'], default='custom')
+    parser.add_argument('--split', type=str, default="test", choices=['test', 'trn', 'val'])
+    parser.add_argument('--sub_class', type=str, default="all")
+    parser.add_argument('--out', type=str, required=True, help='directory to write images.npy and index.json to')
+    args = parser.parse_args()
+
+    download.download_dataset(args.datapath, args.benchmark)
+    dataset = download.load_dataset(args.benchmark, args.datapath, 'auto', 'cpu', args.split, False, 16, sub_class=args.sub_class)
+    cache = preprocess(dataset, args.out)
+    print(f"wrote {cache}, {os.path.getsize(os.path.join(args.out, 'images.npy')) / 2**30:.2f} GiB")
@@ -0,0 +1,152 @@
+r"""Work queue for several nodes sharing a results directory, coordinated through lease files
+
+A node claims a pair by atomically creating <lease_dir>/<idx>.lease (O_CREAT | O_EXCL is atomic on local
+filesystems and NFSv3+), and keeps the lease alive by touching it from a heartbeat thread. Leases that were not
+touched for ttl seconds belong to a node that died and are reclaimed by the next node that comes across them.
+A pair whose correspondence_data file exists (or that is in the results store the nodes share) is done, so nodes
+can be added or removed at any time.
+
+Leases only avoid duplicate work: results are written atomically, so a pair that is computed twice after a
+reclaim race is still saved once and completely. Clocks of the nodes should agree to well within ttl.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+
+from torch.utils.data.dataloader import default_collate
+
+from utils.optimize import result_path
+
+
+class Lease:
+    r"""A claimed pair, touched every ttl / 3 seconds until it is released"""
+
+    def __init__(self, path, owner, ttl):
+        self.path = path
+        self.owner = owner
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, args=(ttl / 3,), daemon=True)
+        self._thread.start()
+
+    def owned(self):
+        try:
+            with open(self.path) as f:
+                return f.read() == self.owner
+        except FileNotFoundError:
+            return False
+
+    def _heartbeat(self, interval):
+        while not self._stop.wait(interval):
+            if not self.owned():
+                # another node reclaimed the pair, it is finished anyway and saved by whichever node is last
+                self.lost = True
+                return
+            os.utime(self.path)
+
+    def release(self):
+        self._stop.set()
+        self._thread.join()
+        if self.owned():
+            os.remove(self.path)
+
+
+class LeaseQueue:
+    r"""Claims the pairs of a dataset that are neither done nor leased by a live node"""
+
+    def __init__(self, lease_dir, save_folder, ttl=600, poll=None, store=None):
+        self.lease_dir = lease_dir
+        self.save_folder = save_folder
+        self.store = store
+        self.ttl = ttl
+        self.poll = ttl / 4 if poll is None else poll
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.leases = {}
+        self.reclaimed = 0
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def lease_path(self, idx):
+        return os.path.join(self.lease_dir, f"{idx:06d}.lease")
+
+    def is_done(self, idx):
+        if self.store is not None:
+            return self.store.is_done(idx)
+        return os.path.exists(result_path(self.save_folder, idx))
+
+    def _create(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        return True
+
+    def _expired(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.ttl
+        except FileNotFoundError:
+            return False
+
+    def _reclaim(self, path):
+        r"""Moves an expired lease out of the way, only one of several nodes doing this at once succeeds"""
+        stale = f"{path}.{self.owner}"
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+
+        if not self._expired(stale):
+            # the lease was renewed or reclaimed between the check and the rename, hand it back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+
+        os.remove(stale)
+        self.reclaimed += 1
+        return True
+
+    def claim(self, idx):
+        r"""Returns a Lease on the pair or None if another live node holds it or it is done"""
+        path = self.lease_path(idx)
+        if not self._create(path):
+            if not self._expired(path) or not self._reclaim(path) or not self._create(path):
+                return None
+
+        lease = Lease(path, self.owner, self.ttl)
+        if self.is_done(idx):
+            # finished by another node since it was checked
+            lease.release()
+            return None
+        self.leases[idx] = lease
+        return lease
+
+    def release(self, idx):
+        self.leases.pop(idx).release()
+
+    def pairs(self, dataset, order=None):
+        r"""Yields (idx, mini_batch of one pair) for every pair this node claims until all pairs are done
+
+        Pairs are tried in order (a list of dataset indices, all of them by default). Pairs leased by other nodes
+        are revisited every poll seconds, so they are picked up if their node dies
+        """
+        remaining = list(range(len(dataset))) if order is None else list(order)
+        while remaining:
+            leased = []
+            for idx in remaining:
+                if self.is_done(idx):
+                    continue
+                if self.claim(idx) is None:
+                    leased.append(idx)
+                    continue
+                yield idx, default_collate([dataset[idx]])
+
+            # pairs that were claimed here are done once they have been processed
+            remaining = [idx for idx in leased if not self.is_done(idx)]
+            if remaining:
+                time.sleep(self.poll)
@@ -57,6 +57,10 @@ class PFWillowDataset(CorrespondenceDataset):
         else:
             raise Exception('Invalid pck evaluation level: %s' % self.thres)
 
+    def num_keypoints(self, idx):
+        r"""Returns the number of key-points of a pair without loading its images"""
+        return self.src_kps.shape[1] // 2
+
     def get_points(self, pts_list, idx, org_imsize):
         r"""Returns key-points of an image"""
         point_coords = pts_list[idx, :].reshape(2, 10)
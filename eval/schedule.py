@@ -0,0 +1,100 @@
+r"""Cost model of the pairs of a dataset and longest processing time first scheduling
+
+Every source keypoint of a pair runs num_opt_iterations restarts of num_steps optimization steps (unet forward
+and backward) followed by num_iterations inference iterations (unet forward), so a pair costs roughly
+
+    seconds = n_pts * num_opt_iterations * (num_steps * c_opt + num_iterations * c_inf) * seconds_per_unit + overhead
+
+where costs are in units of one unet forward. The priors on seconds_per_unit and overhead only matter for the
+reported times, the order of the pairs follows from n_pts alone, and both are refit from observed pair times.
+"""
+import heapq
+
+import numpy as np
+
+
+class CostModel:
+    r"""Estimates the seconds a pair takes from its number of keypoints"""
+
+    def __init__(self, num_steps, num_opt_iterations, num_iterations, c_opt=2.0, c_inf=1.0, seconds_per_unit=0.05, overhead=2.0):
+        self.units_per_keypoint = num_opt_iterations * (num_steps * c_opt + num_iterations * c_inf)
+        self.seconds_per_unit = seconds_per_unit
+        self.overhead = overhead
+        self.observations = []
+
+    def estimate(self, n_pts):
+        return n_pts * self.units_per_keypoint * self.seconds_per_unit + self.overhead
+
+    def observe(self, n_pts, seconds):
+        r"""Refits the model by least squares to all pair times observed so far"""
+        self.observations.append((n_pts * self.units_per_keypoint, seconds))
+        units, times = np.array(self.observations).T
+        if len(np.unique(units)) > 1:
+            seconds_per_unit, overhead = np.polyfit(units, times, 1)
+            if seconds_per_unit > 0:
+                self.seconds_per_unit, self.overhead = seconds_per_unit, max(overhead, 0.0)
+                return
+        # a single pair size does not separate the per keypoint cost from the overhead, both are scaled alike
+        scale = times.mean() / (units.mean() * self.seconds_per_unit + self.overhead)
+        self.seconds_per_unit *= scale
+        self.overhead *= scale
+
+    def __repr__(self):
+        return f"{self.units_per_keypoint * self.seconds_per_unit:.2f} seconds per keypoint + {self.overhead:.2f} seconds per pair"
+
+
+def pair_costs(dataset, cost_model):
+    r"""Estimated seconds of every pair of a dataset"""
+    return np.array([cost_model.estimate(dataset.num_keypoints(idx)) for idx in range(len(dataset))])
+
+
+def lpt_order(costs):
+    r"""Pair indices from the most to the least expensive, handing them out in this order to whichever worker is
+    free first is the longest processing time first schedule"""
+    return [int(idx) for idx in np.argsort(-np.asarray(costs), kind="stable")]
+
+
+def locality_order(dataset):
+    r"""Pair indices grouped by category, then source image, then target image, so pairs sharing images run back to back"""
+    return sorted(range(len(dataset)), key=dataset.pair_key)
+
+
+def pair_order(dataset, order, cost_model=None):
+    r"""Dataset indices in the order given by --order, None for shuffled"""
+    if order == 'shuffle':
+        return None
+    if order == 'index':
+        return list(range(len(dataset)))
+    if order == 'locality':
+        return locality_order(dataset)
+    if order == 'cost':
+        return lpt_order(pair_costs(dataset, cost_model))
+    raise ValueError(f"order must be one of shuffle, index, locality or cost, got {order}")
+
+
+def lpt_bins(costs, num_bins):
+    r"""Splits the pairs into num_bins shards of similar total cost, for workers that cannot share a queue"""
+    bins = [[] for _ in range(num_bins)]
+    loads = [(0.0, k) for k in range(num_bins)]
+    for idx in lpt_order(costs):
+        load, k = heapq.heappop(loads)
+        bins[k].append(idx)
+        heapq.heappush(loads, (load + costs[idx], k))
+    return bins
+
+
+def index_bins(num_pairs, num_bins):
+    r"""Contiguous shards of the pair indices, as when every node takes a range of --item_index"""
+    return [[int(idx) for idx in shard] for shard in np.array_split(np.arange(num_pairs), num_bins)]
+
+
+def bins_makespan(costs, bins):
+    return max(sum(costs[idx] for idx in shard) for shard in bins)
+
+
+def queue_makespan(costs, order, num_workers):
+    r"""Makespan of handing the pairs out in order to whichever of num_workers is free first"""
+    free = [0.0] * num_workers
+    for idx in order:
+        heapq.heappush(free, heapq.heappop(free) + costs[idx])
+    return max(free)
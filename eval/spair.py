@@ -1,15 +1,180 @@
 r"""SPair-71k dataset"""
+import hashlib
 import json
-import glob
 import os
+import shutil
 
-from PIL import Image
 import numpy as np
 import torch
 
 from .dataset import CorrespondenceDataset, random_crop
 
 
+# per pair annotations kept in the index, as (column, json key)
+SCALAR_FIELDS = [('vpvar', 'viewpoint_variation'), ('scvar', 'scale_variation'),
+                 ('trncn', 'truncation'), ('occln', 'occlusion')]
+
+
+def annotation_digest(names, categories):
+    r"""Identifies the pairs and categories an index was built for"""
+    return hashlib.sha1('\n'.join(names + ['#'] + categories).encode()).hexdigest()
+
+
+def index_digest(index_path):
+    r"""The digest of the pairs an annotation index was built for, None if there is no complete index"""
+    try:
+        with open(os.path.join(index_path, 'meta.json')) as f:
+            return json.load(f)['digest']
+    except (FileNotFoundError, NotADirectoryError, ValueError, KeyError):
+        return None
+
+
+def read_annotations(ann_path, names, categories):
+    r"""Reads the annotation json of every pair into flat arrays
+
+    The key-points of all pairs are concatenated into [total key-points, 2] arrays, pair i owning rows
+    kps_offsets[i]:kps_offsets[i + 1]. Everything else is one row per pair
+    """
+    src_kps, trg_kps, offsets = [], [], [0]
+    columns = {'src_bbox': [], 'trg_bbox': [], 'cls_ids': [], **{column: [] for column, _ in SCALAR_FIELDS}}
+    for name in names:
+        with open(os.path.join(ann_path, name + '.json')) as f:
+            anntn = json.load(f)
+        assert len(anntn['src_kps']) == len(anntn['trg_kps'])
+        src_kps.extend(anntn['src_kps'])
+        trg_kps.extend(anntn['trg_kps'])
+        offsets.append(len(src_kps))
+        columns['src_bbox'].append(anntn['src_bndbox'])
+        columns['trg_bbox'].append(anntn['trg_bndbox'])
+        columns['cls_ids'].append(categories.index(anntn['category']))
+        for column, key in SCALAR_FIELDS:
+            columns[column].append(anntn[key])
+
+    arrays = {'src_kps': np.array(src_kps, dtype=np.float32).reshape(-1, 2),
+              'trg_kps': np.array(trg_kps, dtype=np.float32).reshape(-1, 2),
+              'kps_offsets': np.array(offsets, dtype=np.int64),
+              'src_bbox': np.array(columns.pop('src_bbox'), dtype=np.float32),
+              'trg_bbox': np.array(columns.pop('trg_bbox'), dtype=np.float32),
+              **{column: np.array(values, dtype=np.int64) for column, values in columns.items()}}
+    return arrays
+
+
+def build_annotation_index(ann_path, names, categories, index_path):
+    r"""Reads the annotation json of every pair once and saves the arrays of read_annotations at index_path"""
+    arrays = read_annotations(ann_path, names, categories)
+
+    # written next to the final index and moved in place, nodes building the index at once keep the first one and
+    # an index of other pairs is replaced
+    digest = annotation_digest(names, categories)
+    tmp_path = f"{index_path}.tmp-{os.getpid()}"
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        for column, array in arrays.items():
+            np.save(os.path.join(tmp_path, column + '.npy'), array)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'digest': digest, 'num_pairs': len(names)}, f)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    while True:
+        try:
+            # fails while another index is in place
+            os.rename(tmp_path, index_path)
+            return
+        except OSError:
+            if not os.path.isdir(index_path):
+                raise
+        if index_digest(index_path) == digest:
+            # published by another node, which may already be reading it
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        # an index of other pairs, moved aside in one step before it is deleted
+        stale_path = f"{index_path}.stale-{os.getpid()}"
+        try:
+            os.rename(index_path, stale_path)
+        except OSError:
+            continue
+        if index_digest(stale_path) == digest:
+            # another node replaced the stale index since it was checked, put its index back instead of ours
+            tmp_path, stale_path = stale_path, tmp_path
+        shutil.rmtree(stale_path, ignore_errors=True)
+
+
+class AnnotationIndex:
+    r"""The columns of an annotation index, memory mapped on first use
+
+    Only the path is pickled, so DataLoader workers map the files themselves instead of receiving copies
+    """
+    def __init__(self, path):
+        self.path = path
+        self._columns = {}
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            self._columns[column] = np.load(os.path.join(self.path, column + '.npy'), mmap_mode='r')
+        return self._columns[column]
+
+    def __getstate__(self):
+        return {'path': self.path, '_columns': {}}
+
+
+def load_annotation_index(ann_path, names, categories, rows, cache_dir=".cache/annotation_index", build=True):
+    r"""The annotations of the pairs names[rows] and their rows in them
+
+    The index of all names lives in cache_dir under their digest and is built first if it is missing and build
+    is set. Without an index, because it is not built or cache_dir cannot be written, only the annotations of
+    the pairs in rows are read from their json files, into memory
+    """
+    digest = annotation_digest(names, categories)
+    index_path = os.path.join(cache_dir, digest)
+    if build and index_digest(index_path) != digest:
+        print(f"building the annotation index of {len(names)} pairs in {index_path}")
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            build_annotation_index(ann_path, names, categories, index_path)
+        except OSError as e:
+            print(f"cannot write the annotation index ({e}), reading the annotations of the pairs instead")
+
+    if index_digest(index_path) == digest:
+        return AnnotationIndex(index_path), rows
+    return read_annotations(ann_path, [names[row] for row in rows], categories), list(range(len(rows)))
+
+
+class KeypointColumn:
+    r"""The [2, n_pts] key-point tensor of a pair, built from the flat index when it is accessed"""
+    def __init__(self, index, column, rows):
+        self.index = index
+        self.column = column
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def num_keypoints(self, idx):
+        offsets = self.index['kps_offsets']
+        return int(offsets[self.rows[idx] + 1] - offsets[self.rows[idx]])
+
+    def __getitem__(self, idx):
+        start = self.index['kps_offsets'][self.rows[idx]]
+        return torch.from_numpy(np.array(self.index[self.column][start:start + self.num_keypoints(idx)])).t()
+
+
+class Column:
+    r"""The tensor of a per pair annotation, built from the index when it is accessed"""
+    def __init__(self, index, column, rows):
+        self.index = index
+        self.column = column
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        return torch.tensor(self.index[self.column][self.rows[idx]])
+
+
 class SPairDataset(CorrespondenceDataset):
     r"""Inherits CorrespondenceDataset"""
     def __init__(self, benchmark, datapath, thres, device, split, augmentation, feature_size, sub_class="all", item_index=-1):
@@ -18,18 +183,18 @@ class SPairDataset(CorrespondenceDataset):
 
         self.train_data = open(self.spt_path).read().split('\n')
         self.train_data = self.train_data[:len(self.train_data) - 1]
+        all_data = self.train_data
+        # rows of the pairs in the annotation index of the whole split
+        rows = list(range(len(all_data)))
         
         if sub_class != "all":
             
-            new_data = []
-            for i in range(len(self.train_data)):
-                if sub_class in self.train_data[i]:
-                    new_data.append(self.train_data[i])
-                    
-            self.train_data = new_data
+            rows = [i for i in rows if sub_class in all_data[i]]
             
         if item_index != -1:
-            self.train_data = [self.train_data[item_index]]
+            rows = [rows[item_index]]
+
+        self.train_data = [all_data[i] for i in rows]
                     
         
         self.src_imnames = list(map(lambda x: x.split('-')[1] + '.jpg', self.train_data))
@@ -39,20 +204,23 @@ class SPairDataset(CorrespondenceDataset):
         
         # import ipdb; ipdb.set_trace()
 
-        anntn_files = []
-        for data_name in self.train_data:
-            anntn_files.append(glob.glob('%s/%s.json' % (self.ann_path, data_name))[0])
-        anntn_files = list(map(lambda x: json.load(open(x)), anntn_files)) 
-        self.src_kps = list(map(lambda x: torch.tensor(x['src_kps']).t().float(), anntn_files))
-        self.trg_kps = list(map(lambda x: torch.tensor(x['trg_kps']).t().float(), anntn_files))
-        self.src_bbox = list(map(lambda x: torch.tensor(x['src_bndbox']).float(), anntn_files))
-        self.trg_bbox = list(map(lambda x: torch.tensor(x['trg_bndbox']).float(), anntn_files))
-        self.cls_ids = list(map(lambda x: self.cls.index(x['category']), anntn_files))
-
-        self.vpvar = list(map(lambda x: torch.tensor(x['viewpoint_variation']), anntn_files))
-        self.scvar = list(map(lambda x: torch.tensor(x['scale_variation']), anntn_files))
-        self.trncn = list(map(lambda x: torch.tensor(x['truncation']), anntn_files))
-        self.occln = list(map(lambda x: torch.tensor(x['occlusion']), anntn_files))
+        # the annotations of the whole split are read from json once and memory mapped from then on,
+        # per pair tensors are only built when a pair is loaded. A run of one pair does not build the index
+        index, rows = load_annotation_index(self.ann_path, all_data, self.cls, rows, build=item_index == -1)
+        self.src_kps = KeypointColumn(index, 'src_kps', rows)
+        self.trg_kps = KeypointColumn(index, 'trg_kps', rows)
+        self.src_bbox = Column(index, 'src_bbox', rows)
+        self.trg_bbox = Column(index, 'trg_bbox', rows)
+        self.cls_ids = [int(index['cls_ids'][row]) for row in rows]
+
+        self.vpvar = Column(index, 'vpvar', rows)
+        self.scvar = Column(index, 'scvar', rows)
+        self.trncn = Column(index, 'trncn', rows)
+        self.occln = Column(index, 'occln', rows)
+
+    def num_keypoints(self, idx):
+        r"""Returns the number of key-points of a pair from the index"""
+        return self.src_kps.num_keypoints(idx)
 
     def __getitem__(self, idx):
         r"""Constructs and return a batch for SPair-71k dataset"""
@@ -76,11 +244,21 @@ class SPairDataset(CorrespondenceDataset):
 
         return batch
     
-    def collect_results(self):
+    def collect_results(self, store=None):
+        r"""The PCK at the first alpha of every saved pair, per category
+
+        from the pck_array files of runs of single pairs or, given a ResultsStore, from its pck column at once
+        """
         # create a dict to store the results
         # the keys will be each item in self.cls
         # the values will be initialized to empty lists
         results = {cls: [] for cls in self.cls}
+
+        if store is not None:
+            rows = store.rows()
+            for idx, performance in zip(rows["idx"].tolist(), rows["pck"][:, 0].tolist()):
+                results[self.train_data[idx].split(":")[-1]].append(performance)
+            return results
         
         from glob import glob
         # files = sorted(glob("spair_results/results_unflipped/*"))
@@ -105,11 +283,9 @@ class SPairDataset(CorrespondenceDataset):
             
         return results
 
-    def get_image(self, img_names, idx):
-        r"""Returns image tensor"""
-        path = os.path.join(self.img_path, self.cls[self.cls_ids[idx]], img_names[idx])
-
-        return Image.open(path).convert('RGB')
+    def image_key(self, img_names, idx):
+        r"""Images are stored per category"""
+        return os.path.join(self.cls[self.cls_ids[idx]], img_names[idx])
 
     def get_bbox(self, bbox_list, idx, imsize):
         r"""Returns object bounding-box"""
@@ -0,0 +1,125 @@
+r"""PCK of saved results at any thresholds, without rerunning the model
+
+Every correspondence_data_*.pt under --results_loc (as validate_epoch and retest save them) is loaded once and
+the predictions of all pairs are padded into [pairs, 2, keypoints] arrays, so the PCK of the estimates, of every
+layer alone and (for ablated retests) of the first restarts is computed at every alpha in a single pass.
+
+    python -m eval.summarize --results_loc outputs --alphas 0.01 0.05 0.1 0.15
+
+With --metrics the metrics snapshots flushed during the runs (a metrics_<node>.json per node of a lease queue)
+are merged instead, giving the PCK per category, difficulty bucket and layer at the alphas of the run.
+
+    python -m eval.summarize --results_loc outputs --metrics
+
+Retests flush their snapshots to retest_metrics*.json, which --metrics --retest merges instead.
+
+With --results_store the pairs of a results store are summarized instead, its key-point columns are memory mapped
+rather than unpickled pair by pair.
+
+    python -m eval.summarize --results_store outputs/store --alphas 0.05 0.1
+"""
+import argparse
+from glob import glob
+
+import numpy as np
+import torch
+
+from utils.evaluation import Evaluator
+from utils.metrics import StreamingPCK
+from utils.results_store import ResultsStore
+
+
+def pad_keypoints(kps, num_kps):
+    r"""Pads [..., 2, P] key-points with -1 to [..., 2, num_kps]"""
+    padding = -torch.ones(*kps.shape[:-1], num_kps - kps.shape[-1], dtype=kps.dtype)
+    return torch.cat([kps, padding], dim=-1)
+
+
+def load_results(files):
+    r"""Stacks the key-points of saved results into padded tensors
+
+    returns a dict of est_keypoints and trg_kps [N, 2, P], pckthres and n_pts [N] and, if every result has
+    them, ind_layers and ind_opt_iterations [L, N, 2, P]
+    """
+    results = [torch.load(file, map_location="cpu") for file in files]
+    missing = [file for file, result in zip(files, results) if 'pckthres' not in result]
+    if missing:
+        raise ValueError(f"{len(missing)} results were saved without pckthres and n_pts, e.g. {missing[0]}, retest them to summarize")
+
+    num_kps = max(result['trg_kps'].shape[-1] for result in results)
+
+    def stack(key):
+        # the key-points of a single pair, saved with or without its batch dimension
+        return torch.stack([pad_keypoints(result[key].reshape(2, -1), num_kps) for result in results])
+
+    summary = {"est_keypoints": stack('est_keypoints'), "trg_kps": stack('trg_kps'),
+               "pckthres": torch.stack([torch.as_tensor(result['pckthres']).reshape(-1)[0] for result in results]),
+               "n_pts": torch.stack([torch.as_tensor(result['n_pts']).reshape(-1)[0] for result in results])}
+    for key in ['ind_layers', 'ind_opt_iterations']:
+        if all(key in result for result in results):
+            summary[key] = torch.stack([pad_keypoints(result[key], num_kps) for result in results], dim=1)
+    return summary
+
+
+def load_store(store):
+    r"""Stacks the key-points of the pairs in a ResultsStore into padded tensors, as load_results"""
+    pairs = store.pairs()
+    rows = store.rows(pairs)
+    num_kps = int(rows['num_kps'].max())
+    keypoints = [pad_keypoints(store.keypoints(pair), num_kps) for pair in pairs]
+    summary = {"est_keypoints": torch.stack([kps[2] for kps in keypoints]), "trg_kps": torch.stack([kps[1] for kps in keypoints]),
+               "pckthres": torch.from_numpy(rows['pckthres'].astype(np.float32)), "n_pts": torch.from_numpy(rows['n_pts'].astype(np.int64))}
+    num_layers = rows['num_layers'].tolist()
+    if len(set(num_layers)) == 1 and num_layers[0] > 0:
+        summary['ind_layers'] = torch.stack([kps[3:3 + num_layers[0]] for kps in keypoints], dim=1)
+    num_restarts = rows['num_restarts'].tolist()
+    if len(set(num_layers)) == 1 and len(set(num_restarts)) == 1 and num_restarts[0] > 0:
+        summary['ind_opt_iterations'] = torch.stack([kps[3 + num_layers[0]:] for kps in keypoints], dim=1)
+    return summary
+
+
+def summarize(results, alphas):
+    r"""Mean PCK over the pairs at every alpha of the estimates and of every variant in results, {name: [len(alphas)]}"""
+    pck = {"estimate": Evaluator.pck(results['est_keypoints'], results['trg_kps'], results['pckthres'], results['n_pts'], alphas).mean(dim=0)}
+    for key, name in [('ind_layers', 'layer'), ('ind_opt_iterations', 'restarts')]:
+        if key in results:
+            variants = Evaluator.pck(results[key], results['trg_kps'], results['pckthres'], results['n_pts'], alphas).mean(dim=1)
+            for k, variant in enumerate(variants):
+                pck[f"{name} {k + 1 if name == 'restarts' else k}"] = variant
+    return pck
+
+
+def merge_metrics(files):
+    r"""Merges the StreamingPCK snapshots in files"""
+    metrics = StreamingPCK.load(files[0])
+    for file in files[1:]:
+        metrics.merge(StreamingPCK.load(file))
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarizes the PCK of saved results at any thresholds')
+    parser.add_argument('--results_loc', type=str, default='outputs', help='directory searched recursively for correspondence_data_*.pt')
+    parser.add_argument('--alphas', type=float, nargs='+', default=list(Evaluator.alphas))
+    parser.add_argument('--metrics', action='store_true', help='merge the metrics snapshots of the runs instead of loading every result')
+    parser.add_argument('--retest', action='store_true', help='with --metrics, merge the snapshots of retests instead of optimization runs')
+    parser.add_argument('--results_store', type=str, default=None, help='summarize the pairs of this results store instead')
+    args = parser.parse_args()
+
+    if args.metrics:
+        files = sorted(glob(f"{args.results_loc}/**/{'retest_' if args.retest else ''}metrics*.json", recursive=True))
+        metrics = merge_metrics(files)
+        print(f"{len(files)} snapshots, {metrics.count()} pairs")
+        print("group".ljust(20) + "pairs".rjust(7) + "".join(f"{alpha:>9}" for alpha in metrics.alphas))
+        for group in metrics.groups():
+            print(group.ljust(20) + f"{metrics.count(group):7d}" + "".join(f"{value:9.2f}" for value in metrics.mean(group)))
+    else:
+        if args.results_store is not None:
+            results = load_store(ResultsStore(args.results_store))
+        else:
+            files = sorted(glob(f"{args.results_loc}/**/correspondence_data_*.pt", recursive=True))
+            results = load_results(files)
+        print(f"{len(results['n_pts'])} pairs, {int(results['n_pts'].sum())} keypoints")
+        print("alpha".ljust(12) + "".join(f"{alpha:>9}" for alpha in args.alphas))
+        for name, pck in summarize(results, args.alphas).items():
+            print(name.ljust(12) + "".join(f"{value:9.2f}" for value in pck.tolist()))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# utils and eval are imported from the repository root, as eval.eval runs them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
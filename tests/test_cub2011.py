@@ -0,0 +1,47 @@
+import itertools
+import os
+
+import pytest
+
+from eval.cub2011 import CUBDataset
+
+
+@pytest.fixture
+def cub_dir(tmp_path):
+    # images of classes 1 to 4 alternating between the splits, out of class order
+    labels = [2, 1, 3, 1, 2, 4, 1, 3, 2, 1, 1, 2, 3, 1, 2, 2]
+    root = tmp_path / "CUB_200_2011"
+    os.makedirs(root / "parts")
+    with open(root / "images.txt", "w") as f:
+        f.writelines(f"{i + 1} {label:03d}/image_{i}.jpg\n" for i, label in enumerate(labels))
+    with open(root / "train_test_split.txt", "w") as f:
+        f.writelines(f"{i + 1} {i % 3 == 0:d}\n" for i in range(len(labels)))
+    with open(root / "image_class_labels.txt", "w") as f:
+        f.writelines(f"{i + 1} {label}\n" for i, label in enumerate(labels))
+    with open(root / "parts" / "part_locs.txt", "w") as f:
+        f.writelines(f"{i + 1} {part + 1} 10 20 1\n" for i in range(len(labels)) for part in range(CUBDataset.NUM_PARTS))
+    with open(root / "bounding_boxes.txt", "w") as f:
+        f.writelines(f"{i + 1} 0 0 100 100\n" for i in range(len(labels)))
+    return str(tmp_path), labels
+
+
+def test_pairs_follow_combinations(cub_dir):
+    datapath, labels = cub_dir
+    dataset = CUBDataset(datapath, split="test", num_classes=3)
+
+    # the test split is every image not in train, pairs of a class in image order, classes in order
+    test_images = [i for i in range(len(labels)) if i % 3 != 0 and labels[i] <= 3]
+    expected = [pair for label in range(1, 4)
+                for pair in itertools.combinations([i for i in test_images if labels[i] == label], 2)]
+
+    assert len(dataset) == len(expected)
+    assert [dataset.pair(idx) for idx in range(len(dataset))] == expected
+    with pytest.raises(IndexError):
+        dataset.pair(len(dataset))
+
+
+def test_item_index_selects_one_pair(cub_dir):
+    datapath, _ = cub_dir
+    dataset = CUBDataset(datapath, split="test", num_classes=3)
+    single = CUBDataset(datapath, split="test", num_classes=3, item_index=4)
+    assert len(single) == 1 and single.pair(0) == dataset.pair(4)
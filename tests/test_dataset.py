@@ -0,0 +1,23 @@
+import pytest
+import torch
+
+pytest.importorskip("torchvision")
+
+from eval.dataset import find_knn
+
+
+def brute_force_knn(db_vectors, qr_vectors, k):
+    dist = (qr_vectors[:, None] - db_vectors[None]).pow(2).sum(dim=-1)
+    return dist.topk(k, dim=1, largest=False, sorted=True).indices
+
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_find_knn_matches_brute_force(k):
+    generator = torch.Generator().manual_seed(0)
+    db_vectors = torch.rand(300, 16, generator=generator)
+    qr_vectors = torch.rand(200, 16, generator=generator)
+
+    # chunks smaller than both sets, with a partial last chunk
+    nearest = find_knn(db_vectors, qr_vectors, k=k, chunk_size=64)
+    expected = brute_force_knn(db_vectors, qr_vectors, k)
+    assert torch.equal(nearest, expected[:, 0] if k == 1 else expected)
@@ -0,0 +1,64 @@
+import pytest
+import torch
+
+from utils.evaluation import Evaluator
+
+
+def test_pck_matches_classify_prd():
+    generator = torch.Generator().manual_seed(0)
+    trg_kps = torch.rand(16, 2, 9, generator=generator) * 512
+    prd_kps = trg_kps + torch.randn(16, 2, 9, generator=generator) * 40
+    pckthres = torch.rand(16, generator=generator) * 300 + 50
+    n_pts = torch.randint(1, 10, (16,), generator=generator)
+    alphas = [0.05, 0.1, 0.15]
+
+    pck = Evaluator.pck(prd_kps, trg_kps, pckthres, n_pts, alphas)
+    for n in range(16):
+        for a, alpha in enumerate(alphas):
+            correct_dist, _, _ = Evaluator.classify_prd(prd_kps[n, :, :n_pts[n]], trg_kps[n, :, :n_pts[n]], pckthres[n], alpha)
+            assert pck[n, a].item() == pytest.approx(len(correct_dist) / n_pts[n].item() * 100)
+
+
+def skimage_masks(polygons, n_pts, out_h, out_w):
+    draw = pytest.importorskip("skimage.draw")
+    masks = torch.zeros(len(polygons), 1, out_h, out_w)
+    for n, (polygon, num) in enumerate(zip(polygons, n_pts)):
+        rr, cc = draw.polygon(polygon[1, :num].double().numpy(), polygon[0, :num].double().numpy(), shape=(out_h, out_w))
+        masks[n, 0, rr, cc] = 1
+    return masks
+
+
+def assert_same_masks(polygons, n_pts, out_h=40, out_w=48):
+    n_pts = torch.as_tensor(n_pts)
+    masks = Evaluator.polygon_masks(polygons, n_pts, out_h, out_w)
+    expected = skimage_masks(polygons, n_pts, out_h, out_w)
+    mismatches = (masks != expected).flatten(1).sum(dim=1)
+    assert mismatches.sum() == 0, f"masks of polygons {mismatches.nonzero().flatten().tolist()} differ from skimage"
+
+
+def test_polygon_masks_random():
+    generator = torch.Generator().manual_seed(0)
+    polygons = torch.rand(64, 2, 7, generator=generator) * torch.tensor([56.0, 48.0])[:, None] - 4
+    n_pts = torch.randint(3, 8, (64,), generator=generator)
+    assert_same_masks(polygons, n_pts)
+
+
+def test_polygon_masks_vertices_on_pixel_centres():
+    # integer vertices put vertices and whole edges on pixel centres
+    generator = torch.Generator().manual_seed(1)
+    polygons = torch.randint(-3, 50, (64, 2, 6), generator=generator).float()
+    n_pts = torch.randint(3, 7, (64,), generator=generator)
+    assert_same_masks(polygons, n_pts)
+
+
+def test_polygon_masks_degenerate():
+    polygons = torch.tensor([
+        [[2, 30, 30, 2], [5, 5, 20, 20]],            # axis aligned rectangle, horizontal edges on pixel rows
+        [[5, 25, 15, 15], [10, 10, 30, 10]],         # repeated vertex
+        [[-10, 60, 60, -10], [-5, -5, 50, 50]],      # clipped at every border
+        [[3, 20, 37, 37], [3, 20, 3, 3]],            # diagonal edges through pixel centres, padded
+        [[10, 20, 30, 30], [10, 10, 10, 10]],        # zero area, a horizontal segment
+        [[7.5, 20.5, 20.5, 7.5], [4.5, 4.5, 9.5, 9.5]],  # edges between pixel centres
+    ], dtype=torch.float32)
+    assert_same_masks(polygons, [4, 4, 4, 3, 3, 4])
+
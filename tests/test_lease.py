@@ -0,0 +1,49 @@
+import os
+import time
+
+from eval.lease import LeaseQueue
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_live_lease_is_not_claimed(tmp_path):
+    first = LeaseQueue(str(tmp_path / "leases"), str(tmp_path), ttl=60)
+    second = LeaseQueue(str(tmp_path / "leases"), str(tmp_path), ttl=60)
+    assert first.claim(0) is not None
+    assert second.claim(0) is None
+    first.release(0)
+    assert second.claim(0) is not None
+    second.release(0)
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    first = LeaseQueue(str(tmp_path / "leases"), str(tmp_path), ttl=60)
+    second = LeaseQueue(str(tmp_path / "leases"), str(tmp_path), ttl=60)
+    lease = first.claim(0)
+
+    # not touched for less than ttl, the node is alive
+    age(first.lease_path(0), 30)
+    assert second.claim(0) is None
+
+    # not touched for more than ttl, its node died
+    age(first.lease_path(0), 90)
+    assert second.claim(0) is not None
+    assert second.reclaimed == 1
+    assert not lease.owned()
+    assert sorted(os.listdir(tmp_path / "leases")) == ["000000.lease"]
+
+    # releasing the lost lease leaves the new owner's lease in place
+    lease.release()
+    assert os.path.exists(second.lease_path(0))
+    second.release(0)
+    assert not os.path.exists(second.lease_path(0))
+
+
+def test_done_pairs_are_not_claimed(tmp_path):
+    queue = LeaseQueue(str(tmp_path / "leases"), str(tmp_path), ttl=60)
+    open(tmp_path / "correspondence_data_001.pt", "w").close()
+    assert queue.claim(1) is None
+    assert not os.path.exists(queue.lease_path(1))
@@ -0,0 +1,59 @@
+import pickle
+
+import pytest
+import torch
+
+from utils.results_store import ResultsStore
+
+
+def make_result(idx, num_kps=5, num_layers=3, seed=0, category="cat"):
+    generator = torch.Generator().manual_seed(seed)
+    return {"est_keypoints": torch.rand(1, 2, num_kps, generator=generator) * 512,
+            "src_kps": torch.rand(1, 2, num_kps, generator=generator) * 512,
+            "trg_kps": torch.rand(1, 2, num_kps, generator=generator) * 512,
+            "ind_layers": torch.rand(num_layers, 2, num_kps, generator=generator) * 512,
+            "contexts": torch.randn(num_kps, 2, 1, 4, 8, generator=generator),
+            "pck": [float(seed), 50.0], "pckthres": torch.tensor([200.0]), "n_pts": torch.tensor([num_kps - 1]),
+            "idx": torch.tensor([idx]), "groups": ["all", f"category/{category}", "vpvar/1", "scvar/0", "trncn/2", "occln/0"]}
+
+
+def test_round_trip(tmp_path):
+    store = ResultsStore(str(tmp_path), owner="a")
+    results = {pair: make_result(pair + 10, seed=pair, category="dog" if pair % 2 else "cat") for pair in range(4)}
+    for pair, result in results.items():
+        store.append(pair, result, seconds=pair + 0.5)
+    store.close()
+
+    # a reader in another process only sees the files
+    reader = pickle.loads(pickle.dumps(ResultsStore(str(tmp_path))))
+    assert reader.pairs() == [0, 1, 2, 3]
+    assert reader.categories() == ["cat", "dog"]
+    assert reader.category_pairs("dog") == [1, 3]
+    for pair, result in results.items():
+        stored = reader.result(pair)
+        for key in ["est_keypoints", "src_kps", "trg_kps", "ind_layers", "idx", "pckthres", "n_pts"]:
+            assert torch.equal(stored[key], result[key]), key
+        # contexts are stored in half precision
+        assert torch.allclose(stored["contexts"], result["contexts"], atol=1e-2)
+        assert stored["pck"] == result["pck"]
+        assert stored["groups"] == result["groups"]
+        assert stored["seconds"] == pytest.approx(pair + 0.5)
+    assert reader.pck(alpha=0.05) == pytest.approx(1.5)
+
+
+def test_last_written_row_wins(tmp_path):
+    # shard names sort the other way round than the writes
+    late = ResultsStore(str(tmp_path), owner="a")
+    early = ResultsStore(str(tmp_path), owner="z")
+    early.append(0, make_result(0, seed=1))
+    late.append(0, make_result(0, seed=2))
+    early.append(1, make_result(1, seed=3))
+    early.append(1, make_result(1, seed=4))
+    late.close()
+    early.close()
+
+    for store in [ResultsStore(str(tmp_path)), late, early]:
+        store.refresh()
+        assert store.pairs() == [0, 1]
+        assert store.result(0)["pck"][0] == 2.0
+        assert store.result(1)["pck"][0] == 4.0
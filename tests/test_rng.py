@@ -0,0 +1,44 @@
+import torch
+
+from utils import rng as rng_utils
+from utils.optimize_token import prepare_crops
+from utils.rng import RandomStream
+
+
+def streams(pairs, seed=3, keypoint=1, restart=0):
+    return [RandomStream(seed, pair, keypoint, restart) for pair in pairs]
+
+
+def test_draws_depend_on_their_key_only():
+    rng = RandomStream(3, 7, 1, 0)
+    first = rng_utils.uniform(rng, "flip", 4)
+    # draws of other stages and steps in between do not change it
+    rng_utils.uniform(rng, "flip", 5)
+    rng_utils.rand_like(rng, torch.zeros(2, 3), "noise", 4)
+    assert rng_utils.uniform(RandomStream(3, 7, 1, 0), "flip", 4) == first
+    assert rng_utils.uniform(RandomStream(3, 8, 1, 0), "flip", 4) != first
+
+
+def test_noise_does_not_depend_on_the_batch():
+    pairs = [4, 9, 2, 11]
+    latents = torch.zeros(len(pairs), 4, 8, 8)
+    batched = rng_utils.rand_like_each(streams(pairs), latents, "noise", 2)
+    for batch_size in [1, 2, 3]:
+        for start in range(0, len(pairs), batch_size):
+            chunk = pairs[start:start + batch_size]
+            noise = rng_utils.rand_like_each(streams(chunk), latents[:len(chunk)], "noise", 2)
+            assert torch.equal(noise, batched[start:start + batch_size])
+
+
+def test_crops_do_not_depend_on_the_batch():
+    generator = torch.Generator().manual_seed(0)
+    pairs = [4, 9, 2]
+    images = torch.rand(len(pairs), 3, 512, 512, generator=generator)
+    pixel_locs = [torch.rand(2, generator=generator) for _ in pairs]
+    for step in range(8):
+        crops, cropped_pixels = prepare_crops(images, pixel_locs, crop_percent=80, flip_prob=0.5, rngs=streams(pairs), step=step)
+        for b, pair in enumerate(pairs):
+            crop, cropped_pixel = prepare_crops(images[b:b + 1], pixel_locs[b:b + 1], crop_percent=80, flip_prob=0.5,
+                                                rngs=streams([pair]), step=step)
+            assert torch.equal(crop[0], crops[b])
+            assert torch.equal(cropped_pixel[0], cropped_pixels[b])
@@ -0,0 +1,291 @@
+"""Registry of the diffusion models correspondences can be computed with
+
+every backend describes where its weights come from, the DDIM scheduler it was trained with and the
+layout of the cross attention layers AttentionStore keeps (those with at most 32x32 tokens), in the
+order upscale_to_img_size numbers them: all down layers, then mid, then up.
+"""
+
+import inspect
+import json
+import os
+
+import torch
+
+
+SD_SCHEDULER = dict(
+    beta_start=0.00085,
+    beta_end=0.012,
+    beta_schedule="scaled_linear",
+    clip_sample=False,
+    set_alpha_to_one=False,
+)
+
+# layout of stable diffusion 1.x for 512x512 images (64x64 latents)
+SD1_CROSS_ATTENTION_LAYERS = [
+    ("down", 32), ("down", 32), ("down", 16), ("down", 16),
+    ("mid", 8),
+    ("up", 16), ("up", 16), ("up", 16), ("up", 32), ("up", 32), ("up", 32),
+]
+
+
+class ModelBackend:
+    def __init__(
+        self,
+        name,
+        pretrained,
+        heads,
+        cross_attention_layers,
+        default_layers,
+        context_dim=768,
+        latent_size=64,
+        scheduler=SD_SCHEDULER,
+        unet_config=None,
+        vae_config=None,
+    ):
+        """
+        Args:
+            pretrained: hugging face id or local path of the diffusers weights, None builds randomly initialized
+                models from unet_config and vae_config
+            heads: number of attention heads of the cross attention layers
+            cross_attention_layers: (place in unet, resolution) of every stored cross attention layer
+            default_layers: indices into cross_attention_layers used when none are given
+        """
+        self.name = name
+        self.pretrained = pretrained
+        self.heads = heads
+        self.cross_attention_layers = cross_attention_layers
+        self.default_layers = default_layers
+        self.context_dim = context_dim
+        self.latent_size = latent_size
+        self.scheduler = scheduler
+        self.unet_config = unet_config
+        self.vae_config = vae_config
+
+    @property
+    def captured_heads(self):
+        # AttentionControl keeps the second half of the attention heads (the conditional half under cfg)
+        return self.heads // 2
+
+    @property
+    def layer_names(self):
+        return [f"{place}_{res}x{res}" for place, res in self.cross_attention_layers]
+
+    def check_layers(self, layers):
+        for layer in layers:
+            if not 0 <= layer < len(self.cross_attention_layers):
+                raise ValueError(f"{self.name} has {len(self.cross_attention_layers)} cross attention layers, got layer {layer}")
+
+    def check_unet(self, unet):
+        """raises if the unet does not have the cross attention layout this backend describes"""
+        heads, layers = attention_layout(unet, self.latent_size)
+        if layers != self.cross_attention_layers or heads != self.heads:
+            raise ValueError(
+                f"the unet of {self.name} has {heads} heads and cross attention layers {layers}, "
+                f"expected {self.heads} heads and {self.cross_attention_layers}"
+            )
+
+    @classmethod
+    def from_unet(cls, name, unet, latent_size=64):
+        """describes a model that is not in the registry by walking its unet"""
+        heads, layers = attention_layout(unet, latent_size)
+        return cls(name, name, heads, layers, default_layers=list(range(len(layers))), latent_size=latent_size)
+
+
+def attention_layout(unet, latent_size=64):
+    """returns the number of heads and the (place, resolution) of the stored cross attention layers of a unet"""
+    blocks = [("down", block, latent_size // 2**i) for i, block in enumerate(unet.down_blocks)]
+    if getattr(unet, "mid_block", None) is not None:
+        blocks.append(("mid", unet.mid_block, latent_size // 2 ** (len(unet.down_blocks) - 1)))
+    num_up = len(unet.up_blocks)
+    blocks += [("up", block, latent_size // 2 ** (num_up - 1 - i)) for i, block in enumerate(unet.up_blocks)]
+
+    heads = set()
+    layers = []
+    for place, block, res in blocks:
+        for name, module in block.named_modules():
+            if name.endswith("attn2"):
+                heads.add(module.heads)
+                if res**2 <= 32**2:
+                    layers.append((place, res))
+
+    if len(heads) > 1:
+        raise ValueError(f"cross attention layers with differing head counts {heads} are not supported")
+    return heads.pop() if heads else 0, layers
+
+
+class DiffusionModel:
+    """the parts of a StableDiffusionPipeline the correspondence code uses"""
+
+    def __init__(self, unet, vae, scheduler):
+        self.unet = unet
+        self.vae = vae
+        self.scheduler = scheduler
+
+    def to(self, device):
+        self.unet.to(device)
+        self.vae.to(device)
+        return self
+
+    @property
+    def device(self):
+        return next(self.unet.parameters()).device
+
+
+BACKENDS = {
+    "sd-v1-4": ModelBackend(
+        "sd-v1-4",
+        "CompVis/stable-diffusion-v1-4",
+        heads=8,
+        cross_attention_layers=SD1_CROSS_ATTENTION_LAYERS,
+        default_layers=[5, 6, 7, 8],
+    ),
+    "sd-v1-5": ModelBackend(
+        "sd-v1-5",
+        "runwayml/stable-diffusion-v1-5",
+        heads=8,
+        cross_attention_layers=SD1_CROSS_ATTENTION_LAYERS,
+        default_layers=[5, 6, 7, 8],
+    ),
+    # block removed knowledge distilled stable diffusion, one block pair per down stage, two per up stage and
+    # no mid block (needs a diffusers version that supports mid_block_type=None)
+    "bk-sdm-small": ModelBackend(
+        "bk-sdm-small",
+        "nota-ai/bk-sdm-small",
+        heads=8,
+        cross_attention_layers=[("down", 32), ("down", 16), ("up", 16), ("up", 16), ("up", 32), ("up", 32)],
+        default_layers=[2, 3, 4],
+    ),
+    # randomly initialized, for benchmarking the pipeline without downloading weights
+    "tiny-random": ModelBackend(
+        "tiny-random",
+        None,
+        heads=8,
+        cross_attention_layers=[("down", 32), ("mid", 16), ("up", 32), ("up", 32)],
+        default_layers=[1, 2, 3],
+        unet_config=dict(
+            sample_size=64,
+            in_channels=4,
+            out_channels=4,
+            layers_per_block=1,
+            block_out_channels=(32, 64, 64),
+            down_block_types=("CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "DownBlock2D"),
+            up_block_types=("UpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D"),
+            cross_attention_dim=768,
+            attention_head_dim=8,
+            norm_num_groups=16,
+        ),
+        vae_config=dict(
+            in_channels=3,
+            out_channels=3,
+            down_block_types=("DownEncoderBlock2D",) * 4,
+            up_block_types=("UpDecoderBlock2D",) * 4,
+            block_out_channels=(16, 16, 32, 32),
+            latent_channels=4,
+            norm_num_groups=8,
+        ),
+    ),
+}
+
+
+def get_backend(type):
+    """looks a backend up by its registry name or its pretrained weights, None if it is not registered"""
+    if type in BACKENDS:
+        return BACKENDS[type]
+    for backend in BACKENDS.values():
+        if backend.pretrained is not None and backend.pretrained == type:
+            return backend
+    return None
+
+
+def model_backend(ldm):
+    """the backend a model was loaded with, models loaded without one are stable diffusion 1.4"""
+    return getattr(ldm, "backend", BACKENDS["sd-v1-4"])
+
+
+def build_random(backend, seed=0):
+    """builds randomly initialized models from the configs of a backend"""
+    from diffusers import UNet2DConditionModel, AutoencoderKL
+
+    generator_state = torch.random.get_rng_state()
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(**backend.unet_config)
+    vae = AutoencoderKL(**backend.vae_config)
+    torch.random.set_rng_state(generator_state)
+    return unet, vae
+
+
+def snapshot_path(pretrained):
+    """local diffusers snapshot holding the unet and vae weights, only those subfolders are fetched for hub ids"""
+    if os.path.isdir(pretrained):
+        return pretrained
+
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(pretrained, allow_patterns=["unet/*.json", "unet/*.safetensors", "vae/*.json", "vae/*.safetensors"])
+
+
+def load_component(cls, folder, device, dtype, prefixes=None):
+    """instantiates a diffusers model from its config and memory maps its safetensors weights into it
+
+    the model is built without initializing its weights when accelerate is available, and only the
+    weights starting with one of prefixes are read
+    """
+    from safetensors import safe_open
+
+    weights = os.path.join(folder, "diffusion_pytorch_model.safetensors")
+    if not os.path.exists(weights):
+        raise FileNotFoundError(f"lean loading needs safetensors weights, {weights} does not exist")
+
+    with open(os.path.join(folder, "config.json")) as f:
+        config = json.load(f)
+    # configs written by other diffusers versions can have arguments this version does not know
+    arguments = inspect.signature(cls.__init__).parameters
+    config = {key: value for key, value in config.items() if key in arguments}
+
+    try:
+        from accelerate import init_empty_weights
+        from accelerate.utils import set_module_tensor_to_device
+    except ImportError:
+        init_empty_weights = None
+
+    if init_empty_weights is None:
+        model = cls(**config)
+    else:
+        with init_empty_weights():
+            model = cls(**config)
+
+    state_dict = {}
+    with safe_open(weights, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            if prefixes is None or key.startswith(tuple(prefixes)):
+                state_dict[key] = f.get_tensor(key)
+
+    if init_empty_weights is None:
+        model.load_state_dict(state_dict, strict=prefixes is None)
+    else:
+        for key, value in state_dict.items():
+            set_module_tensor_to_device(model, key, device, value=value.to(dtype))
+
+    if prefixes is not None:
+        # submodules whose weights were not read are dropped
+        kept = {prefix.split(".")[0] for prefix in prefixes}
+        for name, _ in list(model.named_children()):
+            if name not in kept:
+                setattr(model, name, None)
+
+    return model.to(device, dtype=dtype)
+
+
+def load_lean(pretrained, device, dtype, scheduler):
+    """loads only the unet and the vae encoder, without the text encoder, tokenizer or safety checker
+
+    contexts are optimized from init_random_noise so the correspondence code never needs the text encoder
+    """
+    from diffusers import UNet2DConditionModel, AutoencoderKL
+
+    path = snapshot_path(pretrained)
+    unet = load_component(UNet2DConditionModel, os.path.join(path, "unet"), device, dtype)
+    # image2latent only encodes, so the decoder is never loaded
+    vae = load_component(AutoencoderKL, os.path.join(path, "vae"), device, dtype, prefixes=["encoder.", "quant_conv."])
+
+    return DiffusionModel(unet, vae, scheduler)
@@ -0,0 +1,139 @@
+"""Graph captured unet that returns the cross attention maps as outputs
+
+register_attention_control records the attention maps by appending them to a controller from a
+monkeypatched python forward, which hides them from torch.jit.trace and torch.compile. CapturingUNet
+collects the maps of one call and returns them next to the noise prediction, so the whole unet call
+including the attention capture becomes one graph.
+"""
+
+import hashlib
+import os
+import time
+
+import torch
+
+from utils import ptp_utils
+from utils.optimize_token import AttentionRecorder
+
+
+COMPILE_MODES = ["none", "trace", "inductor"]
+
+
+class CapturingUNet(torch.nn.Module):
+    def __init__(self, unet):
+        super(CapturingUNet, self).__init__()
+        self.unet = unet
+        self.controller = AttentionRecorder()
+        # register_attention_control patches the attention layers of model.unet
+        ptp_utils.register_attention_control(self, self.controller)
+
+    def forward(self, latents, t, context):
+        self.controller.reset()
+        self.controller.batch_size = latents.shape[0]
+        noise_pred = self.unet(latents, t, encoder_hidden_states=context, return_dict=False)[0]
+        return (noise_pred,) + tuple(self.controller.maps)
+
+
+def unet_fingerprint(unet, num_checksums=8):
+    """the module types of a unet and a cheap digest of its weights, so differently quantized or trained unets get different cache keys
+
+    dynamically quantized unets (see quantize_unet) keep the config and the float32 parameters of the fp32 unet, their
+    int8 weights are packed outside parameters(), so only the types of their linear layers tell them apart
+    """
+    types = sorted({f"{type(module).__module__}.{type(module).__name__}" for module in unet.modules()})
+    state = unet.state_dict()
+    digest = hashlib.sha1("_".join(types).encode())
+    for key, value in state.items():
+        digest.update(f"{key}:{getattr(value, 'dtype', type(value).__name__)}".encode())
+    tensors = [value for value in state.values() if isinstance(value, torch.Tensor) and value.is_floating_point()]
+    for value in tensors[:: max(1, len(tensors) // num_checksums)]:
+        digest.update(f"{value.detach().double().sum().item():.6e}".encode())
+    return digest.hexdigest()
+
+
+class UNetCompiler:
+    """compiles a CapturingUNet per unet and input shape on first use
+
+    trace: torch.jit.trace, the traced module (weights included) is saved to cache_dir and loaded on later runs
+    inductor: torch.compile, compiled kernels are cached in cache_dir by inductor's fx graph cache
+    """
+
+    def __init__(self, mode="trace", cache_dir=".cache/unet"):
+        if mode not in COMPILE_MODES[1:]:
+            raise ValueError(f"mode must be one of {COMPILE_MODES[1:]}, got {mode}")
+        if mode == "inductor" and not hasattr(torch, "compile"):
+            raise ValueError("torch.compile requires torch>=2.0, use mode='trace' instead")
+
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.modules = {}
+        self.compile_seconds = 0.0
+        self.loaded_from_cache = False
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            if mode == "inductor":
+                os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+                import torch._inductor.config
+
+                torch._inductor.config.fx_graph_cache = True
+
+    def __call__(self, unet, latents, t, context):
+        """returns the place keys and the cross attention maps of one unet call"""
+        key = (id(unet), tuple(latents.shape), tuple(context.shape), latents.device.type)
+        if key not in self.modules:
+            start = time.time()
+            self.modules[key] = self.compile(unet, latents, t, context)
+            self.compile_seconds += time.time() - start
+
+        module, keys = self.modules[key]
+        outputs = module(latents, t, context)
+        return keys, outputs[1:]
+
+    def cache_path(self, unet, latents, context):
+        config = getattr(unet, "config", {})
+        signature = "_".join(
+            [
+                str(config.get("_name_or_path", "")),
+                str(dict(config)),
+                type(unet).__name__,
+                str(next(unet.parameters()).dtype),
+                unet_fingerprint(unet),
+                str(tuple(latents.shape)),
+                str(tuple(context.shape)),
+                latents.device.type,
+                torch.__version__,
+            ]
+        )
+        digest = hashlib.sha1(signature.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"unet_{digest}.pt")
+
+    def compile(self, unet, latents, t, context):
+        wrapper = CapturingUNet(unet)
+
+        # an eager call records which part of the unet every returned map comes from
+        with torch.no_grad():
+            wrapper(latents, t, context)
+        keys = list(wrapper.controller.keys)
+
+        if self.mode == "inductor":
+            return torch.compile(wrapper), keys
+
+        path = None if self.cache_dir is None else self.cache_path(unet, latents, context)
+        if path is not None and os.path.exists(path):
+            self.loaded_from_cache = True
+            return torch.jit.load(path, map_location=latents.device), keys
+
+        traced = torch.jit.trace(wrapper, (latents.detach(), t, context.detach()), check_trace=False, strict=False)
+        if path is not None:
+            torch.jit.save(traced, path)
+        return traced, keys
+
+
+def compile_unet(ldm, mode="trace", cache_dir=".cache/unet"):
+    """makes run_unet use a compiled unet that returns its attention maps as graph outputs"""
+    if mode == "none":
+        ldm.unet_compiler = None
+    else:
+        ldm.unet_compiler = UNetCompiler(mode, cache_dir)
+    return ldm
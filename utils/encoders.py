@@ -0,0 +1,108 @@
+"""Image encoders used by image2latent to map image crops to unet latents
+
+every backend takes images of shape (batch, 3, height, width) in [-1, 1] and returns fp32 latents scaled
+like the stable diffusion vae latents (i.e. already multiplied by 0.18215). keys optionally identify every
+image of the batch, only the cached backend uses them
+"""
+
+import hashlib
+
+import torch
+
+from utils.cache import LRUCache
+
+
+class VAEEncoder:
+    """the stable diffusion vae encoder, the reference every other backend is checked against"""
+
+    def __init__(self, ldm):
+        self.vae = ldm.vae
+
+    def encode(self, image, keys=None):
+        param = next(self.vae.parameters())
+        latents = self.vae.encode(image.to(device=param.device, dtype=param.dtype))["latent_dist"].mean.float()
+        return latents * 0.18215
+
+
+class TinyEncoder:
+    """the distilled tiny autoencoder (TAESD) encoder, roughly two orders of magnitude fewer flops than the vae"""
+
+    def __init__(self, ldm, pretrained="madebyollin/taesd"):
+        try:
+            from diffusers import AutoencoderTiny
+        except ImportError:
+            raise ImportError("the tiny encoder needs AutoencoderTiny from diffusers>=0.20")
+
+        param = next(ldm.vae.parameters())
+        self.taesd = AutoencoderTiny.from_pretrained(pretrained, torch_dtype=param.dtype).to(param.device)
+        for param in self.taesd.parameters():
+            param.requires_grad = False
+
+    def encode(self, image, keys=None):
+        param = next(self.taesd.parameters())
+        # TAESD latents are already in the scaled vae latent space
+        return self.taesd.encode(image.to(device=param.device, dtype=param.dtype)).latents.float()
+
+
+class CachedEncoder:
+    """memoizes another backend on keys the callers give every crop, (image id, crop box) for the inference crops
+
+    hits whenever the same crop is encoded again, e.g. uncropped images (crop_percent=100), the corner crops of
+    every restart or retesting the same target with several contexts. Crops without keys, like the random crops
+    of the optimization that rarely repeat, are encoded without being cached
+    """
+
+    def __init__(self, encoder, maxsize=256):
+        self.encoder = encoder
+        self.cache = LRUCache(maxsize)
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    def encode(self, image, keys=None):
+        if keys is None:
+            return self.encoder.encode(image)
+        latents = [self.cache.get(key) for key in keys]
+        missing = [n for n, latent in enumerate(latents) if latent is None]
+        if missing:
+            # the misses of a batch are encoded together
+            for n, latent in zip(missing, self.encoder.encode(image[missing]).split(1)):
+                self.cache.put(keys[n], latent.clone())
+                latents[n] = latent
+        return torch.cat(latents)
+
+
+def image_id(image):
+    """the digest of the pixels of an image, computed once per image to key its crops in the cached backend"""
+    return hashlib.sha1(image.detach().cpu().numpy().tobytes()).hexdigest()
+
+
+def caches_crops(ldm):
+    """whether the backend of ldm is cached, so callers should key the crops they encode"""
+    return isinstance(getattr(ldm, "encoder", None), CachedEncoder)
+
+
+ENCODERS = {
+    "vae": VAEEncoder,
+    "tiny": TinyEncoder,
+    "cached": lambda ldm: CachedEncoder(VAEEncoder(ldm)),
+}
+
+
+def get_encoder(name, ldm):
+    if name not in ENCODERS:
+        raise ValueError(f"encoder must be one of {list(ENCODERS)}, got {name}")
+    return ENCODERS[name](ldm)
+
+
+def encode(ldm, image, keys=None):
+    """encodes with the backend chosen in load_ldm, the vae if there is none"""
+    encoder = getattr(ldm, "encoder", None)
+    if encoder is None:
+        encoder = VAEEncoder(ldm)
+    return encoder.encode(image, keys=keys)
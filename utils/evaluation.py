@@ -1,6 +1,5 @@
 """For quantitative evaluation of DHPF"""
 
-import numpy as np
 import torch
 
 from . import utils
@@ -8,6 +7,9 @@ from . import utils
 
 class Evaluator:
     r"""Computes evaluation metrics of PCK, LT-ACC, IoU"""
+    # thresholds eval_kps_transfer reports the PCK at, as fractions of pckthres
+    alphas = (0.05, 0.1)
+
     @classmethod
     def initialize(cls, alpha=0.1):
         cls.eval_func = cls.eval_kps_transfer
@@ -19,46 +21,58 @@ class Evaluator:
 
     @classmethod
     def eval_kps_transfer(cls, prd_kps, batch):
-        r"""Compute percentage of correct key-points (PCK) based on prediction"""
-
-        pck = []
-        for idx, (pk, tk) in enumerate(zip(prd_kps, batch['trg_kps'])):
-            thres = batch['pckthres'][idx]
-            npt = batch['n_pts'][idx]
-            
-            _, correct_ids_five_percent, _ = cls.classify_prd(pk[:, :npt], tk[:, :npt], thres, 0.05)
-            _, correct_ids_ten_percent, _ = cls.classify_prd(pk[:, :npt], tk[:, :npt], thres, 0.1)
+        r"""Compute percentage of correct key-points (PCK) based on prediction
 
-            pck.append((len(correct_ids_five_percent) / npt.item()) * 100)
-            pck.append((len(correct_ids_ten_percent) / npt.item()) * 100)
+        pck holds the PCK of every item at every alpha in cls.alphas, item major, and correct_ids the
+        correctly transferred key-points of the last item at the last alpha
+        """
+        correct = cls.correct_kps(prd_kps, batch['trg_kps'], batch['pckthres'], batch['n_pts'], cls.alphas)
+        pck = cls.pck_of(correct, batch['n_pts'])
 
-        eval_result = {'pck': pck, 'correct_ids': correct_ids_ten_percent}
+        eval_result = {'pck': pck.reshape(-1).tolist(), 'correct_ids': utils.where(correct[-1, :, -1])}
 
         return eval_result
 
     @classmethod
-    def eval_mask_transfer(cls, prd_kps, batch):
-        r"""Compute LT-ACC and IoU based on transferred points"""
+    def correct_kps(cls, prd_kps, trg_kps, pckthres, n_pts, alphas):
+        r"""Classifies every predicted key-point as correct at every alpha, in one pass
+
+        prd_kps are [..., N, 2, P] predictions of N pairs with any leading dimensions (e.g. layers or
+        restarts), trg_kps [N, 2, P] their targets of which the first n_pts [N] count and pckthres [N].
+        Returns a [..., N, P, len(alphas)] mask, False for the padded key-points
+        """
+        trg_kps = trg_kps.to(prd_kps.device)
+        l2dist = (prd_kps.float() - trg_kps.float()).pow(2).sum(dim=-2).pow(0.5)
+        alphas = torch.as_tensor(alphas, dtype=torch.float32, device=prd_kps.device)
+        thres = pckthres.reshape(-1, 1, 1).float().to(prd_kps.device) * alphas
+        valid = torch.arange(trg_kps.shape[-1], device=prd_kps.device) < n_pts.reshape(-1, 1).to(prd_kps.device)
 
-        ltacc = []
-        iou = []
+        return torch.le(l2dist[..., None], thres) & valid[..., None]
 
-        for idx, prd in enumerate(prd_kps):
-            trg_n_pts = (batch['trg_kps'][idx] > 0)[0].sum()
-            prd_kp = prd[:, :batch['n_pts'][idx]]
-            trg_kp = batch['trg_kps'][idx][:, :trg_n_pts]
+    @classmethod
+    def pck_of(cls, correct, n_pts):
+        r"""PCK in percent of a correct_kps mask, [..., N, len(alphas)]"""
+        n_pts = n_pts.reshape(-1, 1).to(correct.device).double()
+        return correct.sum(dim=-2).double() / n_pts * 100
 
-            imsize = list(batch['trg_img'].size())[2:]
-            trg_xstr, trg_ystr = cls.pts2ptstr(trg_kp)
-            trg_mask = cls.ptstr2mask(trg_xstr, trg_ystr, imsize[0], imsize[1])
-            prd_xstr, pred_ystr = cls.pts2ptstr(prd_kp)
-            prd_mask = cls.ptstr2mask(prd_xstr, pred_ystr, imsize[0], imsize[1])
+    @classmethod
+    def pck(cls, prd_kps, trg_kps, pckthres, n_pts, alphas=None):
+        r"""PCK in percent of [..., N, 2, P] predictions at every alpha (cls.alphas by default), [..., N, len(alphas)]"""
+        alphas = cls.alphas if alphas is None else alphas
+        return cls.pck_of(cls.correct_kps(prd_kps, trg_kps, pckthres, n_pts, alphas), n_pts)
 
-            ltacc.append(cls.label_transfer_accuracy(prd_mask, trg_mask))
-            iou.append(cls.intersection_over_union(prd_mask, trg_mask))
+    @classmethod
+    def eval_mask_transfer(cls, prd_kps, batch):
+        r"""Compute LT-ACC and IoU based on transferred points, for the whole batch at once"""
+        # the target polygon is made of its key-points with a positive x, the transferred one of the first n_pts
+        trg_n_pts = (batch['trg_kps'] > 0)[:, 0].sum(dim=-1)
+        imsize = list(batch['trg_img'].size())[2:]
 
-        eval_result = {'ltacc': ltacc,
-                       'iou': iou}
+        trg_mask = cls.polygon_masks(batch['trg_kps'], trg_n_pts, imsize[0], imsize[1])
+        prd_mask = cls.polygon_masks(prd_kps, batch['n_pts'], imsize[0], imsize[1])
+
+        eval_result = {'ltacc': cls.label_transfer_accuracy(prd_mask, trg_mask).tolist(),
+                       'iou': cls.intersection_over_union(prd_mask, trg_mask).tolist()}
 
         return eval_result
 
@@ -77,46 +91,80 @@ class Evaluator:
 
     @classmethod
     def intersection_over_union(cls, mask1, mask2):
-        r"""Computes IoU between two masks"""
-        rel_part_weight = torch.sum(torch.sum(mask2.gt(0.5).float(), 2, True), 3, True) / \
-                          torch.sum(mask2.gt(0.5).float())
-        part_iou = torch.sum(torch.sum((mask1.gt(0.5) & mask2.gt(0.5)).float(), 2, True), 3, True) / \
-                   torch.sum(torch.sum((mask1.gt(0.5) | mask2.gt(0.5)).float(), 2, True), 3, True)
-        weighted_iou = torch.sum(torch.mul(rel_part_weight, part_iou)).item()
+        r"""Computes IoU between two batches of [N, C, H, W] masks, [N]"""
+        mask1, mask2 = mask1.gt(0.5), mask2.gt(0.5)
+        area2 = mask2.sum(dim=(2, 3)).float()
+        rel_part_weight = area2 / area2.sum(dim=1, keepdim=True)
+        part_iou = (mask1 & mask2).sum(dim=(2, 3)).float() / (mask1 | mask2).sum(dim=(2, 3)).float()
+        weighted_iou = torch.sum(rel_part_weight * part_iou, dim=1)
 
         return weighted_iou
 
     @classmethod
     def label_transfer_accuracy(cls, mask1, mask2):
-        r"""LT-ACC measures the overlap with emphasis on the background class"""
-        return torch.mean((mask1.gt(0.5) == mask2.gt(0.5)).double()).item()
-
-    @classmethod
-    def pts2ptstr(cls, pts):
-        r"""Convert tensor of points to string"""
-        x_str = str(list(pts[0].cpu().numpy()))
-        x_str = x_str[1:len(x_str)-1]
-        y_str = str(list(pts[1].cpu().numpy()))
-        y_str = y_str[1:len(y_str)-1]
-
-        return x_str, y_str
-
-    @classmethod
-    def pts2mask(cls, x_pts, y_pts, shape):
-        from skimage import draw
-        r"""Build a binary mask tensor base on given xy-points"""
-        x_idx, y_idx = draw.polygon(x_pts, y_pts, shape)
-        mask = np.zeros(shape, dtype=np.bool)
-        mask[x_idx, y_idx] = True
-
-        return mask
+        r"""LT-ACC measures the overlap with emphasis on the background class, [N]"""
+        return torch.mean((mask1.gt(0.5) == mask2.gt(0.5)).double(), dim=(1, 2, 3))
 
     @classmethod
-    def ptstr2mask(cls, x_str, y_str, out_h, out_w):
-        r"""Convert xy-point mask (string) to tensor mask"""
-        x_pts = np.fromstring(x_str, sep=',')
-        y_pts = np.fromstring(y_str, sep=',')
-        mask_np = cls.pts2mask(y_pts, x_pts, [out_h, out_w])
-        mask = torch.tensor(mask_np.astype(np.float32)).unsqueeze(0).unsqueeze(0).float()
-
-        return mask
+    def polygon_masks(cls, polygons, n_pts, out_h, out_w):
+        r"""Rasterizes a batch of polygons into [N, 1, out_h, out_w] masks, as skimage.draw.polygon does
+
+        polygons are [N, 2, P] (x, y) vertices, the first n_pts [N] of which make up each polygon. As in skimage
+        pixel (row, column) is inside when it is a vertex or when the horizontal ray to its right or the one to its
+        left crosses an odd number of edges, which includes the pixels on an edge. The loop runs over the P edges,
+        every edge is tested against all rows of the batch at once and the columns a ray crosses it at are found
+        exactly, so vertices and edges through pixel centres are classified as skimage classifies them
+        """
+        polygons = polygons.double()
+        n_pts = torch.as_tensor(n_pts, device=polygons.device).reshape(-1, 1)
+        num_vertices = polygons.shape[-1]
+
+        rows = torch.arange(out_h, dtype=torch.float64, device=polygons.device)[None]
+        cols = torch.arange(out_w, dtype=torch.float64, device=polygons.device)
+        right = torch.zeros(len(polygons), out_h, out_w, dtype=torch.bool, device=polygons.device)
+        left = torch.zeros_like(right)
+
+        # edge i runs from vertex i to vertex i + 1, the last vertex of a polygon closes it back to its first
+        vertex = torch.arange(num_vertices, device=polygons.device)[None]
+        following = torch.where(vertex + 1 < n_pts, vertex + 1, torch.zeros_like(vertex))
+        x0, y0 = polygons[:, 0], polygons[:, 1]
+        x1, y1 = torch.gather(x0, 1, following), torch.gather(y0, 1, following)
+
+        for i in range(num_vertices):
+            valid = i < n_pts
+            dy = (y1[:, i] - y0[:, i])[:, None]
+            # the ray of row r crosses the edge at column q = a / dy, a column c is left of it when (a - c * dy) * dy > 0
+            a = x0[:, i, None] * (y1[:, i, None] - rows) - x1[:, i, None] * (y0[:, i, None] - rows)
+            # horizontal edges are never crossed
+            horizontal = dy == 0
+            dy = torch.where(horizontal, torch.ones_like(dy), dy)
+            q = a / dy
+
+            def left_of(c):
+                return (a - c * dy) * dy > 0
+
+            def right_of(c):
+                return (a - c * dy) * dy < 0
+
+            # the first column at or right of the crossing and the last one at or left of it, exact despite rounding
+            first = torch.ceil(q)
+            first = torch.where(left_of(first), first + 1, first)
+            first = torch.where(left_of(first - 1), first, first - 1)
+            last = torch.floor(q)
+            last = torch.where(right_of(last), last - 1, last)
+            last = torch.where(right_of(last + 1), last, last + 1)
+
+            crosses_right = ((y0[:, i, None] > rows) != (y1[:, i, None] > rows)) & valid & ~horizontal
+            crosses_left = ((y0[:, i, None] < rows) != (y1[:, i, None] < rows)) & valid & ~horizontal
+            right ^= crosses_right[..., None] & (cols < first[..., None])
+            left ^= crosses_left[..., None] & (cols > last[..., None])
+
+        mask = right | left
+
+        # vertices on pixel centres are inside
+        on_pixel = (x0 == torch.round(x0)) & (y0 == torch.round(y0)) & (vertex < n_pts) & \
+                   (x0 >= 0) & (x0 < out_w) & (y0 >= 0) & (y0 < out_h)
+        n, v = on_pixel.nonzero(as_tuple=True)
+        mask[n, y0[n, v].long(), x0[n, v].long()] = True
+
+        return mask[:, None].float()
@@ -0,0 +1,96 @@
+"""Streaming PCK sums and counts, overall, per category, per difficulty bucket and per layer
+
+every pair adds its PCK at every alpha to the running sums of the groups it belongs to, so the means are
+available at any point in O(1) per pair and nothing grows with the number of pairs. Aggregators of several
+workers or nodes merge by adding their sums, and snapshots are flushed to json so they survive the run.
+"""
+
+import json
+import os
+
+import torch
+
+from utils.evaluation import Evaluator
+
+# the difficulty annotations of SPair pairs, each value of a field is a bucket
+DIFFICULTY_FIELDS = ["vpvar", "scvar", "trncn", "occln"]
+
+
+def pair_groups(mini_batch):
+    """the groups of a mini batch of one pair: all, its category and its difficulty buckets, if the dataset has them"""
+    groups = ["all"]
+    if "category" in mini_batch:
+        category = mini_batch["category"]
+        groups.append(f"category/{category[0] if isinstance(category, (list, tuple)) else category}")
+    for field in DIFFICULTY_FIELDS:
+        if field in mini_batch:
+            groups.append(f"{field}/{int(torch.as_tensor(mini_batch[field]).reshape(-1)[0])}")
+    return groups
+
+
+class StreamingPCK:
+    """running sums of the PCK (in percent) of pairs at every alpha, per group
+
+    groups are names like all, category/cat, vpvar/1 or layer/3, see pair_groups
+    """
+
+    def __init__(self, alphas=Evaluator.alphas):
+        self.alphas = [float(alpha) for alpha in alphas]
+        self.sums = {}
+        self.counts = {}
+
+    def update(self, pck, groups=("all",)):
+        """adds the PCK of a pair at every alpha to every group in groups"""
+        pck = [float(value) for value in pck]
+        assert len(pck) == len(self.alphas)
+        for group in groups:
+            sums = self.sums.setdefault(group, [0.0] * len(self.alphas))
+            for a, value in enumerate(pck):
+                sums[a] += value
+            self.counts[group] = self.counts.get(group, 0) + 1
+
+    def merge(self, other):
+        """adds the sums of other, e.g. of another worker or node"""
+        assert other.alphas == self.alphas, f"cannot merge PCK at {other.alphas} into PCK at {self.alphas}"
+        for group, count in other.counts.items():
+            sums = self.sums.setdefault(group, [0.0] * len(self.alphas))
+            for a, value in enumerate(other.sums[group]):
+                sums[a] += value
+            self.counts[group] = self.counts.get(group, 0) + count
+        return self
+
+    def count(self, group="all"):
+        return self.counts.get(group, 0)
+
+    def mean(self, group="all", alpha=None):
+        """the mean PCK of the pairs in group at every alpha, or at alpha only"""
+        count = self.count(group)
+        means = [value / count if count else 0.0 for value in self.sums.get(group, [0.0] * len(self.alphas))]
+        return means if alpha is None else means[self.alphas.index(alpha)]
+
+    def groups(self, prefix=""):
+        return sorted(group for group in self.counts if group.startswith(prefix))
+
+    def snapshot(self):
+        return {"alphas": self.alphas,
+                "groups": {group: {"count": self.counts[group], "sums": self.sums[group], "mean": self.mean(group)} for group in self.groups()}}
+
+    def flush(self, path):
+        """writes a snapshot to path, through a temporary file so a snapshot that exists is always complete"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            snapshot = json.load(f)
+        metrics = cls(snapshot["alphas"])
+        for group, entry in snapshot["groups"].items():
+            metrics.sums[group] = list(entry["sums"])
+            metrics.counts[group] = entry["count"]
+        return metrics
+
+    def __repr__(self):
+        return f"StreamingPCK({self.count()} pairs, pck {self.mean()} at alphas {self.alphas})"
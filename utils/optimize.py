@@ -1,11 +1,348 @@
+import os
+import random
+import time
+from glob import glob
+
 from tqdm import tqdm
+import numpy as np
 import torch
+from torch.utils.data import DataLoader, Dataset
 from utils.utils import visualie_correspondences
 from utils.evaluation import Evaluator
 
-from utils.optimize_token import optimize_prompt, find_max_pixel_value, visualize_image_with_points, run_image_with_tokens_cropped
+from utils.optimize_token import optimize_prompts, find_max_pixel_value, visualize_image_with_points, run_image_with_tokens_cropped, run_images_with_tokens_cropped, image_batch
+from utils.workers import ModelPool
+from utils.rng import RandomStream
+from utils.metrics import StreamingPCK, pair_groups
+from utils.prefetch import PipelineStats, timed
+from utils import encoders
+
+
+def data_loader(dataset, num_workers=0, device="cpu", **kwargs):
+    """a DataLoader that loads the next pairs in num_workers persistent processes, into pinned memory if they go to a cuda device"""
+    if num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=2)
+    return DataLoader(dataset, num_workers=num_workers, pin_memory=torch.device(device).type == "cuda", **kwargs)
+
+
+class SavedResults(Dataset):
+    """the saved results of retest and the pairs they belong to, so both are loaded by DataLoader workers"""
+
+    def __init__(self, files, dataset):
+        self.files = files
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        data = torch.load(self.files[i], map_location="cpu")
+        return data, self.dataset[data['idx']]
+
+
+class StoredResults(Dataset):
+    """the results of pairs in a ResultsStore and the pairs they belong to, see SavedResults"""
+
+    def __init__(self, store, pairs, dataset):
+        self.store = store
+        self.pairs = pairs
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __getitem__(self, i):
+        data = self.store.result(self.pairs[i])
+        return data, self.dataset[int(data['idx'])]
+
+
+def result_path(save_folder, i):
+    return f"{save_folder}/correspondence_data_{i:03d}.pt"
+
+
+def save_result(result, path):
+    """
+    Saves through a temporary file so that a result that exists is always complete
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(result, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def metrics_path(save_folder, owner=None, mode="optimize"):
+    """where the metrics snapshot of a run is flushed to, one per node of a lease queue
+
+    retests are flushed to retest_metrics*.json, so they never overwrite or get merged with the snapshots of the
+    optimization they retest
+    """
+    name = "metrics" if mode == "optimize" else f"{mode}_metrics"
+    return f"{save_folder}/{name}.json" if owner is None else f"{save_folder}/{name}_{owner}.json"
+
+
+def record_pair(metrics, result):
+    """adds the pck of a result of validate_epoch to its groups in metrics and that of every layer, returns the latter"""
+    metrics.update(result['pck'], result.get('groups', ["all"]))
+    if 'ind_layers' not in result:
+        return []
+    layer_pck = Evaluator.pck(result['ind_layers'][:, None], result['trg_kps'], result['pckthres'], result['n_pts'])
+    layer_pck = [pck.reshape(-1).tolist() for pck in layer_pck]
+    for k, pck in enumerate(layer_pck):
+        metrics.update(pck, [f"layer/{k}"])
+    return layer_pck
+
+
+def checkpoint_path(save_folder, i, j):
+    return f"{save_folder}/checkpoint_{i:03d}_{j:02d}.pt"
+
+
+def remove_checkpoints(save_folder, i):
+    for path in glob(f"{save_folder}/checkpoint_{i:03d}_*.pt"):
+        os.remove(path)
+
+
+def get_rng_state():
+    """
+    State of every random number generator the optimization draws from, as tensors and tuples so it loads with weights_only
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {"random": random.getstate(),
+            "numpy": (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    random.setstate(state["random"])
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if state["cuda"]:
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def unbatch(batch, b):
+    """the b-th pair of a collated mini batch, as a mini batch of one pair"""
+    if torch.is_tensor(batch):
+        return batch[b:b + 1]
+    if isinstance(batch, dict):
+        return {key: unbatch(value, b) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)) and len(batch) > 0 and isinstance(batch[0], str):
+        return [batch[b]]
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(unbatch(value, b) for value in batch)
+    return batch
+
+
+def batched(pairs, batch_size):
+    """groups the (i, mini batch of one pair) of pairs into (ids, mini batches) of up to batch_size pairs"""
+    ids, mini_batches = [], []
+    for i, mini_batch in pairs:
+        ids.append(i)
+        mini_batches.append(mini_batch)
+        if len(ids) == batch_size:
+            yield ids, mini_batches
+            ids, mini_batches = [], []
+    if ids:
+        yield ids, mini_batches
+
+
+def _layer_maps(attn_maps):
+    """the attention maps of every layer averaged over the heads, [layers, 1, 512, 512]"""
+    return torch.stack([torch.mean(attn_maps[k], dim=0, keepdim=True) for k in range(attn_maps.shape[0])], dim=0)
+
+
+def _combine_maps(all_maps, layers, upsample_res):
+    """the softmax of the maps of every layer averaged over the restarts"""
+    all_maps = torch.mean(torch.stack(all_maps, dim=0), dim=0)
+    all_maps = torch.nn.Softmax(dim=-1)(all_maps.reshape(len(layers), upsample_res*upsample_res))
+    return all_maps.reshape(len(layers), upsample_res, upsample_res)
+
+
+def correspond_pair(ldm, mini_batch, i, **kwargs):
+    """
+    Optimizes the text embeddings of every source keypoint of a pair and finds the target keypoints, see correspond_pairs
+    """
+    est_keypoints, ind_layers, contexts = correspond_pairs(ldm, [mini_batch], [i], **kwargs)
+    return est_keypoints[0], ind_layers[0], contexts[0]
+
+
+def correspond_pairs(ldm,
+                     mini_batches,
+                     ids,
+                     upsample_res = 512,
+                     num_steps=100,
+                     noise_level = 10,
+                     layers = [0, 1, 2, 3, 4, 5],
+                     device = 'cpu',
+                     visualize = False,
+                     lr = 1e-3,
+                     num_opt_iterations = 5,
+                     sigma = 32,
+                     flip_prob = 0.5,
+                     crop_percent=80,
+                     save_folder = "outputs",
+                     num_iterations=20,
+                     context_cache = None,
+                     checkpoint = False,
+                     seed = None):
+    """
+    Optimizes the text embeddings of every source keypoint of the pairs in mini_batches (each a mini batch of one
+    pair, numbered by ids) and finds the target keypoints
+
+    keypoint j of every pair that has one is optimized and found in the same unet calls, so the unet runs on
+    batches of up to len(mini_batches) pairs. Returns the estimated keypoints, those estimated by every layer
+    alone and the optimized contexts of every pair. With a context_cache the contexts optimized for a source
+    image and keypoint are reused by later pairs with the same source keypoint, with a seed only by the same pair
+    as they depend on its random streams. With checkpoint every finished
+    keypoint is saved together with the random state after it and the settings of the run, and keypoints
+    checkpointed by an earlier run with the same settings are loaded so the pair continues where it stopped (the
+    random state is only restored for a group of one pair). With a seed every random draw is keyed on (seed, dataset
+    index of the pair, keypoint, restart), so the results are those of the pairs run one at a time
+    """
+    pairs = [int(torch.as_tensor(mini_batch['idx']).reshape(-1)[0]) for mini_batch in mini_batches]
+    # checkpoints of runs with other settings are not reused
+    settings = {"upsample_res": upsample_res, "num_steps": num_steps, "noise_level": noise_level, "layers": list(layers), "lr": lr, "num_opt_iterations": num_opt_iterations,
+                "sigma": sigma, "flip_prob": flip_prob, "crop_percent": crop_percent, "num_iterations": num_iterations, "seed": seed}
+
+    def stream(b, j, restart):
+        return None if seed is None else RandomStream(seed, pairs[b], j, restart)
+
+    # the digests of the images key the context cache and the crops of the cached encoder
+    cache_crops = encoders.caches_crops(ldm)
+    if context_cache is not None or cache_crops:
+        src_digests = [encoders.image_id(mini_batch['src_img'][0]) for mini_batch in mini_batches]
+    if cache_crops:
+        trg_digests = [encoders.image_id(mini_batch['trg_img'][0]) for mini_batch in mini_batches]
+
+    # the keypoints of a pair end at the first padded one
+    num_keypoints = []
+    for mini_batch in mini_batches:
+        padded = (mini_batch['src_kps'][0, 0] == -1).nonzero()
+        num_keypoints.append(int(padded[0]) if len(padded) > 0 else mini_batch['src_kps'].shape[2])
+
+    est_keypoints = [-1*torch.ones_like(mini_batch['src_kps']) for mini_batch in mini_batches]
+    ind_layers = [-1*torch.ones_like(mini_batch['src_kps']).repeat(len(layers), 1, 1) for mini_batch in mini_batches]
+
+    all_contexts = [[] for _ in mini_batches]
+
+    # the images are uploaded once, every optimization and restart resamples its crops from them on the device
+    src_images = image_batch([mini_batch['src_img'][0] for mini_batch in mini_batches], device)
+    trg_images = image_batch([mini_batch['trg_img'][0] for mini_batch in mini_batches], device)
+
+    for j in range(max(num_keypoints, default=0)):
+        batch = []
+        for b, (mini_batch, i) in enumerate(zip(mini_batches, ids)):
+            if j >= num_keypoints[b]:
+                continue
+
+            state = None
+            if checkpoint and os.path.exists(checkpoint_path(save_folder, i, j)):
+                state = torch.load(checkpoint_path(save_folder, i, j), map_location='cpu')
+                if state.get('settings') != settings:
+                    print(f"ignoring {checkpoint_path(save_folder, i, j)}, it was saved by a run with other settings")
+                    state = None
+            if state is not None:
+                est_keypoints[b][0, :, j] = state['est_keypoint']
+                ind_layers[b][:, :, j] = state['ind_layers']
+                all_contexts[b].append(state['contexts'].to(device))
+                if len(mini_batches) == 1:
+                    # the global generators are shared by the whole group, only the state after a lone pair is its own
+                    set_rng_state(state['rng'])
+                continue
+
+            if visualize:
+                visualize_image_with_points(mini_batch['src_img'][0], mini_batch['src_kps'][0, :, j], f"{i:03d}_initial_point_{j:02d}", save_folder=save_folder)
+                visualize_image_with_points(mini_batch['trg_img'][0], mini_batch['trg_kps'][0, :, j], f"{i:03d}_target_point_{j:02d}", save_folder=save_folder)
+            batch.append(b)
+
+        if not batch:
+            continue
+
+        # Find the text embeddings for the source points, those of cached source keypoints are reused
+        contexts = {}
+        if context_cache is not None:
+            # seeded contexts come from the streams of their pair, so they are only reused by the same pair
+            keys = {b: (src_digests[b], tuple(mini_batches[b]['src_kps'][0, :, j].tolist())) + ((pairs[b],) if seed is not None else ())
+                    for b in batch}
+            for b in batch:
+                cached = context_cache.get(keys[b])
+                if cached is not None:
+                    contexts[b] = cached
+        optimized = [b for b in batch if b not in contexts]
+        if optimized:
+            for b in optimized:
+                contexts[b] = []
+            images = src_images[optimized]
+            for restart in range(num_opt_iterations):
+                context = optimize_prompts(ldm, images, [mini_batches[b]['src_kps'][0, :, j]/512 for b in optimized], num_steps=num_steps, device=device, layers=layers, lr = lr, upsample_res=upsample_res, noise_level=noise_level, sigma = sigma, flip_prob=flip_prob, crop_percent=crop_percent, rngs=[stream(b, j, restart) for b in optimized])
+                for n, b in enumerate(optimized):
+                    contexts[b].append(context[n:n + 1])
+            if context_cache is not None:
+                for b in optimized:
+                    context_cache.put(keys[b], contexts[b])
+        for b in batch:
+            all_contexts[b].append(torch.stack(contexts[b]))
+
+        # Find and combine the attention maps over the multiple found text embeddings and crops
+        all_maps = {b: [] for b in batch}
+        images = trg_images[batch]
+        for restart in range(num_opt_iterations):
+            attn_maps, _ = run_images_with_tokens_cropped(ldm, images, torch.cat([contexts[b][restart] for b in batch]), upsample_res = upsample_res, noise_level=noise_level, layers=layers, device=device, crop_percent=crop_percent, num_iterations=num_iterations, image_masks = [None if 'bool_img_trg' not in mini_batches[b] else mini_batches[b]['bool_img_trg'][0] for b in batch], rngs=[stream(b, j, restart) for b in batch],
+                                                          image_ids=[trg_digests[b] for b in batch] if cache_crops else None)
+            for n, b in enumerate(batch):
+                maps = _layer_maps(attn_maps[n])
+                for k in range(maps.shape[0]):
+                    _max_val = find_max_pixel_value(maps[k, 0], img_size = 512)
+                    ind_layers[b][k, :, j] = (_max_val+0.5)
+                all_maps[b].append(maps)
+
+        for b in batch:
+            i, mini_batch = ids[b], mini_batches[b]
+            maps = _combine_maps(all_maps[b], layers, upsample_res)
+
+            # Visualize the attention maps for the target image
+            if visualize:
+                for k in range(maps.shape[0]):
+                    visualize_image_with_points(maps[k, None], mini_batch['trg_kps'][0, :, j]/512*upsample_res, f"{i:03d}_largest_loc_trg_{j:02d}_{k:02d}", save_folder=save_folder)
+                visualize_image_with_points(torch.mean(maps, dim=0)[None], None, f"{i:03d}_largest_loc_trg_{j:02d}_mean", save_folder=save_folder)
+
+            # Take the argmax to find the corresponding location for the target image
+            maps = torch.mean(maps, dim=0)
+            max_val = find_max_pixel_value(maps, img_size = 512)
+            est_keypoints[b][0, :, j] = (max_val+0.5)
+
+        # Find the attention maps for the source image
+        if visualize:
+            all_maps = {b: [] for b in batch}
+            images = src_images[batch]
+            for restart in range(num_opt_iterations):
+                attn_map_src, _ = run_images_with_tokens_cropped(ldm, images, torch.cat([contexts[b][restart] for b in batch]), upsample_res=upsample_res, noise_level=noise_level, layers=layers, device=device, crop_percent=crop_percent, num_iterations=num_iterations, image_masks = [None if 'bool_img_src' not in mini_batches[b] else mini_batches[b]['bool_img_src'][0] for b in batch], rngs=[stream(b, j, restart) for b in batch],
+                                                              image_ids=[src_digests[b] for b in batch] if cache_crops else None)
+                for n, b in enumerate(batch):
+                    all_maps[b].append(_layer_maps(attn_map_src[n]))
+            for b in batch:
+                i, mini_batch = ids[b], mini_batches[b]
+                maps = _combine_maps(all_maps[b], layers, upsample_res)
+                for k in range(maps.shape[0]):
+                    visualize_image_with_points(maps[k, None], mini_batch['src_kps'][0, :, j]/512*upsample_res, f"{i:03d}_largest_loc_src_{j:02d}_{k:02d}", save_folder=save_folder)
+                visualize_image_with_points(torch.mean(maps, dim=0)[None], None, f"{i:03d}_largest_loc_src_{j:02d}_mean", save_folder=save_folder)
+
+        if checkpoint:
+            for b in batch:
+                save_result({'est_keypoint': est_keypoints[b][0, :, j], 'ind_layers': ind_layers[b][:, :, j], 'contexts': all_contexts[b][-1].detach().cpu(), 'rng': get_rng_state(), 'settings': settings},
+                            checkpoint_path(save_folder, ids[b], j))
+
+    return est_keypoints, ind_layers, [torch.stack(contexts) for contexts in all_contexts]
+
+
+def _correspond_task(ldm, task):
+    """runs a group of pairs, returns the results of every pair and the seconds the group took"""
+    ids, mini_batches, kwargs = task
+    start = time.time()
+    est_keypoints, ind_layers, contexts = correspond_pairs(ldm, mini_batches, ids, **kwargs)
+    results = [(i, est, ind, context.detach().cpu()) for i, est, ind, context in zip(ids, est_keypoints, ind_layers, contexts)]
+    return ids, results, time.time() - start
 
-import wandb
 
 def validate_epoch(ldm,
                    val_loader,
@@ -24,89 +361,112 @@ def validate_epoch(ldm,
                    crop_percent=80,
                    save_folder = "outputs",
                    item_index = -1,
-                   num_iterations=20):
-    
+                   num_iterations=20,
+                   workers = 1,
+                   lease_queue = None,
+                   order = None,
+                   cost_model = None,
+                   context_cache = None,
+                   resume = False,
+                   seed = None,
+                   results_store = None):
+    """
+    Finds the correspondences of every pair in val_loader, saves them and returns their StreamingPCK
 
-    pbar = tqdm(enumerate(val_loader), total=len(val_loader))
-    pck_array = []
-    pck_array_ind_layers = [[] for i in range(len(layers))]
-    for i, mini_batch in pbar:
-        
-        est_keypoints = -1*torch.ones_like(mini_batch['src_kps'])
-        ind_layers = -1*torch.ones_like(mini_batch['src_kps']).repeat(len(layers), 1, 1)
-            
-        all_contexts = []
+    the pck is aggregated per category, difficulty bucket and layer, see utils.metrics, and flushed to
+    metrics_path after every pair (a file per node with a lease_queue).
 
-        for j in range(mini_batch['src_kps'].shape[2]):
-            
-            if mini_batch['src_kps'][0, 0, j] == -1:
-                break
-            
-            if visualize:
-                visualize_image_with_points(mini_batch['src_img'][0], mini_batch['src_kps'][0, :, j], f"{i:03d}_initial_point_{j:02d}", save_folder=save_folder)
-                visualize_image_with_points(mini_batch['trg_img'][0], mini_batch['trg_kps'][0, :, j], f"{i:03d}_target_point_{j:02d}", save_folder=save_folder)
-        
-            # Find the text embeddings for the source point
-            contexts = []
-            for _ in range(num_opt_iterations):
-                context = optimize_prompt(ldm, mini_batch['src_img'][0], mini_batch['src_kps'][0, :, j]/512, num_steps=num_steps, device=device, layers=layers, lr = lr, upsample_res=upsample_res, noise_level=noise_level, sigma = sigma, flip_prob=flip_prob, crop_percent=crop_percent)
-                contexts.append(context)
-            all_contexts.append(torch.stack(contexts))
-            
-            # Find and combine the attention maps over the multiple found text embeddings and crops
-            all_maps = []
-            for context in contexts:
-                maps = []
-                attn_maps, _ = run_image_with_tokens_cropped(ldm, mini_batch['trg_img'][0], context, index=0, upsample_res = upsample_res, noise_level=noise_level, layers=layers, device=device, crop_percent=crop_percent, num_iterations=num_iterations, image_mask = None if 'bool_img_trg' not in mini_batch else mini_batch['bool_img_trg'][0])
-                for k in range(attn_maps.shape[0]):
-                    avg = torch.mean(attn_maps[k], dim=0, keepdim=True)
-                    maps.append(avg)
-                    _max_val = find_max_pixel_value(avg[0], img_size = 512)
-                    ind_layers[k, :, j] = (_max_val+0.5)
-                maps = torch.stack(maps, dim=0)
-                all_maps.append(maps)
-            all_maps = torch.stack(all_maps, dim=0)
-            all_maps = torch.mean(all_maps, dim=0)
-            all_maps = torch.nn.Softmax(dim=-1)(all_maps.reshape(len(layers), upsample_res*upsample_res))
-            all_maps = all_maps.reshape(len(layers), upsample_res, upsample_res)
-            
-            # Visualize the attention maps for the target image
-            if visualize:
-                for k in range(all_maps.shape[0]):
-                    visualize_image_with_points(all_maps[k, None], mini_batch['trg_kps'][0, :, j]/512*upsample_res, f"{i:03d}_largest_loc_trg_{j:02d}_{k:02d}", save_folder=save_folder)
-                visualize_image_with_points(torch.mean(all_maps, dim=0)[None], None, f"{i:03d}_largest_loc_trg_{j:02d}_mean", save_folder=save_folder)
-            
-            # Take the argmax to find the corresponding location for the target image
-            all_maps = torch.mean(all_maps, dim=0)
-            max_val = find_max_pixel_value(all_maps, img_size = 512)
-            est_keypoints[0, :, j] = (max_val+0.5)
-            
-            
-            # Find the attention maps for the source image
-            if visualize:
-                all_maps = []
-                for context in contexts:
-                    attn_map_src, _ = run_image_with_tokens_cropped(ldm, mini_batch['src_img'][0], context, index=0, upsample_res=upsample_res, noise_level=noise_level, layers=layers, device=device, crop_percent=crop_percent, num_iterations=num_iterations, image_mask = None if 'bool_img_src' not in mini_batch else mini_batch['bool_img_src'][0])
-                    maps = []
-                    for k in range(attn_map_src.shape[0]):
-                        avg = torch.mean(attn_map_src[k], dim=0, keepdim=True)
-                        maps.append(avg)
-                    maps = torch.stack(maps, dim=0)
-                    all_maps.append(maps)
-                all_maps = torch.stack(all_maps, dim=0)
-                all_maps = torch.mean(all_maps, dim=0)
-                all_maps = torch.nn.Softmax(dim=-1)(all_maps.reshape(len(layers), upsample_res*upsample_res))
-                all_maps = all_maps.reshape(len(layers), upsample_res, upsample_res)
-                for k in range(all_maps.shape[0]):  
-                    visualize_image_with_points(all_maps[k, None], mini_batch['src_kps'][0, :, j]/512*upsample_res, f"{i:03d}_largest_loc_src_{j:02d}_{k:02d}", save_folder=save_folder)
-                visualize_image_with_points(torch.mean(all_maps, dim=0)[None], None, f"{i:03d}_largest_loc_src_{j:02d}_mean", save_folder=save_folder)
+    with workers > 1 the pairs are handed out to a pool of processes sharing the weights of ldm and
+    their results are merged as they finish. With a lease_queue only the pairs of val_loader.dataset
+    this node claims are run, in the given order of dataset indices. Pairs are always saved under their index
+    in val_loader.dataset, whatever the sampler order, so any folder can be resumed or leased.
+    The observed time of every pair refines cost_model. A context_cache is only used with a single worker.
+    With resume pairs with a saved result are skipped and every keypoint is checkpointed so an interrupted pair continues from its last finished keypoint. The pairs are
+    run in groups of val_loader.batch_size that share their unet calls, see correspond_pairs, and are
+    evaluated and saved one by one. With a seed results do not depend on the order, the batch size, the
+    number of workers or interruptions. With a results_store (see utils.results_store) results are appended
+    to it instead of saved one file per pair, and pairs it holds are done
+    """
+    kwargs = {"upsample_res": upsample_res, "num_steps": num_steps, "noise_level": noise_level, "layers": layers, "device": device, "visualize": visualize, "lr": lr,
+              "num_opt_iterations": num_opt_iterations, "sigma": sigma, "flip_prob": flip_prob, "crop_percent": crop_percent, "save_folder": save_folder, "num_iterations": num_iterations,
+              "checkpoint": resume or lease_queue is not None, "seed": seed}
 
-        # Evaluate the performance of the individual layers
-        for k in range(len(pck_array_ind_layers)):
-            _eval_result = Evaluator.eval_kps_transfer(ind_layers[k].cpu()[None], mini_batch)
-            pck_array_ind_layers[k] += _eval_result['pck']
-            
-            print(f"layer {k} pck {sum(pck_array_ind_layers[k]) / len(pck_array_ind_layers[k])}, this pck {_eval_result['pck']}")
+    if kwargs["checkpoint"] and val_loader.batch_size > 1 and seed is None:
+        # the pairs of a group draw from the same global generators, a checkpoint only restores the state of a lone pair
+        raise ValueError("resuming or leasing batches of more than one pair needs a seed")
+
+    def stored_as(i):
+        # with item_index the dataset holds that one pair, its rows in a shared store are keyed by its real index
+        return i if item_index == -1 else item_index
+
+    pool = None
+    if workers > 1:
+        if context_cache is not None:
+            print("the context cache is not shared between workers and is not used")
+        # the workers are forked before the data loader starts its worker processes and pin memory thread
+        pool = ModelPool(ldm, workers)
+
+    metrics = StreamingPCK()
+    total = len(val_loader.sampler)
+    if lease_queue is not None:
+        pairs = lease_queue.pairs(val_loader.dataset, order)
+    else:
+        # the order is drawn from the sampler once, so the pairs are numbered by the dataset indices they are loaded from
+        indices = list(val_loader.sampler)
+        if resume:
+            remaining = []
+            for idx in indices:
+                if results_store is not None and results_store.is_done(stored_as(idx)):
+                    record_pair(metrics, results_store.result(stored_as(idx)))
+                elif results_store is None and os.path.exists(result_path(save_folder, idx)):
+                    record_pair(metrics, torch.load(result_path(save_folder, idx)))
+                else:
+                    remaining.append(idx)
+            print(f"resuming, {total - len(remaining)} of {total} pairs are done")
+            indices = remaining
+            total = len(indices)
+        pairs = enumerate(data_loader(val_loader.dataset, val_loader.num_workers, device, batch_size=val_loader.batch_size, sampler=indices))
+    data_wait = PipelineStats()
+    pairs = timed(pairs, data_wait)
+    if lease_queue is None:
+        # pair b of mini batch i is the (i * batch_size + b)-th index drawn from the sampler
+        pairs = ((indices[i * val_loader.batch_size + b], unbatch(mini_batch, b))
+                 for i, mini_batch in pairs for b in range(len(mini_batch['idx'])))
+    groups = batched(pairs, val_loader.batch_size)
+
+    mini_batches = {}
+    if pool is not None:
+        def tasks():
+            for ids, group in groups:
+                mini_batches.update(zip(ids, group))
+                yield ids, group, kwargs
+
+        group_results = (result for _, result in pool.imap(_correspond_task, tasks()))
+    else:
+        kwargs['context_cache'] = context_cache
+
+        def serial_results():
+            for ids, group in groups:
+                mini_batches.update(zip(ids, group))
+                yield _correspond_task(ldm, (ids, group, kwargs))
+
+        group_results = serial_results()
+
+    pair_seconds = {}
+
+    def pair_results():
+        for ids, results, seconds in group_results:
+            pair_seconds.update((i, seconds / len(ids)) for i in ids)
+            if cost_model is not None:
+                cost_model.observe(sum(int(mini_batches[i]['n_pts'].sum()) for i in ids), seconds)
+            yield from results
+
+    results = pair_results()
+
+    pbar = tqdm(results, total=total)
+    for i, est_keypoints, ind_layers, contexts in pbar:
+        mini_batch = mini_batches.pop(i)
+        seconds = pair_seconds.pop(i)
 
         # Evaluate the performance of the estimated keypoints
         eval_result = Evaluator.eval_kps_transfer(est_keypoints.cpu(), mini_batch)
@@ -116,23 +476,46 @@ def validate_epoch(ldm,
             visualie_correspondences(mini_batch['src_img'][0], mini_batch['trg_img'][0], mini_batch['src_kps'], est_keypoints, f"correspondences_estimated_{i:03d}", correct_ids = eval_result['correct_ids'], save_folder=save_folder)
             visualie_correspondences(mini_batch['src_img'][0], mini_batch['trg_img'][0], mini_batch['src_kps'], mini_batch['trg_kps'], f"correspondences_gt_{i:03d}", correct_ids = eval_result['correct_ids'], save_folder=save_folder)
             
-        dict = {"est_keypoints": est_keypoints, "correct_ids": eval_result['correct_ids'], "src_kps": mini_batch['src_kps'], "trg_kps": mini_batch['trg_kps'], "idx": mini_batch['idx'] if item_index == -1 else item_index, "contexts": torch.stack(all_contexts), 'pck': eval_result['pck']}
+        dict = {"est_keypoints": est_keypoints, "correct_ids": eval_result['correct_ids'], "src_kps": mini_batch['src_kps'], "trg_kps": mini_batch['trg_kps'], "idx": mini_batch['idx'] if item_index == -1 else item_index, "contexts": contexts, 'pck': eval_result['pck'],
+                "pckthres": mini_batch['pckthres'], "n_pts": mini_batch['n_pts'], "ind_layers": ind_layers.cpu(), "groups": pair_groups(mini_batch)}
         # save dict 
-        torch.save(dict, f"{save_folder}/correspondence_data_{i:03d}.pt")
+        if results_store is None:
+            save_result(dict, result_path(save_folder, i))
+        else:
+            results_store.append(stored_as(i), dict, seconds)
+        remove_checkpoints(save_folder, i)
+        if lease_queue is not None:
+            lease_queue.release(i)
+
+        # Aggregate the performance of the estimated keypoints and of the individual layers
+        layer_pck = record_pair(metrics, dict)
+        metrics.flush(metrics_path(save_folder, None if lease_queue is None else lease_queue.owner))
 
-        pck_array += eval_result['pck']
+        for k in range(len(layer_pck)):
+            print(f"layer {k} pck {sum(metrics.mean(f'layer/{k}')) / len(metrics.alphas)}, this pck {layer_pck[k]}")
 
-        mean_pck_ten = sum(pck_array[1::2]) / len(pck_array[1::2])
+        mean_pck_ten = metrics.mean(alpha=0.1)
         
         print(f"epoch: {epoch} {i} this pck ", eval_result['pck'], " mean_pck " , mean_pck_ten)
         
         if wandb_log:
+            import wandb
+
             wandb_dict = {"pck": mean_pck_ten}
-            for k in range(len(pck_array_ind_layers)):
-                wandb_dict[f"pck_layer_{k}"] = sum(pck_array_ind_layers[k]) / len(pck_array_ind_layers[k])
+            for k in range(len(layer_pck)):
+                wandb_dict[f"pck_layer_{k}"] = sum(metrics.mean(f"layer/{k}")) / len(metrics.alphas)
             wandb.log(wandb_dict)
 
-    return pck_array
+    if pool is not None:
+        pool.report()
+        pool.close()
+    if results_store is not None:
+        results_store.close()
+    if cost_model is not None:
+        print(f"cost model: {cost_model}")
+    print(f"waited {data_wait.stall:.1f} seconds for {data_wait.items} pairs to load")
+
+    return metrics
 
 
 def retest(ldm,
@@ -149,9 +532,18 @@ def retest(ldm,
             ablate_results = False,
             num_iterations = 20,
             results_loc = "outputs/",
-            save_folder = "outputs"):
+            save_folder = "outputs",
+            seed = None,
+            num_workers = 0,
+            results_store = None,
+            save_store = None):
     """
-    Takes the saved text embeddings and re-evaluates them
+    Takes the saved text embeddings and re-evaluates them, returns their StreamingPCK
+
+    the saved results and their pairs are loaded ahead by num_workers DataLoader workers, from the
+    correspondence_data files in the folders of results_loc or, given a results_store, from its memory mapped shards.
+    Given a save_store the retested results are appended to it, under the numbers of their pairs, instead of saved
+    as correspondence_data files
     
     if ablate_results:
         saves performance for average of 1-5 optimization iterations
@@ -161,27 +553,34 @@ def retest(ldm,
     
     from glob import glob
     
-    correspondences = glob(f"{results_loc}/*/correspondence_data_*.pt")
+    if results_store is None:
+        correspondences = glob(f"{results_loc}/*/correspondence_data_*.pt")
+        # the pair number is the name of the folder of the result
+        numbers = [int(correspondence.split("/")[-2]) for correspondence in correspondences]
+    else:
+        numbers = results_store.pairs()
     
     if item_index != -1:
-        correspondences = [correspondences[item_index]]
+        numbers = [numbers[item_index]]
+        if results_store is None:
+            correspondences = [correspondences[item_index]]
     
     index = 0
 
-    pck_array = []
-    pck_array_ind_layers = [[] for _ in range(len(layers))]
+    metrics = StreamingPCK()
+    data_wait = PipelineStats()
+    # unbatched (batch_size=None), as test_dataset[idx] returns them
+    saved = SavedResults(correspondences, test_dataset) if results_store is None else StoredResults(results_store, numbers, test_dataset)
+    loader = data_loader(saved, num_workers, device, batch_size=None)
     # for i, correspondence in enumerate(correspondences):
-    for _i in range(len(correspondences)):
-        
-        i = int(correspondences[_i].split("/")[-2])
+    for _i, (data, mini_batch) in enumerate(timed(loader, data_wait)):
+        start = time.time()
         
-        data = torch.load(correspondences[_i], map_location=device)
+        i = numbers[_i]
         
         contexts = data["contexts"].to(device)
         
-        idx = data['idx']
-        
-        mini_batch = test_dataset[idx]
+        idx = int(torch.as_tensor(data['idx']).reshape(-1)[0])
     
         mini_batch['pckthres'] = mini_batch['pckthres'][None]
         mini_batch['n_pts'] = mini_batch['n_pts'][None]
@@ -191,6 +590,9 @@ def retest(ldm,
         ind_layers = -1*torch.ones_like(mini_batch['src_kps']).repeat(len(layers), 1, 1)
         ind_opt_iterations = -1*torch.ones_like(mini_batch['src_kps']).repeat(10, 1, 1)
         ind_inf_iterations = -1*torch.ones_like(mini_batch['src_kps']).repeat(num_iterations, 1, 1)
+
+        # every keypoint and context crops the same target, the cached encoder keys its crops on the digest
+        trg_id = encoders.image_id(mini_batch['trg_img']) if encoders.caches_crops(ldm) else None
         
         
         for j in range(contexts.shape[0]):
@@ -211,7 +613,8 @@ def retest(ldm,
                 
                 maps = []
         
-                attn_maps, _collected_attention_maps = run_image_with_tokens_cropped(ldm, mini_batch['trg_img'], contexts[j, l].to(device), index=0, upsample_res = upsample_res, noise_level=noise_level, layers=layers, device=device, crop_percent=crop_percent, num_iterations = num_iterations)
+                rng = None if seed is None else RandomStream(seed, int(torch.as_tensor(idx).reshape(-1)[0]), j, l)
+                attn_maps, _collected_attention_maps = run_image_with_tokens_cropped(ldm, mini_batch['trg_img'], contexts[j, l].to(device), index=0, upsample_res = upsample_res, noise_level=noise_level, layers=layers, device=device, crop_percent=crop_percent, num_iterations = num_iterations, rng=rng, image_id=trg_id)
                 
                 collected_attention_maps.append(torch.stack(_collected_attention_maps, dim=0).detach().cpu())
                 
@@ -291,26 +694,21 @@ def retest(ldm,
                     visualize_image_with_points(all_maps[k, None], mini_batch['src_kps'][:, j]/512*upsample_res, f"{index:03d}_largest_loc_src_{j:02d}_{k:02d}", save_folder=save_folder)
                 visualize_image_with_points(torch.mean(all_maps, dim=0)[None], None, f"{index:03d}_largest_loc_src_{j:02d}_mean", save_folder=save_folder)
                 
-        ind_layers_results = []
+        def variant_pck(predictions):
+            # the pck of every layer, restart or iteration in one pass
+            pck = Evaluator.pck(predictions.cpu()[:, None], mini_batch['trg_kps'], mini_batch['pckthres'], mini_batch['n_pts'])
+            return [variant.reshape(-1).tolist() for variant in pck]
+
+        ind_layers_results = variant_pck(ind_layers)
             
         for k in range(ind_layers.shape[0]):
-            _eval_result = Evaluator.eval_kps_transfer(ind_layers[k].cpu()[None], mini_batch)
-            pck_array_ind_layers[k] += _eval_result['pck']
+            metrics.update(ind_layers_results[k], [f"layer/{k}"])
             
-            ind_layers_results.append(_eval_result['pck'])
-            
-            print(f"layer {k} pck {sum(pck_array_ind_layers[k]) / len(pck_array_ind_layers[k])}, this pck {_eval_result['pck']}")
+            print(f"layer {k} pck {sum(metrics.mean(f'layer/{k}')) / len(metrics.alphas)}, this pck {ind_layers_results[k]}")
             
         if ablate_results:
-            opt_iterations_results = []    
-            for k in range(ind_opt_iterations.shape[0]):
-                _eval_result = Evaluator.eval_kps_transfer(ind_opt_iterations[k].cpu()[None], mini_batch)
-                opt_iterations_results.append(_eval_result['pck'])
-                
-            inf_iterations_results = []    
-            for k in range(ind_inf_iterations.shape[0]):
-                _eval_result = Evaluator.eval_kps_transfer(ind_inf_iterations[k].cpu()[None], mini_batch)
-                inf_iterations_results.append(_eval_result['pck'])
+            opt_iterations_results = variant_pck(ind_opt_iterations)
+            inf_iterations_results = variant_pck(ind_inf_iterations)
         
 
         eval_result = Evaluator.eval_kps_transfer(est_keypoints[None].cpu(), mini_batch)
@@ -320,22 +718,34 @@ def retest(ldm,
             visualie_correspondences(mini_batch['src_img'], mini_batch['trg_img'], mini_batch['src_kps'][None], est_keypoints[None], f"correspondences_estimated_{index:03d}_{eval_result['pck'][1]}%", correct_ids = eval_result['correct_ids'], save_folder=save_folder, line_width=5)
             visualie_correspondences(mini_batch['src_img'], mini_batch['trg_img'], mini_batch['src_kps'][None], mini_batch['trg_kps'], f"correspondences_gt_{index:03d}_{eval_result['pck'][1]}%", correct_ids = eval_result['correct_ids'], save_folder=save_folder, line_width=5)
 
-        pck_array += eval_result['pck']
+        metrics.update(eval_result['pck'], pair_groups(mini_batch))
+        metrics.flush(metrics_path(save_folder, mode="retest"))
 
-        mean_pck = sum(pck_array) / len(pck_array)
+        mean_pck = sum(metrics.mean()) / len(metrics.alphas)
         
         index += 1
         
-        dict = {"est_keypoints": est_keypoints, "correct_ids": eval_result['correct_ids'], "src_kps": mini_batch['src_kps'], "trg_kps": mini_batch['trg_kps'], "idx": mini_batch['idx'] if item_index == -1 else item_index, 'pck': eval_result['pck']}
+        dict = {"est_keypoints": est_keypoints, "correct_ids": eval_result['correct_ids'], "src_kps": mini_batch['src_kps'], "trg_kps": mini_batch['trg_kps'], "idx": mini_batch['idx'] if item_index == -1 else item_index, 'pck': eval_result['pck'],
+                "pckthres": mini_batch['pckthres'], "n_pts": mini_batch['n_pts'], "ind_layers": ind_layers.cpu()}
+        if ablate_results:
+            # the estimates of the first 1, 2, ... restarts
+            dict["ind_opt_iterations"] = ind_opt_iterations[:contexts.shape[1]].cpu()
         # save dict 
-        torch.save(dict, f"{save_folder}/correspondence_data_{index:03d}.pt")
+        if save_store is None:
+            # saved under the number of the pair, as validate_epoch saves it
+            save_result(dict, result_path(save_folder, i))
+        else:
+            dict.update(contexts=data["contexts"], groups=pair_groups(mini_batch))
+            save_store.append(i, dict, time.time() - start)
         
         print(f"epoch: {epoch} {i} this pck ", eval_result['pck'], " mean_pck " , mean_pck)
         
         if wandb_log:
+            import wandb
+
             wandb_dict = {"pck": mean_pck}
-            for k in range(len(pck_array_ind_layers)):
-                wandb_dict[f"pck_layer_{k}"] = sum(pck_array_ind_layers[k]) / len(pck_array_ind_layers[k])
+            for k in range(len(layers)):
+                wandb_dict[f"pck_layer_{k}"] = sum(metrics.mean(f"layer/{k}")) / len(metrics.alphas)
             wandb.log(wandb_dict)
             
         if ablate_results:
@@ -347,5 +757,8 @@ def retest(ldm,
             }, f"{save_folder}/{idx:06d}_results.pt")
         
         
+    if save_store is not None:
+        save_store.close()
+    print(f"waited {data_wait.stall:.1f} seconds for {data_wait.items} pairs to load")
 
-    return pck_array
+    return metrics
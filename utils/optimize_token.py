@@ -13,33 +13,64 @@
 # limitations under the License.
 
 import torch
-from diffusers import StableDiffusionPipeline, DDIMScheduler
 import numpy as np
 import abc
+import contextlib
+import copy
 from utils import ptp_utils
+from utils import encoders
+from utils import backends
+from utils import rng as rng_utils
+from utils import prefetch
 from PIL import Image
 
 import torch.nn.functional as F
 
 import torch.nn as nn
 
-import pynvml
-
 
 def get_memory_free_MiB(gpu_index):
+    import pynvml
+
     pynvml.nvmlInit()
     handle = pynvml.nvmlDeviceGetHandleByIndex(int(gpu_index))
     mem_info = pynvml.nvmlDeviceGetMemoryInfo(handle)
     return mem_info.free // 1024**2
 
 
-def load_ldm(device, type="CompVis/stable-diffusion-v1-4"):
+PRECISIONS = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def get_dtype(precision, device):
+    """returns the dtype to run the model in, fp16 is only supported on cuda and falls back to fp32 elsewhere"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {list(PRECISIONS)}, got {precision}")
+
+    dtype = PRECISIONS[precision]
+    if dtype == torch.float16 and torch.device(device).type != "cuda":
+        print("fp16 is only supported on cuda, falling back to fp32")
+        dtype = torch.float32
+    return dtype
+
+
+def load_ldm(device, type="CompVis/stable-diffusion-v1-4", precision="fp32", encoder="vae", lean=False):
+    """loads a model by its name in utils.backends.BACKENDS or its pretrained weights
+
+    unregistered weights are loaded as well, with their cross attention layout read from the unet.
+    lean=True skips the StableDiffusionPipeline and only loads the unet and the vae encoder from
+    memory mapped safetensors, see utils.backends.load_lean
+    """
+    from diffusers import StableDiffusionPipeline, DDIMScheduler
+
+    dtype = get_dtype(precision, device)
+    backend = backends.get_backend(type)
+
     scheduler = DDIMScheduler(
-        beta_start=0.00085,
-        beta_end=0.012,
-        beta_schedule="scaled_linear",
-        clip_sample=False,
-        set_alpha_to_one=False,
+        **(backends.SD_SCHEDULER if backend is None else backend.scheduler)
     )
 
     MY_TOKEN = ""
@@ -49,20 +80,80 @@ def load_ldm(device, type="CompVis/stable-diffusion-v1-4"):
     MAX_NUM_WORDS = 77
     scheduler.set_timesteps(NUM_DDIM_STEPS)
 
-    ldm = StableDiffusionPipeline.from_pretrained(
-        type, use_auth_token=MY_TOKEN, scheduler=scheduler
-    ).to(device)
+    if backend is not None and backend.pretrained is None:
+        unet, vae = backends.build_random(backend)
+        ldm = backends.DiffusionModel(unet, vae, scheduler).to(device)
+    elif lean:
+        ldm = backends.load_lean(
+            type if backend is None else backend.pretrained, device, dtype, scheduler
+        )
+    else:
+        ldm = StableDiffusionPipeline.from_pretrained(
+            type if backend is None else backend.pretrained,
+            use_auth_token=MY_TOKEN,
+            scheduler=scheduler,
+        ).to(device)
+
+    if backend is None:
+        backend = backends.ModelBackend.from_unet(type, ldm.unet)
+        print(f"{type} is not a registered backend, using cross attention layers {backend.layer_names}")
+    backend.check_unet(ldm.unet)
+    ldm.backend = backend
+
+    # the weights are stored in the requested precision, optimized contexts and
+    # accumulated attention maps stay in fp32
+    for module in [ldm.vae, ldm.unet, getattr(ldm, "text_encoder", None)]:
+        if module is not None:
+            module.to(dtype=dtype)
+            for param in module.parameters():
+                param.requires_grad = False
+
+    # the backend image2latent encodes the crops with, see utils.encoders
+    ldm.encoder = encoders.get_encoder(encoder, ldm)
+
+    return ldm
+
+
+def quantize_unet(ldm, keep_fp32=True):
+    """dynamically quantizes the linear layers of the unet (attention projections and feed forwards) to int8 for cpu inference
+
+    quantized layers have no backward pass, so by default the fp32 unet is kept for optimize_prompt and
+    the quantized copy is only swapped in by run_image_with_tokens_cropped. keep_fp32=False quantizes in
+    place, which halves the memory when only running inference (retest)
+    """
+    from torch.ao.quantization import quantize_dynamic
+
+    param = next(ldm.unet.parameters())
+    if param.device.type != "cpu" or param.dtype != torch.float32:
+        raise ValueError("int8 quantization requires an fp32 model on the cpu")
+
+    unet = copy.deepcopy(ldm.unet) if keep_fp32 else ldm.unet
+    quantized = quantize_dynamic(unet, {nn.Linear}, dtype=torch.qint8, inplace=True)
 
-    for param in ldm.vae.parameters():
-        param.requires_grad = False
-    for param in ldm.text_encoder.parameters():
-        param.requires_grad = False
-    for param in ldm.unet.parameters():
-        param.requires_grad = False
+    if keep_fp32:
+        ldm.quantized_unet = quantized
+    else:
+        ldm.unet = quantized
 
     return ldm
 
 
+@contextlib.contextmanager
+def inference_unet(ldm):
+    """swaps in the quantized unet, if there is one, for gradient free inference"""
+    quantized = getattr(ldm, "quantized_unet", None)
+    if quantized is None:
+        yield ldm.unet
+        return
+
+    unet = ldm.unet
+    ldm.unet = quantized
+    try:
+        yield quantized
+    finally:
+        ldm.unet = unet
+
+
 class AttentionControl(abc.ABC):
     def step_callback(self, x_t):
         return x_t
@@ -80,8 +171,16 @@ class AttentionControl(abc.ABC):
 
     def __call__(self, attn, is_cross: bool, place_in_unet: str):
         if self.cur_att_layer >= self.num_uncond_att_layers:
-            h = attn.shape[0]
-            attn[h // 2 :] = self.forward(attn[h // 2 :], is_cross, place_in_unet)
+            # the second half of the heads of every item in the batch, batch major as the heads are laid out
+            shape = attn.shape
+            attn = attn.reshape(self.batch_size, -1, *shape[1:])
+            h = attn.shape[1]
+            cond = attn[:, h // 2 :].reshape(-1, *shape[1:])
+            edited = self.forward(cond, is_cross, place_in_unet)
+            # the stores return the maps they were given, only maps a controller edits are written back
+            if edited is not cond:
+                attn[:, h // 2 :] = edited.reshape(self.batch_size, -1, *shape[1:])
+            attn = attn.reshape(shape)
         self.cur_att_layer += 1
         if self.cur_att_layer == self.num_att_layers + self.num_uncond_att_layers:
             self.cur_att_layer = 0
@@ -97,6 +196,8 @@ class AttentionControl(abc.ABC):
         self.cur_step = 0
         self.num_att_layers = -1
         self.cur_att_layer = 0
+        # items in the batch of the unet call, set by run_unet
+        self.batch_size = 1
 
 
 class AttentionStore(AttentionControl):
@@ -114,7 +215,7 @@ class AttentionStore(AttentionControl):
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
         if attn.shape[1] <= 32**2:  # avoid memory overhead
-            self.step_store[key].append(attn)
+            self.step_store[key].append(attn.float())
         return attn
 
     def between_steps(self):
@@ -143,6 +244,36 @@ class AttentionStore(AttentionControl):
         self.step_store = self.get_empty_store()
         self.attention_store = {}
 
+    @classmethod
+    def from_maps(cls, keys, maps):
+        """builds a store holding the attention maps of a single step, e.g. the outputs of a compiled unet"""
+        store = cls()
+        store.attention_store = cls.get_empty_store()
+        for key, attn in zip(keys, maps):
+            store.attention_store[key].append(attn.float())
+        store.cur_step = 1
+        return store
+
+
+class AttentionRecorder(AttentionControl):
+    """keeps the cross attention maps of a single unet call in call order so they can be returned as graph outputs"""
+
+    def forward(self, attn, is_cross: bool, place_in_unet: str):
+        if is_cross and attn.shape[1] <= 32**2:
+            self.maps.append(attn)
+            self.keys.append(f"{place_in_unet}_cross")
+        return attn
+
+    def reset(self):
+        super(AttentionRecorder, self).reset()
+        self.maps = []
+        self.keys = []
+
+    def __init__(self):
+        super(AttentionRecorder, self).__init__()
+        self.maps = []
+        self.keys = []
+
 
 def load_512(image_path, left=0, right=0, top=0, bottom=0):
     if type(image_path) is str:
@@ -188,8 +319,8 @@ def init_prompt(model, prompt: str):
     return context, prompt
 
 
-def init_random_noise(device, num_words=77):
-    return torch.randn(1, num_words, 768).to(device)
+def init_random_noise(device, num_words=77, dim=768, generator=None):
+    return torch.randn(1, num_words, dim, generator=generator).to(device)
 
 
 def image2latent(model, image, device):
@@ -199,14 +330,36 @@ def image2latent(model, image, device):
         if type(image) is torch.Tensor and image.dim() == 4:
             latents = image
         else:
-            # print the max and min values of the image
-            image = torch.from_numpy(image).float() * 2 - 1
-            image = image.permute(2, 0, 1).unsqueeze(0).to(device)
-            latents = model.vae.encode(image)["latent_dist"].mean
-            latents = latents * 0.18215
+            # crops are (channels, height, width) tensors, arrays (height, width, channels), both in [0, 1]
+            latents = images2latents(model, image_tensor(image, device)[None], device)
     return latents
 
 
+def images2latents(model, images, device, keys=None):
+    """encodes a (batch, channels, height, width) tensor of crops in [0, 1], keys identify the crops for the cached encoder"""
+    with torch.no_grad():
+        # the vae may be on another device than the unet, see utils.prefetch.enable_prefetch
+        return encoders.encode(model, images * 2 - 1, keys=keys).to(device)
+
+
+def run_unet(ldm, latents, context, t):
+    """runs a single denoising step and returns an AttentionStore holding its attention maps
+
+    uses the compiled unet if one was set up with utils.compiled_unet.compile_unet
+    """
+    compiler = getattr(ldm, "unet_compiler", None)
+    if compiler is None:
+        controller = AttentionStore()
+        controller.batch_size = latents.shape[0]
+        ptp_utils.register_attention_control(ldm, controller)
+        ptp_utils.diffusion_step(ldm, controller, latents, context, t, cfg=False)
+        return controller
+
+    with ptp_utils.autocast(ldm):
+        keys, maps = compiler(ldm.unet, latents, t, context)
+    return AttentionStore.from_maps(keys, maps)
+
+
 def reshape_attention(attention_map):
     """takes average over 0th dimension and reshapes into square image
 
@@ -231,7 +384,6 @@ def visualize_attention_map(attention_map, file_name):
     img.save(file_name)
 
 
-@torch.no_grad()
 def run_image_with_tokens_cropped(
     ldm,
     image,
@@ -245,13 +397,49 @@ def run_image_with_tokens_cropped(
     num_iterations=20,
     crop_percent=100.0,
     image_mask=None,
+    rng=None,
+    image_id=None,
 ):
-    # if image is a torch.tensor, convert to numpy
-    if type(image) == torch.Tensor:
-        image = image.permute(1, 2, 0).detach().cpu().numpy()
+    attention_maps, collected_attention_maps = run_images_with_tokens_cropped(
+        ldm, [image], tokens, device=device, from_where=from_where, upsample_res=upsample_res,
+        noise_level=noise_level, layers=layers, num_iterations=num_iterations, crop_percent=crop_percent,
+        image_masks=[image_mask], rngs=[rng], image_ids=None if image_id is None else [image_id],
+    )
+    return attention_maps[0], [maps[0] for maps in collected_attention_maps]
 
-    num_samples = torch.zeros(len(layers), 4, 512, 512).to(device)
-    sum_samples = torch.zeros(len(layers), 4, 512, 512).to(device)
+
+@torch.no_grad()
+def run_images_with_tokens_cropped(
+    ldm,
+    images,
+    tokens,
+    device="cuda",
+    from_where=["down_cross", "mid_cross", "up_cross"],
+    upsample_res=512,
+    noise_level=10,
+    layers=[0, 1, 2, 3, 4, 5],
+    num_iterations=20,
+    crop_percent=100.0,
+    image_masks=None,
+    rngs=None,
+    image_ids=None,
+):
+    """run_image_with_tokens_cropped for a batch of images, every image with its own context in tokens, sharing the unet calls
+
+    images is a list of images or a (batch, channels, height, width) tensor of them, image_masks and rngs have an
+    entry (or None) per image. With image_ids (see utils.encoders.image_id) the cached encoder keys every crop on
+    its image and box. Returns the attention maps as [batch, layers, heads, 512, 512] and those after every iteration
+    """
+    # the images stay on the device, the crops of every iteration are resampled from them there in one go
+    images = image_batch(images, device)
+    batch_size = len(images)
+    image_masks = [None] * batch_size if image_masks is None else image_masks
+    rngs = [None] * batch_size if rngs is None else rngs
+
+    num_heads = backends.model_backend(ldm).captured_heads
+
+    num_samples = torch.zeros(batch_size, len(layers), num_heads, 512, 512).to(device)
+    sum_samples = torch.zeros(batch_size, len(layers), num_heads, 512, 512).to(device)
 
     pixel_locs = (
         torch.tensor([[0, 0], [0, 512], [512, 0], [512, 512]]).float().to(device)
@@ -259,63 +447,86 @@ def run_image_with_tokens_cropped(
 
     collected_attention_maps = []
 
-    for i in range(num_iterations):
-        if i < 4:
-            pixel_loc = pixel_locs[i]
-        else:
-            _attention_maps = sum_samples / num_samples
+    def masked(attention_maps):
+        return torch.stack([
+            maps if mask is None else maps * mask[None, None].to(device)
+            for maps, mask in zip(attention_maps, image_masks)
+        ])
+
+    def crop_all(pixel_locs, i):
+        # (y_start, height, x_start, width) of every crop
+        boxes = [
+            crop_box(images.shape[2], images.shape[3], pixel_loc, crop_percent,
+                     generator=rng_utils.generator(rng, "inference_crop", i))
+            for pixel_loc, rng in zip(pixel_locs, rngs)
+        ]
+        return resample_crops(images, boxes), boxes
+
+    def encode(cropped_images, boxes):
+        keys = None if image_ids is None else [(image_id, box) for image_id, box in zip(image_ids, boxes)]
+        return images2latents(ldm, cropped_images, device, keys=keys)
+
+    encode_ahead = prefetch.encodes_ahead(ldm)
+
+    def prepare(i):
+        cropped_images, boxes = crop_all([pixel_locs[i]] * batch_size, i)
+        if encode_ahead:
+            cropped_images = encode(cropped_images, boxes)
+        return cropped_images, boxes
+
+    # the quantized unet is swapped in for the whole loop, if there is one. Only the crops at the
+    # four corners can be prepared ahead, the later ones are centered on the attention maps so far
+    with inference_unet(ldm), prefetch.prefetcher(ldm, prepare, range(min(num_iterations, 4))) as corners:
+        corners = iter(corners)
+        for i in range(num_iterations):
+            if i < 4:
+                cropped_images, boxes = next(corners)
+                latents = cropped_images if encode_ahead else encode(cropped_images, boxes)
+            else:
+                _attention_maps = sum_samples / num_samples
 
-            # remove all the nans
-            _attention_maps[_attention_maps != _attention_maps] = 0
+                # remove all the nans
+                _attention_maps[_attention_maps != _attention_maps] = 0
 
-            _attention_maps = torch.mean(_attention_maps, dim=0)
-            _attention_maps = torch.mean(_attention_maps, dim=0)
+                _attention_maps = torch.mean(_attention_maps, dim=1)
+                _attention_maps = torch.mean(_attention_maps, dim=1)
 
-            max_val = find_max_pixel_value(_attention_maps, img_size=512) + 0.5
+                max_vals = [find_max_pixel_value(maps, img_size=512) + 0.5 for maps in _attention_maps]
 
-            pixel_loc = max_val.clone()
+                cropped_images, boxes = crop_all([max_val.clone() for max_val in max_vals], i)
 
-        cropped_image, cropped_pixel, y_start, height, x_start, width = crop_image(
-            image, pixel_loc, crop_percent=crop_percent
-        )
+                latents = encode(cropped_images, boxes)
 
-        latents = image2latent(ldm, cropped_image, device)
+            latents = ldm.scheduler.add_noise(
+                latents, rng_utils.rand_like_each(rngs, latents, "inference_noise", i), ldm.scheduler.timesteps[-3]
+            )
 
-        controller = AttentionStore()
+            controller = run_unet(ldm, latents, tokens, ldm.scheduler.timesteps[-3])
 
-        ptp_utils.register_attention_control(ldm, controller)
+            # every crop has the same size, crop_percent of the 512x512 images
+            height = boxes[0][1]
 
-        latents = ldm.scheduler.add_noise(
-            latents, torch.rand_like(latents), ldm.scheduler.timesteps[-3]
-        )
-
-        latents = ptp_utils.diffusion_step(
-            ldm, controller, latents, tokens, ldm.scheduler.timesteps[-3], cfg=False
-        )
+            _attention_maps = upscale_to_img_size(
+                controller,
+                from_where=from_where,
+                upsample_res=height,
+                layers=layers,
+                num_heads=num_heads,
+                batched=True,
+            )
 
-        assert height == width
+            for b, (y_start, height, x_start, width) in enumerate(boxes):
+                assert height == width
 
-        _attention_maps = upscale_to_img_size(
-            controller, from_where=from_where, upsample_res=height, layers=layers
-        )
+                num_samples[b, :, :, y_start : y_start + height, x_start : x_start + width] += 1
+                sum_samples[
+                    b, :, :, y_start : y_start + height, x_start : x_start + width
+                ] += _attention_maps[b]
 
-        num_samples[:, :, y_start : y_start + height, x_start : x_start + width] += 1
-        sum_samples[
-            :, :, y_start : y_start + height, x_start : x_start + width
-        ] += _attention_maps
-
-        _attention_maps = sum_samples / num_samples
-
-        if image_mask is not None:
-            _attention_maps = _attention_maps * image_mask[None, None].to(device)
-
-        collected_attention_maps.append(_attention_maps.clone())
+            collected_attention_maps.append(masked(sum_samples / num_samples))
 
     # visualize sum_samples/num_samples
-    attention_maps = sum_samples / num_samples
-
-    if image_mask is not None:
-        attention_maps = attention_maps * image_mask[None, None].to(device)
+    attention_maps = masked(sum_samples / num_samples)
 
     return attention_maps, collected_attention_maps
 
@@ -325,9 +536,15 @@ def upscale_to_img_size(
     from_where=["down_cross", "mid_cross", "up_cross"],
     upsample_res=512,
     layers=[0, 1, 2, 3, 4, 5],
+    num_heads=4,
+    batched=False,
 ):
     """
     returns the bilinearly upsampled attention map of size upsample_res x upsample_res for the first word in the prompt
+
+    num_heads is the number of heads the controller keeps per layer, see ModelBackend.captured_heads.
+    The maps are [layers, heads, upsample_res, upsample_res] for a single image, with batched
+    [batch, layers, heads, upsample_res, upsample_res] for every image of the unet call
     """
 
     attention_maps = controller.get_average_attention()
@@ -346,8 +563,8 @@ def upscale_to_img_size(
             img = attention_maps[key][layer]
 
             img = img.reshape(
-                4, int(img.shape[1] ** 0.5), int(img.shape[1] ** 0.5), img.shape[2]
-            )[None, :, :, :, 1]
+                -1, num_heads, int(img.shape[1] ** 0.5), int(img.shape[1] ** 0.5), img.shape[2]
+            )[:, :, :, :, 1]
 
             if upsample_res != -1:
                 # bilinearly upsample the image to img_sizeximg_size
@@ -360,9 +577,9 @@ def upscale_to_img_size(
 
             imgs.append(img)
 
-    imgs = torch.cat(imgs, dim=0)
+    imgs = torch.stack(imgs, dim=1)
 
-    return imgs
+    return imgs if batched else imgs[0]
 
 
 def softargmax2d(input, beta=1000):
@@ -394,7 +611,7 @@ def softargmax2d(input, beta=1000):
 
 def find_context(image, ldm, pixel_loc, context_estimator, device="cuda"):
     with torch.no_grad():
-        latent = image2latent(ldm, image.numpy().transpose(1, 2, 0), device)
+        latent = image2latent(ldm, image, device)
 
     context = context_estimator(latent, pixel_loc)
 
@@ -471,12 +688,11 @@ def gaussian_circle(pos, size=64, sigma=16, device="cuda"):
     return gaussian
 
 
-def crop_image(image, pixel, crop_percent=80, margin=0.15):
-    """pixel is an integer between 0 and image.shape[1] or image.shape[2]"""
+def crop_box(height, width, pixel, crop_percent=80, margin=0.15, generator=None):
+    """a random (y_start, crop_height, x_start, crop_width) box of crop_percent of the image keeping pixel away from its border"""
 
     assert 0 < crop_percent <= 100, "crop_percent should be between 0 and 100"
 
-    height, width, channels = image.shape
     crop_height = int(height * crop_percent / 100)
     crop_width = int(width * crop_percent / 100)
 
@@ -498,28 +714,64 @@ def crop_image(image, pixel, crop_percent=80, margin=0.15):
     y_start_max = min(y_start_max, height - crop_height)
 
     # Choose a random top-left corner within the allowed bounds
-    x_start = torch.randint(int(x_start_min), int(x_start_max) + 1, (1,)).item()
-    y_start = torch.randint(int(y_start_min), int(y_start_max) + 1, (1,)).item()
-
-    # Crop the image
-    cropped_image = image[
-        y_start : y_start + crop_height, x_start : x_start + crop_width
-    ]
-
-    # bilinearly upsample to 512x512
-    cropped_image = torch.nn.functional.interpolate(
-        torch.tensor(cropped_image[None]).permute(0, 3, 1, 2),
-        size=(512, 512),
-        mode="bilinear",
-        align_corners=False,
-    )[0]
+    x_start = torch.randint(int(x_start_min), int(x_start_max) + 1, (1,), generator=generator).item()
+    y_start = torch.randint(int(y_start_min), int(y_start_max) + 1, (1,), generator=generator).item()
+
+    return y_start, crop_height, x_start, crop_width
+
+
+def crop_grids(boxes, height, width, size=512, flips=None):
+    """the grid_sample grids resampling the (y_start, height, x_start, width) rows of boxes, a tensor, of height x width images to size x size
+
+    the sampling points of F.interpolate (align_corners=False) on each crop clamped to the crop, so pixels outside a box
+    never contribute. The box of a crop whose flips entry is True is one of the mirror image, which is sampled without
+    flipping the image. The grids are built on the device of boxes
+    """
+    y_start, crop_height, x_start, crop_width = boxes.T[:, :, None]
+
+    steps = torch.arange(size, dtype=boxes.dtype, device=boxes.device) + 0.5
+    xs = torch.minimum(x_start + (steps * crop_width / size - 0.5).clamp(min=0), x_start + crop_width - 1)
+    ys = torch.minimum(y_start + (steps * crop_height / size - 0.5).clamp(min=0), y_start + crop_height - 1)
+
+    # pixel centers to the [-1, 1] coordinates of grid_sample
+    xs = (2 * xs + 1) / width - 1
+    ys = (2 * ys + 1) / height - 1
+    if flips is not None:
+        # column x of the mirror image is column width - 1 - x of the image, at -x in the coordinates of grid_sample
+        xs = torch.where(flips[:, None], -xs, xs)
+    return torch.stack(torch.broadcast_tensors(xs[:, None, :], ys[:, :, None]), dim=-1)
+
+
+def resample_crops(images, boxes, size=512, flips=None):
+    """bilinearly resamples box n of image n of a (batch, channels, height, width) tensor to size x size, see crop_grids
+
+    boxes are (y_start, height, x_start, width) tuples and flips, if given, whether each box is one of the mirror image.
+    They are copied to the device of the images at once and all crops come from a single grid_sample
+    """
+    _, _, height, width = images.shape
+    flips = [False] * len(boxes) if flips is None else flips
+    params = torch.tensor([list(box) + [flip] for box, flip in zip(boxes, flips)], dtype=torch.float32).to(images.device)
+    grid = crop_grids(params[:, :4], height, width, size, flips=params[:, 4] > 0)
+    return F.grid_sample(images, grid.to(images.dtype), mode="bilinear", padding_mode="border", align_corners=False)
+
+
+def crop_image(image, pixel, crop_percent=80, margin=0.15, generator=None):
+    """crops a (channels, height, width) tensor around pixel, in pixels, and resizes the crop to 512x512 on its device
+
+    returns the crop, pixel in the crop in [0, 1] and the (y_start, crop_height, x_start, crop_width) box
+    """
+    _, height, width = image.shape
+    y_start, crop_height, x_start, crop_width = crop_box(height, width, pixel, crop_percent, margin, generator)
+
+    cropped_image = resample_crops(image[None], [(y_start, crop_height, x_start, crop_width)])[0]
 
     # calculate new pixel location
+    x, y = pixel
     new_pixel = torch.stack([x - x_start, y - y_start])
     new_pixel = new_pixel / crop_width
 
     return (
-        cropped_image.permute(1, 2, 0).numpy(),
+        cropped_image,
         new_pixel,
         y_start,
         crop_height,
@@ -528,6 +780,48 @@ def crop_image(image, pixel, crop_percent=80, margin=0.15):
     )
 
 
+def image_tensor(image, device):
+    """a (channels, height, width) float tensor in [0, 1] on device from a tensor of that shape or a (height, width, channels) array"""
+    if not isinstance(image, torch.Tensor):
+        image = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+    return image.to(device=device, dtype=torch.float32)
+
+
+def image_batch(images, device):
+    """a (batch, channels, height, width) float tensor on device of a list of images (see image_tensor) or of such a tensor"""
+    if isinstance(images, torch.Tensor) and images.dim() == 4:
+        return images.to(device=device, dtype=torch.float32)
+    return torch.stack([image_tensor(image, device) for image in images])
+
+
+def prepare_crops(images, pixel_locs, crop_percent=80, flip_prob=0.5, rngs=None, step=0):
+    """the inputs of optimization step step: a random crop around pixel_loc of every image, flipped with probability flip_prob
+
+    images is a (batch, channels, height, width) tensor. Returns the crops, resampled together, and the pixel_locs
+    in the crops, in [0, 1]
+    """
+    rngs = [None] * len(images) if rngs is None else rngs
+    _, _, height, width = images.shape
+    boxes, flips, cropped_pixels = [], [], []
+    for pixel_loc, rng in zip(pixel_locs, rngs):
+        flip = rng_utils.uniform(rng, "flip", step) <= flip_prob
+        if flip:
+            pixel_loc = pixel_loc.clone()
+            # flip pixel loc
+            pixel_loc[0] = 1 - pixel_loc[0]
+
+        pixel = pixel_loc * 512
+        y_start, crop_height, x_start, crop_width = crop_box(
+            height, width, pixel, crop_percent, generator=rng_utils.generator(rng, "crop", step)
+        )
+        boxes.append((y_start, crop_height, x_start, crop_width))
+        flips.append(flip)
+        # pixel in the crop, as crop_image computes it
+        cropped_pixels.append(torch.stack([pixel[0] - x_start, pixel[1] - y_start]) / crop_width)
+
+    return resample_crops(images, boxes, flips=flips), cropped_pixels
+
+
 def optimize_prompt(
     ldm,
     image,
@@ -543,86 +837,110 @@ def optimize_prompt(
     sigma=32,
     flip_prob=0.5,
     crop_percent=80,
+    rng=None,
 ):
-    # if image is a torch.tensor, convert to numpy
-    if type(image) == torch.Tensor:
-        image = image.permute(1, 2, 0).detach().cpu().numpy()
-
-    if context is None:
-        context = init_random_noise(device)
-
-    context.requires_grad = True
-
-    # optimize context to maximize attention at pixel_loc
-    optimizer = torch.optim.Adam([context], lr=lr)
-
-    # time the optimization
-    import time
-
-    start = time.time()
-
-    for iteration in range(num_steps):
-        with torch.no_grad():
-            if np.random.rand() > flip_prob:
-                cropped_image, cropped_pixel, _, _, _, _ = crop_image(
-                    image, pixel_loc * 512, crop_percent=crop_percent
-                )
+    """optimizes a context whose attention maps peak at pixel_loc of image
 
-                latent = image2latent(ldm, cropped_image, device)
-
-                _pixel_loc = cropped_pixel.clone()
-            else:
-                image_flipped = np.flip(image, axis=1).copy()
+    rng is a utils.rng.RandomStream every random draw is keyed on, the global generators are used without one
+    """
+    return optimize_prompts(
+        ldm, [image], [pixel_loc], contexts=context, device=device, num_steps=num_steps, from_where=from_where,
+        upsample_res=upsample_res, layers=layers, lr=lr, noise_level=noise_level, sigma=sigma,
+        flip_prob=flip_prob, crop_percent=crop_percent, rngs=[rng],
+    )
 
-                pixel_loc_flipped = pixel_loc.clone()
-                # flip pixel loc
-                pixel_loc_flipped[0] = 1 - pixel_loc_flipped[0]
 
-                cropped_image, cropped_pixel, _, _, _, _ = crop_image(
-                    image_flipped, pixel_loc_flipped * 512, crop_percent=crop_percent
-                )
+def optimize_prompts(
+    ldm,
+    images,
+    pixel_locs,
+    contexts=None,
+    device="cuda",
+    num_steps=100,
+    from_where=["down_cross", "mid_cross", "up_cross"],
+    upsample_res=32,
+    layers=[0, 1, 2, 3, 4, 5],
+    lr=1e-3,
+    noise_level=-1,
+    sigma=32,
+    flip_prob=0.5,
+    crop_percent=80,
+    rngs=None,
+):
+    """optimize_prompt for a batch of images and pixel locations, every unet call is shared by the batch
 
-                _pixel_loc = cropped_pixel.clone()
+    images is a list of images or a (batch, channels, height, width) tensor of them, which callers optimizing the
+    same images again upload once. The loss is the sum of the losses of the items, so every context gets the gradient of its own loss and
+    Adam, which works elementwise, updates it as if it was optimized alone. Returns [batch, words, dim] contexts
+    """
+    batch_size = len(pixel_locs)
+    rngs = [None] * batch_size if rngs is None else rngs
 
-                latent = image2latent(ldm, cropped_image, device)
+    # the images stay on the device, the crops of every step are resampled from them there in one go
+    images = image_batch(images, device)
 
-        noisy_image = ldm.scheduler.add_noise(
-            latent, torch.rand_like(latent), ldm.scheduler.timesteps[noise_level]
-        )
+    if contexts is None:
+        dim = backends.model_backend(ldm).context_dim
+        contexts = torch.cat([init_random_noise(device, dim=dim, generator=rng_utils.generator(rng, "init")) for rng in rngs])
 
-        controller = AttentionStore()
+    contexts.requires_grad = True
 
-        ptp_utils.register_attention_control(ldm, controller)
+    # optimize context to maximize attention at pixel_loc
+    optimizer = torch.optim.Adam([contexts], lr=lr)
 
-        _ = ptp_utils.diffusion_step(
-            ldm,
-            controller,
-            noisy_image,
-            context,
-            ldm.scheduler.timesteps[noise_level],
-            cfg=False,
-        )
+    # time the optimization
+    import time
 
-        attention_maps = upscale_to_img_size(
-            controller, from_where=from_where, upsample_res=upsample_res, layers=layers
-        )
-        num_maps = attention_maps.shape[0]
+    start = time.time()
 
-        # divide by the mean along the dim=1
-        attention_maps = torch.mean(attention_maps, dim=1)
+    encode_ahead = prefetch.encodes_ahead(ldm)
 
-        gt_maps = gaussian_circle(
-            _pixel_loc, size=upsample_res, sigma=sigma, device=device
+    def prepare(iteration):
+        cropped_images, cropped_pixels = prepare_crops(
+            images, pixel_locs, crop_percent=crop_percent, flip_prob=flip_prob, rngs=rngs, step=iteration
         )
+        if encode_ahead:
+            cropped_images = images2latents(ldm, cropped_images, device)
+        return cropped_images, cropped_pixels
+
+    with prefetch.prefetcher(ldm, prepare, range(num_steps)) as inputs:
+        for iteration, (crops, _pixel_locs) in zip(range(num_steps), inputs):
+            latents = crops if encode_ahead else images2latents(ldm, crops, device)
+
+            noisy_image = ldm.scheduler.add_noise(
+                latents, rng_utils.rand_like_each(rngs, latents, "noise", iteration), ldm.scheduler.timesteps[noise_level]
+            )
+
+            controller = run_unet(
+                ldm, noisy_image, contexts, ldm.scheduler.timesteps[noise_level]
+            )
+
+            attention_maps = upscale_to_img_size(
+                controller,
+                from_where=from_where,
+                upsample_res=upsample_res,
+                layers=layers,
+                num_heads=backends.model_backend(ldm).captured_heads,
+                batched=True,
+            )
+            num_maps = attention_maps.shape[1]
+
+            # divide by the mean along the heads
+            attention_maps = torch.mean(attention_maps, dim=2)
+
+            loss = 0
+            for b, _pixel_loc in enumerate(_pixel_locs):
+                gt_maps = gaussian_circle(
+                    _pixel_loc, size=upsample_res, sigma=sigma, device=device
+                )
 
-        gt_maps = gt_maps.reshape(1, -1).repeat(num_maps, 1)
-        attention_maps = attention_maps.reshape(num_maps, -1)
+                gt_maps = gt_maps.reshape(1, -1).repeat(num_maps, 1)
 
-        loss = torch.nn.MSELoss()(attention_maps, gt_maps)
-        loss.backward()
-        optimizer.step()
-        optimizer.zero_grad()
+                loss = loss + torch.nn.MSELoss()(attention_maps[b].reshape(num_maps, -1), gt_maps)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
 
     print(f"optimization took {time.time() - start} seconds")
 
-    return context
+    return contexts
@@ -0,0 +1,133 @@
+"""Prepares the inputs of the next unet steps in a background thread while the current step runs
+
+cropping, resizing and converting the crops (and encoding them when the vae is on another device than the
+unet) happens in a producer thread that stays up to depth steps ahead of the unet, through a bounded queue.
+torch releases the GIL inside its kernels, so the producer runs while the unet computes.
+
+the producer makes the random draws of the steps it prepares, so prefetching only gives the same results as
+running inline if the draws are keyed by a utils.rng.RandomStream (i.e. with --seed).
+"""
+
+import queue
+import threading
+import time
+
+
+class PipelineStats:
+    """time the unet waited for its inputs (stall) and time spent preparing them"""
+
+    def __init__(self):
+        self.items = 0
+        self.stall = 0.0
+        self.produce = 0.0
+
+    def __repr__(self):
+        return f"{self.items} inputs prepared in {self.produce:.1f}s, {self.stall:.1f}s stalled waiting for them"
+
+
+class Prefetcher:
+    """iterates produce(step) for every step, computed depth steps ahead in a background thread
+
+    with depth 0 produce runs inline when the next input is asked for. Exceptions of produce are raised
+    by the consumer, and leaving the with block stops the producer
+    """
+
+    def __init__(self, produce, steps, depth=2, stats=None):
+        self.produce = produce
+        self.steps = list(steps)
+        self.depth = depth
+        self.stats = PipelineStats() if stats is None else stats
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = None
+        if depth > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _timed(self, step):
+        start = time.perf_counter()
+        item = self.produce(step)
+        self.stats.produce += time.perf_counter() - start
+        self.stats.items += 1
+        return item
+
+    def _put(self, entry):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        for step in self.steps:
+            try:
+                entry = (True, self._timed(step))
+            except BaseException as e:
+                self._put((False, e))
+                return
+            if not self._put(entry):
+                return
+
+    def __iter__(self):
+        for step in self.steps:
+            start = time.perf_counter()
+            if self._thread is None:
+                item = self._timed(step)
+            else:
+                ok, item = self._queue.get()
+                if not ok:
+                    raise item
+            # inline preparation counts as stalled, the unet waits for it either way
+            self.stats.stall += time.perf_counter() - start
+            yield item
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def timed(iterable, stats):
+    """yields the items of iterable, e.g. a DataLoader, adding the time spent waiting for each to stats.stall"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        stats.stall += time.perf_counter() - start
+        stats.items += 1
+        yield item
+
+
+def enable_prefetch(ldm, depth=2, vae_device=None):
+    """makes optimize_prompt and run_image_with_tokens_cropped prepare their inputs depth steps ahead
+
+    with a vae_device the vae is moved there and the producer also encodes the crops
+    """
+    if vae_device is not None:
+        ldm.vae.to(vae_device)
+    ldm.prefetch_depth = depth
+    ldm.prefetch_stats = PipelineStats()
+    return ldm
+
+
+def encodes_ahead(ldm):
+    """whether the producer encodes the crops, only if that does not compete with the unet for its device"""
+    vae = next(ldm.vae.parameters()).device
+    unet = next(ldm.unet.parameters()).device
+    return vae != unet
+
+
+def prefetcher(ldm, produce, steps):
+    """a Prefetcher with the depth and stats set up by enable_prefetch, inline if there are none"""
+    return Prefetcher(produce, steps, depth=getattr(ldm, "prefetch_depth", 0), stats=getattr(ldm, "prefetch_stats", None))
@@ -20,15 +20,27 @@ import torch.nn.functional as F
 
 
 
+def model_dtype(model):
+    return next(model.unet.parameters()).dtype
+
+
+def autocast(model):
+    """autocasts to the dtype the unet was loaded in, this is a no-op for fp32 models"""
+    param = next(model.unet.parameters())
+    return torch.autocast(device_type=param.device.type, dtype=param.dtype, enabled=param.dtype != torch.float32)
+
+
 def diffusion_step(model, controller, latents, context, t, guidance_scale=None, cfg = True):
     
-    if cfg:
-        latents_input = torch.cat([latents] * 2)
-        noise_pred = model.unet(latents_input, t, encoder_hidden_states=context)["sample"]
-        noise_pred_uncond, noise_prediction_text = noise_pred.chunk(2)
-        noise_pred = noise_pred_uncond + guidance_scale * (noise_prediction_text - noise_pred_uncond)
-    else:
-        noise_pred = model.unet(latents, t, encoder_hidden_states=context)["sample"]
+    with autocast(model):
+        if cfg:
+            latents_input = torch.cat([latents] * 2)
+            noise_pred = model.unet(latents_input, t, encoder_hidden_states=context)["sample"]
+            noise_pred_uncond, noise_prediction_text = noise_pred.chunk(2)
+            noise_pred = noise_pred_uncond + guidance_scale * (noise_prediction_text - noise_pred_uncond)
+        else:
+            noise_pred = model.unet(latents, t, encoder_hidden_states=context)["sample"]
+    noise_pred = noise_pred.float()
         
     latents = model.scheduler.step(noise_pred, t, latents)["prev_sample"]
     latents = controller.step_callback(latents)
@@ -168,10 +180,11 @@ def register_attention_control(model, controller):
                 sim = sim.masked_fill(~mask, max_neg_value)
 
             # attention, what we cannot get enough of
-            attn = torch.nn.Softmax(dim=-1)(sim)
+            # the softmax and the stored maps are kept in fp32 under mixed precision
+            attn = torch.nn.Softmax(dim=-1)(sim.float())
             attn = attn.clone()
             attn = controller(attn, is_cross, place_in_unet)
-            out = torch.matmul(attn, v)
+            out = torch.matmul(attn.to(v.dtype), v)
             
             out = self.reshape_batch_dim_to_heads(out)
             return to_out(out)
@@ -0,0 +1,270 @@
+"""Append-only columnar store of the results of validate_epoch, instead of a pickle per pair
+
+every process writing results appends to its own shard directory, so nodes sharing the store never write the
+same file. A shard holds
+    rows.bin       one fixed size record per saved pair (see row_dtype): its numbers, category, difficulty,
+                   pck, timing and the offsets of its arrays in the blobs
+    keypoints.bin  float32 source, target and estimated key-points, the estimates of every layer and, for ablated
+                   retests, those of the first restarts
+    contexts.bin   float16 optimized contexts
+    meta.json      the alphas of the pck column, written last so a shard with a meta.json has all its files
+a row is appended after the arrays it points to, so every complete row refers to complete data and an
+interrupted write at most leaves unreferenced bytes. Readers memory map every shard and index the rows by
+pair and category. Every row records when it was written, the last written row of a pair replaces the others
+whichever shards they are in (clocks of the nodes should agree, as for eval.lease).
+"""
+
+import json
+import os
+import socket
+import time
+import uuid
+
+import numpy as np
+import torch
+
+from utils.evaluation import Evaluator
+from utils.metrics import DIFFICULTY_FIELDS
+
+
+def row_dtype(num_alphas):
+    return np.dtype([
+        ("pair", "<i8"),                  # number the pair was saved under, its dataset index when resuming or leasing
+        ("idx", "<i8"),                   # dataset index
+        ("category", "S32"),
+        ("difficulty", "i1", (len(DIFFICULTY_FIELDS),)),  # -1 for datasets without them
+        ("n_pts", "<i4"),
+        ("num_kps", "<i4"),               # padded number of key-points of the key-point arrays
+        ("num_layers", "<i4"),
+        ("num_restarts", "<i4"),          # estimates of the first restarts, see retest(ablate_results=True)
+        ("pckthres", "<f4"),
+        ("pck", "<f8", (num_alphas,)),
+        ("seconds", "<f4"),
+        ("written", "<i8"),               # nanoseconds since the epoch, increasing within a shard
+        ("kps_offset", "<i8"),            # in float32 elements of keypoints.bin
+        ("contexts_offset", "<i8"),       # in float16 elements of contexts.bin
+        ("contexts_shape", "<i4", (5,)),  # [keypoints, restarts, 1, words, dim]
+    ])
+
+
+class Shard:
+    """the memory mapped files of a shard, remapped as the shard grows"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.alphas = json.load(f)["alphas"]
+        self.dtype = row_dtype(len(self.alphas))
+        self.rows = np.zeros(0, dtype=self.dtype)
+        self._blobs = {}
+
+    def refresh(self):
+        """maps the complete rows written so far, returns whether there are new ones"""
+        num_rows = os.path.getsize(os.path.join(self.path, "rows.bin")) // self.dtype.itemsize
+        if num_rows == len(self.rows):
+            return False
+        self.rows = np.memmap(os.path.join(self.path, "rows.bin"), dtype=self.dtype, mode="r", shape=(num_rows,))
+        self._blobs = {}
+        return True
+
+    def blob(self, name, dtype):
+        if name not in self._blobs:
+            path = os.path.join(self.path, name)
+            self._blobs[name] = np.memmap(path, dtype=dtype, mode="r") if os.path.getsize(path) > 0 else np.zeros(0, dtype)
+        return self._blobs[name]
+
+
+class ResultsStore:
+    """the results of every shard under root, and the shard of this process once it appends
+
+    only root and the owner are pickled, so DataLoader workers map the shards themselves
+    """
+
+    def __init__(self, root, owner=None):
+        self.root = root
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}" if owner is None else owner
+        self._files = None
+        self._shards = {}
+        self.index = {}
+        self._written = {}
+        self._last_written = 0
+        os.makedirs(root, exist_ok=True)
+        self.refresh()
+
+    def __getstate__(self):
+        return {"root": self.root, "owner": self.owner, "_files": None, "_shards": {}, "index": {}, "_written": {}, "_last_written": 0}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.refresh()
+
+    # writing
+
+    def _open(self):
+        path = os.path.join(self.root, f"shard-{self.owner}")
+        os.makedirs(path, exist_ok=True)
+        self._files = {name: open(os.path.join(path, name), "ab") for name in ["rows.bin", "keypoints.bin", "contexts.bin"]}
+        self._dtype = row_dtype(len(Evaluator.alphas))
+
+        # readers only look at shards with a complete meta.json, so it is moved in place after the files exist
+        tmp_path = os.path.join(path, f"meta.json.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"alphas": list(Evaluator.alphas)}, f)
+        os.replace(tmp_path, os.path.join(path, "meta.json"))
+
+    def append(self, pair, result, seconds=0.0):
+        """appends a result as validate_epoch saves it (a dict of est_keypoints, src_kps, trg_kps, ind_layers,
+        contexts, pck, pckthres, n_pts, idx, groups and optionally ind_opt_iterations) under the number pair"""
+        if self._files is None:
+            self._open()
+
+        num_kps = result["src_kps"].shape[-1]
+        restarts = result.get("ind_opt_iterations", torch.zeros(0, 2, num_kps)).reshape(-1, 2, num_kps)
+        keypoints = torch.cat([result["src_kps"].reshape(1, 2, num_kps), result["trg_kps"].reshape(1, 2, num_kps),
+                               result["est_keypoints"].reshape(1, 2, num_kps), result["ind_layers"].reshape(-1, 2, num_kps),
+                               restarts.to(result["ind_layers"].device)])
+        contexts = result["contexts"].detach().cpu()
+
+        row = np.zeros(1, dtype=self._dtype)
+        row["pair"] = pair
+        row["idx"] = int(torch.as_tensor(result["idx"]).reshape(-1)[0])
+        groups = dict(group.split("/", 1) for group in result.get("groups", ["all"])[1:])
+        row["category"] = groups.get("category", "").encode()
+        row["difficulty"] = [int(groups.get(field, -1)) for field in DIFFICULTY_FIELDS]
+        row["n_pts"] = int(torch.as_tensor(result["n_pts"]).reshape(-1)[0])
+        row["num_kps"] = num_kps
+        row["num_restarts"] = len(restarts)
+        row["num_layers"] = len(keypoints) - 3 - len(restarts)
+        row["pckthres"] = float(torch.as_tensor(result["pckthres"]).reshape(-1)[0])
+        row["pck"] = result["pck"]
+        row["seconds"] = seconds
+        self._last_written = max(time.time_ns(), self._last_written + 1)
+        row["written"] = self._last_written
+        row["kps_offset"] = self._files["keypoints.bin"].tell() // 4
+        row["contexts_offset"] = self._files["contexts.bin"].tell() // 2
+        row["contexts_shape"] = contexts.shape
+
+        # the arrays first, the row that refers to them last
+        self._files["keypoints.bin"].write(keypoints.cpu().float().numpy().tobytes())
+        self._files["contexts.bin"].write(contexts.half().numpy().tobytes())
+        self._files["keypoints.bin"].flush()
+        self._files["contexts.bin"].flush()
+        self._files["rows.bin"].write(row.tobytes())
+        self._files["rows.bin"].flush()
+        self.refresh()
+
+    def close(self):
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+            self._files = None
+
+    # reading
+
+    def refresh(self):
+        """maps the rows other writers appended since the last refresh"""
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if name.startswith("shard-") and name not in self._shards and os.path.exists(os.path.join(path, "meta.json")):
+                self._shards[name] = Shard(path)
+        for name, shard in self._shards.items():
+            start = len(shard.rows)
+            if shard.refresh():
+                new = shard.rows[start:]
+                for row, pair, written in zip(range(start, len(shard.rows)), new["pair"].tolist(), new["written"].tolist()):
+                    # the last written row of a pair wins, ties go to the later shard name so every reader agrees
+                    if pair not in self.index or (written, name) >= self._written[pair]:
+                        self.index[pair] = (name, row)
+                        self._written[pair] = (written, name)
+
+    def is_done(self, pair):
+        if pair not in self.index:
+            self.refresh()
+        return pair in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def pairs(self):
+        return sorted(self.index)
+
+    def row(self, pair):
+        name, row = self.index[pair]
+        return self._shards[name].rows[row]
+
+    def rows(self, pairs=None):
+        """the rows of pairs (all by default) as one structured array"""
+        pairs = self.pairs() if pairs is None else pairs
+        by_shard = {}
+        for n, pair in enumerate(pairs):
+            name, row = self.index[pair]
+            by_shard.setdefault(name, ([], []))
+            by_shard[name][0].append(n)
+            by_shard[name][1].append(row)
+        rows = None
+        for name, (positions, shard_rows) in by_shard.items():
+            shard = self._shards[name]
+            if rows is None:
+                rows = np.zeros(len(pairs), dtype=shard.dtype)
+            rows[positions] = shard.rows[shard_rows]
+        return np.zeros(0, dtype=row_dtype(len(Evaluator.alphas))) if rows is None else rows
+
+    def categories(self):
+        return sorted({category.decode() for category in np.unique(self.rows()["category"])})
+
+    def category_pairs(self, category):
+        """the pairs of a category, in order"""
+        return np.asarray(self.pairs(), dtype=np.int64)[self.rows()["category"] == category.encode()].tolist()
+
+    def pck(self, category=None, alpha=None):
+        """the mean PCK of the stored pairs (of category only) at every alpha, or at alpha only"""
+        rows = self.rows()
+        if category is not None:
+            rows = rows[rows["category"] == category.encode()]
+        means = rows["pck"].mean(axis=0).tolist() if len(rows) else [0.0] * rows["pck"].shape[-1]
+        return means if alpha is None else means[self.alphas.index(alpha)]
+
+    @property
+    def alphas(self):
+        """the alphas of the pck column, those of the first shard"""
+        for shard in self._shards.values():
+            return [float(alpha) for alpha in shard.alphas]
+        return [float(alpha) for alpha in Evaluator.alphas]
+
+    def keypoints(self, pair):
+        """[3 + layers + restarts, 2, num_kps] source, target and estimated key-points, those of every layer and of the first restarts"""
+        name, row = self.index[pair]
+        shard, record = self._shards[name], self._shards[name].rows[row]
+        size = (3 + int(record["num_layers"]) + int(record["num_restarts"])) * 2 * int(record["num_kps"])
+        blob = shard.blob("keypoints.bin", np.float32)
+        offset = int(record["kps_offset"])
+        return torch.from_numpy(np.array(blob[offset:offset + size])).reshape(-1, 2, int(record["num_kps"]))
+
+    def contexts(self, pair):
+        """the optimized contexts, as float32"""
+        name, row = self.index[pair]
+        shard, record = self._shards[name], self._shards[name].rows[row]
+        shape = [int(size) for size in record["contexts_shape"]]
+        blob = shard.blob("contexts.bin", np.float16)
+        offset = int(record["contexts_offset"])
+        return torch.from_numpy(np.array(blob[offset:offset + int(np.prod(shape))])).reshape(shape).float()
+
+    def result(self, pair):
+        """a result as validate_epoch saves it with torch.save, without the correct_ids"""
+        record = self.row(pair)
+        keypoints = self.keypoints(pair)
+        category = record["category"].decode()
+        groups = ["all"] + ([f"category/{category}"] if category else []) + \
+                 [f"{field}/{value}" for field, value in zip(DIFFICULTY_FIELDS, record["difficulty"].tolist()) if value >= 0]
+        num_layers = int(record["num_layers"])
+        result = {"src_kps": keypoints[0][None], "trg_kps": keypoints[1][None], "est_keypoints": keypoints[2][None],
+                  "ind_layers": keypoints[3:3 + num_layers], "contexts": self.contexts(pair), "idx": torch.tensor([int(record["idx"])]),
+                  "pck": record["pck"].tolist(), "pckthres": torch.tensor([float(record["pckthres"])]),
+                  "n_pts": torch.tensor([int(record["n_pts"])]), "groups": groups, "seconds": float(record["seconds"])}
+        if record["num_restarts"] > 0:
+            result["ind_opt_iterations"] = keypoints[3 + num_layers:]
+        return result
+
+    def __repr__(self):
+        return f"ResultsStore({self.root}, {len(self)} pairs in {len(self._shards)} shards)"
+
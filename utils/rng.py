@@ -0,0 +1,53 @@
+"""Random draws keyed by where in the pipeline they are made
+
+every draw of a seeded run gets a fresh generator seeded from a hash of (seed, pair, keypoint, restart, stage,
+step), so its value depends on its key only and not on how many draws were made before it in the process. Serial,
+parallel, batched and resumed runs therefore draw the same crops, flips and noise, and anything computed from
+them can be cached across runs. Generators are always on the cpu so the draws do not depend on the device either.
+
+without a stream (rng=None) the global generators are used as before.
+"""
+
+import hashlib
+import struct
+
+import numpy as np
+import torch
+
+
+class RandomStream:
+    def __init__(self, seed, pair=0, keypoint=0, restart=0):
+        self.key = (seed, pair, keypoint, restart)
+
+    def seed(self, stage, step=0):
+        data = struct.pack("<5q", *self.key, step) + stage.encode()
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little") & (2**63 - 1)
+
+    def generator(self, stage, step=0):
+        return torch.Generator().manual_seed(self.seed(stage, step))
+
+    def __repr__(self):
+        return f"RandomStream(seed={self.key[0]}, pair={self.key[1]}, keypoint={self.key[2]}, restart={self.key[3]})"
+
+
+def generator(rng, stage, step=0):
+    """the generator of a draw, None (the global torch generator) without a stream"""
+    return None if rng is None else rng.generator(stage, step)
+
+
+def uniform(rng, stage, step=0):
+    """a float in [0, 1)"""
+    if rng is None:
+        return np.random.rand()
+    return torch.rand(1, generator=rng.generator(stage, step)).item()
+
+
+def rand_like(rng, tensor, stage, step=0):
+    if rng is None:
+        return torch.rand_like(tensor)
+    return torch.rand(tensor.shape, generator=rng.generator(stage, step)).to(tensor.device, tensor.dtype)
+
+
+def rand_like_each(rngs, tensor, stage, step=0):
+    """rand_like for every item of a batch, each from its own stream"""
+    return torch.cat([rand_like(rng, tensor[b : b + 1], stage, step) for b, rng in enumerate(rngs)])
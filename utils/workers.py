@@ -0,0 +1,156 @@
+"""Process pool whose workers share one copy of the model weights
+
+the parent loads the model once and moves its frozen weights into shared memory. On the cpu the workers
+are forked and map the same pages, so N workers cost one copy of the unet and vae plus their activations
+instead of N copies. cuda cannot be forked, there the workers are spawned and receive the weights as
+cuda ipc handles.
+"""
+
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+import numpy as np
+import torch
+
+
+_ldm = None
+
+
+def shared_modules(ldm):
+    """the modules holding weights the workers use"""
+    encoder = getattr(ldm, "encoder", None)
+    modules = [ldm.unet, ldm.vae, getattr(ldm, "quantized_unet", None), getattr(encoder, "taesd", None)]
+    return [module for module in modules if module is not None]
+
+
+def share_model(ldm):
+    """freezes the weights and moves them into shared memory"""
+    for module in shared_modules(ldm):
+        for param in module.parameters():
+            param.requires_grad = False
+        module.share_memory()
+    return ldm
+
+
+def memory_usage():
+    """resident, proportional and unique set size of this process in MB
+
+    shared weights count fully towards the rss of every process that maps them, but are split between
+    those processes in the pss and do not count towards the uss
+    """
+    try:
+        fields = {}
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[0].endswith(":"):
+                    fields[parts[0][:-1]] = int(parts[1]) / 1024
+        return {
+            "rss": fields["Rss"],
+            "pss": fields["Pss"],
+            "uss": fields["Private_Clean"] + fields["Private_Dirty"],
+        }
+    except (FileNotFoundError, KeyError):
+        import psutil
+
+        info = psutil.Process().memory_full_info()
+        return {"rss": info.rss / 1024**2, "pss": getattr(info, "pss", 0) / 1024**2, "uss": info.uss / 1024**2}
+
+
+def _init_worker(ldm, num_threads):
+    global _ldm
+    if ldm is not None:
+        _ldm = ldm
+    torch.set_num_threads(num_threads)
+
+    # forked workers inherit the random state of the parent and would all draw the same crops and noise
+    seed = int.from_bytes(os.urandom(4), "little")
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def _run_task(function, task):
+    start = time.time()
+    result = function(_ldm, task)
+    return os.getpid(), result, time.time() - start, memory_usage()
+
+
+class ModelPool:
+    """runs function(ldm, task) over tasks in num_workers processes that share the weights of ldm
+
+    tasks are handed out one at a time as workers become free. function has to be defined at module level
+    so it can be sent to spawned workers. The workers are started when the pool is created, so create it
+    before starting threads or DataLoader iterators. A worker that dies (e.g. killed for running out of memory) raises
+    BrokenProcessPool instead of losing its task
+    """
+
+    def __init__(self, ldm, num_workers, num_threads=None):
+        global _ldm
+
+        share_model(ldm)
+        self.num_workers = num_workers
+        self.stats = {}
+
+        if num_threads is None:
+            num_threads = max(1, torch.get_num_threads() // num_workers)
+
+        if next(ldm.unet.parameters()).device.type == "cpu":
+            # forked workers inherit the model from the parent's memory
+            _ldm = ldm
+            context = multiprocessing.get_context("fork")
+            initargs = (None, num_threads)
+        else:
+            context = torch.multiprocessing.get_context("spawn")
+            initargs = (ldm, num_threads)
+
+        self.executor = ProcessPoolExecutor(num_workers, mp_context=context, initializer=_init_worker, initargs=initargs)
+        # the workers start now rather than at the first task, so they are not forked from a parent that runs
+        # threads by then (e.g. the pin memory thread of a DataLoader)
+        wait([self.executor.submit(os.getpid) for _ in range(num_workers)])
+
+    def imap(self, function, tasks, queue_size=None):
+        """yields (worker pid, result) in the order the tasks finish
+
+        tasks is consumed lazily, at most queue_size (twice the number of workers by default) are in flight
+        """
+        tasks = iter(tasks)
+        queue_size = queue_size or 2 * self.num_workers
+        pending = {self.executor.submit(_run_task, function, task) for task in islice(tasks, queue_size)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pid, result, seconds, memory = future.result()
+                stats = self.stats.setdefault(pid, {"tasks": 0, "seconds": 0.0})
+                stats["tasks"] += 1
+                stats["seconds"] += seconds
+                stats["memory"] = memory
+                yield pid, result
+
+            for task in islice(tasks, len(done)):
+                pending.add(self.executor.submit(_run_task, function, task))
+
+    def report(self):
+        """prints the throughput and memory of every worker next to the parent's"""
+        parent = memory_usage()
+        print(f"parent: rss {parent['rss']:.0f} MB, pss {parent['pss']:.0f} MB, uss {parent['uss']:.0f} MB")
+        for pid, stats in sorted(self.stats.items()):
+            memory = stats["memory"]
+            print(
+                f"worker {pid}: {stats['tasks']} tasks in {stats['seconds']:.1f} seconds "
+                f"({stats['tasks'] / max(stats['seconds'], 1e-9):.3f} tasks per second), "
+                f"rss {memory['rss']:.0f} MB, pss {memory['pss']:.0f} MB, uss {memory['uss']:.0f} MB"
+            )
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()